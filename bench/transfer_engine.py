@@ -0,0 +1,272 @@
+"""
+Offline benchmark of the transfer engine in bot/FastTelethon.py.
+
+ParallelTransferrer runs unchanged against a fake MTProto sender instead of Telegram:
+the sender pool hands out FakeSender connections, and the fake client answers
+upload.getFile from an in-memory block and acknowledges upload.saveFilePart /
+upload.saveBigFilePart. The fake network adds a round trip per request (with
+jitter), a per-connection bandwidth cap and one shared link per direction, and can
+inject server errors, dropped connections and flood waits.
+
+Every cell of the grid (connection count x part size) is run once to time it (MB/s,
+CPU seconds per GB) and once under tracemalloc for the peak Python heap, so tracing
+never skews the timings. A connection count of 0 lets the adaptive probe choose.
+
+    python bench/transfer_engine.py --size-mb 128 --connections 1,4,8,16,0 --parts-kb 256,512,1024
+    python bench/transfer_engine.py --direction upload --fail-rate 0.02 --drop-rate 0.005
+"""
+import argparse
+import asyncio
+import logging
+import os
+import random
+import shutil
+import sys
+import tempfile
+import time
+import tracemalloc
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+# bot.config reads these at import time; the benchmark never connects to Telegram
+for name, value in (("APP_ID", "1"), ("API_HASH", "bench"), ("BOT_TOKEN", "bench"), ("OWNER", "1")):
+    os.environ.setdefault(name, value)
+
+from telethon import errors, helpers  # noqa: E402
+from telethon.tl.functions.upload import GetFileRequest  # noqa: E402
+from telethon.tl.types import InputDocumentFileLocation  # noqa: E402
+from telethon.tl.types.storage import FileUnknown  # noqa: E402
+from telethon.tl.types.upload import File  # noqa: E402
+
+from bot import FastTelethon  # noqa: E402
+
+GB = 1024 ** 3
+MB = 1024 ** 2
+DC_ID = 2
+BLOCK = os.urandom(FastTelethon.MAX_DOWNLOAD_PART_SIZE)
+
+
+class FakeNetwork:
+    """Latency, bandwidth and failures shared by every fake connection of a run."""
+
+    def __init__(self, args):
+        self.latency = args.latency_ms / 1000
+        self.jitter = args.jitter_ms / 1000
+        self.link_rate = args.link_mbs * MB
+        self.conn_rate = args.conn_mbs * MB
+        self.fail_rate = args.fail_rate
+        self.drop_rate = args.drop_rate
+        self.flood_rate = args.flood_rate
+        self.flood_seconds = args.flood_seconds
+        # Time at which each direction's link has sent everything queued on it
+        self.busy_until = {"upload": 0.0, "download": 0.0}
+        self.requests = 0
+        self.injected = 0
+        self.received = set()  # upload part indices acknowledged
+
+    async def carry(self, direction: str, size: int):
+        """One request: half a round trip, the payload over the shared link, the other half."""
+        loop = asyncio.get_running_loop()
+        await asyncio.sleep(max(0.0, self.latency / 2 + random.uniform(-self.jitter, self.jitter)))
+        now = loop.time()
+        # The shared link sends queued payloads one after another; a single connection never beats conn_rate
+        start = max(now, self.busy_until[direction])
+        self.busy_until[direction] = start + size / self.link_rate
+        done = max(self.busy_until[direction], now + size / self.conn_rate)
+        await asyncio.sleep(done - now + self.latency / 2)
+
+    def failure(self, sender):
+        """An error to raise instead of answering, or None"""
+        roll = random.random()
+        if roll < self.fail_rate:
+            error = errors.ServerError(request=None, message="INTERNAL")
+        elif roll < self.fail_rate + self.drop_rate:
+            sender.connected = False
+            error = ConnectionError("Connection reset by the fake network")
+        elif roll < self.fail_rate + self.drop_rate + self.flood_rate:
+            error = errors.FloodWaitError(request=None, capture=self.flood_seconds)
+        else:
+            return None
+        self.injected += 1
+        return error
+
+
+class FakeSender:
+    """Stands in for MTProtoSender: one connection to the fake DC."""
+
+    def __init__(self, network: FakeNetwork):
+        self.network = network
+        self.connected = True
+        self.auth_key = "bench"
+
+    def is_connected(self):
+        return self.connected
+
+    async def disconnect(self):
+        self.connected = False
+
+    async def send(self, request):
+        self.network.requests += 1
+        if not self.connected:
+            raise ConnectionError("Request on a closed fake connection")
+        error = self.network.failure(self)
+        if error is not None:
+            await asyncio.sleep(self.network.latency)
+            raise error
+        if isinstance(request, GetFileRequest):
+            await self.network.carry("download", request.limit)
+            # Parts never exceed BLOCK, so every offset is served from the same bytes
+            return File(FileUnknown(), 0, BLOCK[:request.limit])
+        await self.network.carry("upload", len(request.bytes))
+        self.network.received.add(request.file_part)
+        return True
+
+
+class FakePool(FastTelethon.SenderPool):
+    def __init__(self, network: FakeNetwork):
+        super().__init__()
+        self.network = network
+
+    async def _connect(self, client, dc_id, auth_key):
+        await asyncio.sleep(self.network.latency * 2)  # TCP and MTProto handshakes
+        self.created += 1
+        return FakeSender(self.network)
+
+
+class FakeClient:
+    """The few TelegramClient attributes ParallelTransferrer touches."""
+
+    def __init__(self):
+        self.loop = asyncio.get_running_loop()
+        self.session = type("Session", (), {"dc_id": DC_ID, "auth_key": "bench"})()
+
+    async def _call(self, sender, request):
+        return await sender.send(request)
+
+
+async def upload(client, network, path, size, part_kb, connections):
+    transferrer = FastTelethon.ParallelTransferrer(client, label=path)
+    with open(path, "rb") as f:
+        try:
+            part_size, part_count, _ = await transferrer.init_upload(
+                helpers.generate_random_long(), size, part_kb, connections or None
+            )
+            await transferrer.upload_parts(enumerate(FastTelethon.iter_file_parts(f, part_size)), lambda *_: None)
+        finally:
+            await transferrer.finish_upload()
+    assert len(network.received) == part_count, f"{len(network.received)} of {part_count} parts acknowledged"
+    return size
+
+
+async def download(client, network, path, size, part_kb, connections):
+    location = InputDocumentFileLocation(1, 1, b"", "")
+    fd = os.open(path, os.O_RDWR | os.O_CREAT | os.O_TRUNC, 0o644)
+    try:
+        transferrer = FastTelethon.ParallelTransferrer(client, label=path)
+        written = await transferrer.download_to(
+            fd, location, size, part_size_kb=part_kb, connection_count=connections or None
+        )
+    finally:
+        os.close(fd)
+    assert written == size, f"downloaded {written} of {size} bytes"
+    return written
+
+
+async def run_case(args, workdir, direction, connections, part_kb, trace):
+    network = FakeNetwork(args)
+    FastTelethon.sender_pool = FakePool(network)
+    # Adaptive runs start from scratch every time instead of from the previous cell's result
+    tuning = os.path.join(workdir, "tuning.json")
+    if os.path.exists(tuning):
+        os.remove(tuning)
+    FastTelethon.transfer_tuning = FastTelethon.TransferTuning(tuning)
+    client = FakeClient()
+    size = args.size_mb * MB
+    if direction == "upload":
+        transfer, path = upload, os.path.join(workdir, "source.bin")
+    else:
+        transfer, path = download, os.path.join(workdir, "target.bin")
+
+    if trace:
+        tracemalloc.start()
+    cpu, wall = time.process_time(), time.perf_counter()
+    try:
+        moved = await transfer(client, network, path, size, part_kb, connections)
+        cpu, wall = time.process_time() - cpu, time.perf_counter() - wall
+        peak = tracemalloc.get_traced_memory()[1] if trace else 0
+    finally:
+        if trace:
+            tracemalloc.stop()
+        await FastTelethon.sender_pool.close()
+    stats = FastTelethon.transfer_monitor.recent[-1]
+    return {
+        "mbs": moved / wall / MB,
+        "cpu": cpu * GB / moved,
+        "peak": peak / MB,
+        "senders": len(stats.senders),
+        "requests": network.requests,
+        "injected": network.injected,
+    }
+
+
+def parse_list(value):
+    return [int(item) for item in value.split(",") if item.strip()]
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--direction", choices=("upload", "download", "both"), default="both")
+    parser.add_argument("--size-mb", type=int, default=64, help="size of each transfer")
+    parser.add_argument("--connections", type=parse_list, default=[1, 2, 4, 8, 16, 0],
+                        help="connection counts to try; 0 = adaptive")
+    parser.add_argument("--parts-kb", type=parse_list, default=[128, 256, 512, 1024],
+                        help="part sizes to try; uploads skip those above 512")
+    parser.add_argument("--latency-ms", type=float, default=60, help="round trip per request")
+    parser.add_argument("--jitter-ms", type=float, default=10, help="± random spread of each one-way delay")
+    parser.add_argument("--link-mbs", type=float, default=100, help="shared link bandwidth per direction")
+    parser.add_argument("--conn-mbs", type=float, default=8, help="bandwidth cap of one connection")
+    parser.add_argument("--fail-rate", type=float, default=0.0, help="share of requests answered with a server error")
+    parser.add_argument("--drop-rate", type=float, default=0.0, help="share of requests that drop their connection")
+    parser.add_argument("--flood-rate", type=float, default=0.0, help="share of requests answered with a flood wait")
+    parser.add_argument("--flood-seconds", type=int, default=1, help="length of an injected flood wait")
+    parser.add_argument("--seed", type=int, default=1)
+    parser.add_argument("--verbose", action="store_true", help="keep the engine's retry and tuning logs")
+    args = parser.parse_args()
+    random.seed(args.seed)
+    if not args.verbose:
+        logging.getLogger("FastTelethon").setLevel(logging.WARNING)
+
+    directions = ("upload", "download") if args.direction == "both" else (args.direction,)
+    max_upload_kb = FastTelethon.MAX_UPLOAD_PART_SIZE // 1024
+    max_download_kb = FastTelethon.MAX_DOWNLOAD_PART_SIZE // 1024
+    workdir = tempfile.mkdtemp(prefix="transfer_bench_")
+    try:
+        if "upload" in directions:
+            with open(os.path.join(workdir, "source.bin"), "wb") as f:
+                for _ in range(args.size_mb):
+                    f.write(BLOCK)
+        print(
+            f"{args.size_mb} MiB per transfer, {args.latency_ms:g}±{args.jitter_ms:g} ms RTT, "
+            f"link {args.link_mbs:g} MB/s, {args.conn_mbs:g} MB/s per connection, "
+            f"{args.fail_rate:g} errors / {args.drop_rate:g} drops / {args.flood_rate:g} floods per request"
+        )
+        print(f"{'direction':<9} {'conns':>6} {'part KiB':>8} {'MB/s':>8} {'CPU s/GB':>9} "
+              f"{'peak MiB':>9} {'senders':>8} {'requests':>9} {'faults':>7}")
+        for direction in directions:
+            limit = max_upload_kb if direction == "upload" else max_download_kb
+            for part_kb in args.parts_kb:
+                if part_kb > limit:
+                    continue
+                for connections in args.connections:
+                    result = asyncio.run(run_case(args, workdir, direction, connections, part_kb, trace=False))
+                    traced = asyncio.run(run_case(args, workdir, direction, connections, part_kb, trace=True))
+                    print(
+                        f"{direction:<9} {connections or 'auto':>6} {part_kb:>8} {result['mbs']:>8.1f} "
+                        f"{result['cpu']:>9.3f} {traced['peak']:>9.1f} {result['senders']:>8} "
+                        f"{result['requests']:>9} {result['injected']:>7}"
+                    )
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+
+if __name__ == "__main__":
+    main()
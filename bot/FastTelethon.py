@@ -1,26 +1,35 @@
 import asyncio
 import hashlib
-import inspect
+import io
+import json
 import logging
 import math
+import mmap
 import os
-from collections import defaultdict
+import random
+import time
+from collections import defaultdict, deque
 from typing import (
     AsyncGenerator,
+    AsyncIterator,
     Awaitable,
     BinaryIO,
+    Callable,
     DefaultDict,
+    Deque,
+    Dict,
+    Iterator,
     List,
     Optional,
     Tuple,
     Union,
 )
 
-from telethon import TelegramClient, helpers, utils
+from telethon import TelegramClient, errors, helpers, utils
 from telethon.crypto import AuthKey
 from telethon.network import MTProtoSender
 from telethon.tl.alltlobjects import LAYER
-from telethon.tl.functions import InvokeWithLayerRequest
+from telethon.tl.functions import InvokeWithLayerRequest, PingRequest
 from telethon.tl.functions.auth import (
     ExportAuthorizationRequest,
     ImportAuthorizationRequest,
@@ -40,9 +49,63 @@ from telethon.tl.types import (
     InputPhotoFileLocation,
     TypeInputFile,
 )
-from .config import UPLOAD_CONNECTIONS
+from .config import UPLOAD_CONNECTIONS, SENDER_IDLE_TTL
+from .bandwidth import bandwidth
+from .disk_writer import DiskWriter
+from .transfer_stats import SenderStats, TransferStats, transfer_monitor
+from .funcn import report_progress, finish_progress
 
-filename = ""
+# Streamed uploads use the largest part size and announce an unknown part count
+# (-1) on every part but the last one.
+STREAM_PART_SIZE = 512 * 1024
+STREAM_TOTAL_PARTS = -1
+BIG_FILE_THRESHOLD = 10 * 1024 * 1024
+
+# Resumable downloads keep a bitmap of finished parts in `<file>.parts`, saved at most
+# once a second, and retry a dropped transfer this many times before giving up.
+PARTS_SUFFIX = ".parts"
+PARTS_SAVE_INTERVAL = 1.0
+RESUME_ATTEMPTS = 3
+RESUME_BACKOFF = 2
+# A partial download is kept for a later resume this long after its sidecar last changed
+PARTS_TTL = 24 * 3600
+
+# Resumable uploads keep their file_id and acknowledged parts in `<file>.upload`. Telegram
+# only holds on to saved parts for a limited time, so older state starts a fresh upload.
+UPLOAD_STATE_SUFFIX = ".upload"
+UPLOAD_STATE_TTL = 12 * 3600
+
+# Pooled connections idle for longer than SENDER_PING_AFTER are pinged before reuse;
+# at most MAX_IDLE_SENDERS per DC are kept (the most any one transfer opens).
+SENDER_PING_AFTER = 30
+SENDER_PING_TIMEOUT = 5
+MAX_IDLE_SENDERS = 20
+
+# A part that fails is retried up to PART_ATTEMPTS times, by whichever sender is free
+# first; a sender failing SENDER_MAX_FAILURES parts in a row gets a fresh connection.
+PART_ATTEMPTS = 5
+PART_TIMEOUT = 60
+PART_RETRY_BACKOFF = 1
+SENDER_MAX_FAILURES = 2
+# Flood waits don't count as attempts, but a part that has waited this many seconds in
+# total fails the transfer instead of holding its job slot indefinitely.
+MAX_PART_FLOOD_WAIT = 600
+
+# Adaptive transfers start with ADAPTIVE_START senders on a DC that hasn't been measured
+# yet, add one every PROBE_INTERVAL seconds while throughput grows by PROBE_GAIN, and
+# never exceed MAX_CONNECTIONS. The best count per DC is smoothed into TUNING_FILE once a
+# transfer has run for TUNING_MIN_SAMPLES intervals.
+ADAPTIVE_START = 4
+MAX_CONNECTIONS = 20
+PROBE_INTERVAL = 1.0
+PROBE_GAIN = 1.05
+TUNING_FILE = "transfer_tuning.json"
+TUNING_MIN_SAMPLES = 3
+TUNING_SMOOTHING = 0.3
+
+# Telegram's largest parts: 512 KiB for uploads, 1 MiB for upload.getFile
+MAX_UPLOAD_PART_SIZE = 512 * 1024
+MAX_DOWNLOAD_PART_SIZE = 1024 * 1024
 
 log: logging.Logger = logging.getLogger("FastTelethon")
 
@@ -55,9 +118,148 @@ TypeLocation = Union[
 ]
 
 
-class DownloadSender:
+def pick_part_size(file_size: int, download: bool = False) -> int:
+    """Bytes per part. Big files use the largest part Telegram allows, so fewer requests move the same data."""
+    if file_size > BIG_FILE_THRESHOLD:
+        return MAX_DOWNLOAD_PART_SIZE if download else MAX_UPLOAD_PART_SIZE
+    return utils.get_appropriated_part_size(file_size) * 1024
+
+
+class TransferTuning:
+    """
+    The sender count that gave the best throughput per DC and direction, smoothed over
+    transfers and kept in a JSON file so the next transfer starts its probe near it.
+    """
+
+    def __init__(self, path: str = TUNING_FILE) -> None:
+        self.path = path
+        self.entries: Dict[str, Dict[str, float]] = {}
+        self.load()
+
+    def load(self) -> None:
+        try:
+            with open(self.path) as f:
+                self.entries = json.load(f)
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError) as e:
+            log.warning(f"Could not load transfer tuning from {self.path}: {e}")
+
+    def save(self) -> None:
+        try:
+            with open(f"{self.path}.tmp", "w") as f:
+                json.dump(self.entries, f, indent=2)
+            os.replace(f"{self.path}.tmp", self.path)
+        except OSError as e:
+            log.warning(f"Could not save transfer tuning to {self.path}: {e}")
+
+    def start_count(self, dc_id: int, direction: str, default: int, limit: int) -> int:
+        entry = self.entries.get(f"{direction}:{dc_id}")
+        count = round(entry["connections"]) if entry else default
+        return max(1, min(limit, count))
+
+    def record(self, dc_id: int, direction: str, connections: int, rate: float) -> None:
+        key = f"{direction}:{dc_id}"
+        entry = self.entries.get(key)
+        if entry:
+            # One noisy transfer shouldn't move the starting point far
+            connections = TUNING_SMOOTHING * connections + (1 - TUNING_SMOOTHING) * entry["connections"]
+        self.entries[key] = {"connections": round(connections, 2), "throughput": round(rate), "updated": int(time.time())}
+        self.save()
+        log.info(f"DC {dc_id} {direction}: best {connections:.1f} senders at {rate / 1024 ** 2:.1f} MB/s")
+
+
+transfer_tuning = TransferTuning()
+
+
+def _retryable(error: BaseException) -> bool:
+    """Dropped connections, timeouts, flood waits and Telegram-side failures are worth another try."""
+    return isinstance(error, (
+        ConnectionError, asyncio.TimeoutError, errors.InvalidBufferError, errors.SecurityError,
+        errors.FloodError, errors.ServerError, errors.TimedOutError,
+    ))
+
+
+class TransferSender:
+    """One pooled connection of a ParallelTransferrer, and how it recovers from failed parts."""
+
     client: TelegramClient
     sender: MTProtoSender
+    dc_id: int
+    healthy: bool
+    failures: int
+    stats: SenderStats
+
+    def __init__(self, client: TelegramClient, sender: MTProtoSender, dc_id: int) -> None:
+        self.client = client
+        self.sender = sender
+        self.dc_id = dc_id
+        self.healthy = True
+        self.failures = 0
+        self.stats = SenderStats()
+
+    async def call(self, request):
+        if isinstance(request, GetFileRequest):
+            await bandwidth.acquire("download", request.limit)
+        else:
+            await bandwidth.acquire("upload", len(request.bytes))
+        started = time.monotonic()
+        try:
+            result = await asyncio.wait_for(self.client._call(self.sender, request), PART_TIMEOUT)
+        except errors.RPCError as e:
+            self.stats.record_error(e)
+            raise  # Telegram answered, so the connection itself is fine
+        except BaseException as e:
+            # Broken, or left with a request in flight: don't lend it to another transfer
+            self.healthy = False
+            if isinstance(e, Exception):
+                self.stats.record_error(e)
+            raise
+        self.failures = 0
+        payload = result.bytes if isinstance(request, GetFileRequest) else request.bytes
+        self.stats.record(time.monotonic() - started, len(payload))
+        return result
+
+    async def recover(self, error: BaseException, attempt: int) -> float:
+        """
+        Note a failed part, swapping the connection for a fresh one if this one is broken
+        or keeps failing. Returns how long to wait before the part is tried again.
+        """
+        if isinstance(error, errors.FloodWaitError):
+            return error.seconds
+        self.failures += 1
+        if not self.healthy or self.failures >= SENDER_MAX_FAILURES:
+            await self.reconnect()
+        return PART_RETRY_BACKOFF * attempt
+
+    async def reconnect(self) -> None:
+        await sender_pool.discard(self.sender)
+        self.sender = await sender_pool.acquire(self.client, self.dc_id)
+        self.healthy = True
+        self.failures = 0
+        self.stats.reconnects += 1
+        log.info(f"Replaced a failing connection to DC {self.dc_id}")
+
+    async def call_retrying(self, request):
+        """call(), retrying the same part on this sender; for transfers that must keep part order."""
+        attempt = 0
+        flood_waited = 0
+        while True:
+            try:
+                return await self.call(request)
+            except Exception as e:
+                if isinstance(e, errors.FloodWaitError):
+                    flood_waited += e.seconds
+                else:
+                    attempt += 1
+                if not _retryable(e) or attempt >= PART_ATTEMPTS or flood_waited > MAX_PART_FLOOD_WAIT:
+                    raise
+                delay = await self.recover(e, attempt)
+                log.warning(f"Part request failed ({e!r}); retrying in {delay}s")
+                await asyncio.sleep(delay)
+
+
+class DownloadSender(TransferSender):
     request: GetFileRequest
     remaining: int
     stride: int
@@ -66,14 +268,14 @@ class DownloadSender:
         self,
         client: TelegramClient,
         sender: MTProtoSender,
+        dc_id: int,
         file: TypeLocation,
         offset: int,
         limit: int,
         stride: int,
         count: int,
     ) -> None:
-        self.sender = sender
-        self.client = client
+        super().__init__(client, sender, dc_id)
         self.request = GetFileRequest(file, offset=offset, limit=limit)
         self.stride = stride
         self.remaining = count
@@ -81,18 +283,206 @@ class DownloadSender:
     async def next(self) -> Optional[bytes]:
         if not self.remaining:
             return None
-        result = await self.client._call(self.sender, self.request)
+        result = await self.call_retrying(self.request)
         self.remaining -= 1
         self.request.offset += self.stride
         return result.bytes
 
-    def disconnect(self) -> Awaitable[None]:
-        return self.sender.disconnect()
+    async def fetch(self, offset: int) -> bytes:
+        """Request the part at offset, regardless of this sender's own stride."""
+        self.request.offset = offset
+        result = await self.call(self.request)
+        return result.bytes
 
 
-class UploadSender:
-    client: TelegramClient
-    sender: MTProtoSender
+class PartBitmap:
+    """
+    Which parts of a partial transfer are done, persisted in a sidecar file so an
+    interrupted download or upload only has to move what is missing. extra holds
+    whatever else the transfer needs to resume (an upload's file_id).
+    """
+
+    def __init__(self, path: Optional[str], key: str, size: int, part_size: int) -> None:
+        self.path = path
+        self.key = key
+        self.size = size
+        self.part_size = part_size
+        self.part_count = math.ceil(size / part_size)
+        self.bits = bytearray((self.part_count + 7) // 8)
+        self.extra = {}
+        self.last_save = 0.0
+
+    @classmethod
+    def load(cls, path: str, key: str, size: int, part_size: int) -> "PartBitmap":
+        """Read the sidecar at path; starts empty if it is missing or describes another download."""
+        bitmap = cls(path, key, size, part_size)
+        try:
+            with open(path) as f:
+                state = json.load(f)
+            done = bytes.fromhex(state["done"])
+            if (state["key"], state["size"], state["part_size"]) == (key, size, part_size) and len(done) == len(bitmap.bits):
+                bitmap.bits[:] = done
+                bitmap.extra = state.get("extra") or {}
+        except (OSError, ValueError, KeyError, TypeError):
+            pass
+        return bitmap
+
+    def has(self, index: int) -> bool:
+        return bool(self.bits[index >> 3] & (1 << (index & 7)))
+
+    def mark(self, index: int) -> None:
+        self.bits[index >> 3] |= 1 << (index & 7)
+
+    def missing(self) -> List[int]:
+        return [index for index in range(self.part_count) if not self.has(index)]
+
+    def part_length(self, index: int) -> int:
+        return min(self.part_size, self.size - index * self.part_size)
+
+    def completed_bytes(self) -> int:
+        return sum(self.part_length(index) for index in range(self.part_count) if self.has(index))
+
+    def save(self, force: bool = False) -> None:
+        now = time.monotonic()
+        if not self.path or (not force and now - self.last_save < PARTS_SAVE_INTERVAL):
+            return
+        self.last_save = now
+        state = {
+            "key": self.key, "size": self.size, "part_size": self.part_size,
+            "done": self.bits.hex(), "extra": self.extra,
+        }
+        try:
+            with open(f"{self.path}.tmp", "w") as f:
+                json.dump(state, f)
+            os.replace(f"{self.path}.tmp", self.path)
+        except OSError as e:
+            log.warning(f"Could not save transfer progress to {self.path}: {e}")
+
+    def remove(self) -> None:
+        if not self.path:
+            return
+        try:
+            os.remove(self.path)
+        except FileNotFoundError:
+            pass
+
+
+class SenderPool:
+    """
+    Long-lived MTProto connections per DC. Transfers borrow senders and hand them back
+    instead of connecting (and, on a foreign DC, exporting the authorization) each time.
+    Idle connections are closed after idle_ttl, and one that has been idle for a while
+    is pinged before it is lent out again.
+    """
+
+    def __init__(self, idle_ttl: float = SENDER_IDLE_TTL, max_idle: int = MAX_IDLE_SENDERS) -> None:
+        self.idle_ttl = idle_ttl
+        self.max_idle = max_idle
+        self.idle: DefaultDict[int, List[Tuple[MTProtoSender, float]]] = defaultdict(list)
+        self.auth_keys: Dict[int, AuthKey] = {}
+        self.auth_locks: DefaultDict[int, asyncio.Lock] = defaultdict(asyncio.Lock)
+        self.created = 0
+        self.reused = 0
+        self._reaper: Optional[asyncio.Task] = None
+
+    def _auth_key(self, client: TelegramClient, dc_id: int) -> Optional[AuthKey]:
+        if dc_id == client.session.dc_id:
+            return client.session.auth_key
+        return self.auth_keys.get(dc_id)
+
+    async def acquire(self, client: TelegramClient, dc_id: int) -> MTProtoSender:
+        """A connected sender for dc_id: an idle one that passes the health check, or a new one."""
+        idle = self.idle[dc_id]
+        while idle:
+            sender, since = idle.pop()
+            if await self._usable(sender, since):
+                self.reused += 1
+                return sender
+            await self._close(sender)
+        if self._auth_key(client, dc_id) is None:
+            # Only the first connection to a foreign DC exports the authorization; the rest reuse its key
+            async with self.auth_locks[dc_id]:
+                if self._auth_key(client, dc_id) is None:
+                    sender = await self._connect(client, dc_id, None)
+                    auth = await client(ExportAuthorizationRequest(dc_id))
+                    client._init_request.query = ImportAuthorizationRequest(id=auth.id, bytes=auth.bytes)
+                    await sender.send(InvokeWithLayerRequest(LAYER, client._init_request))
+                    self.auth_keys[dc_id] = sender.auth_key
+                    return sender
+        return await self._connect(client, dc_id, self._auth_key(client, dc_id))
+
+    async def release(self, dc_id: int, sender: MTProtoSender) -> None:
+        """Take a sender back for reuse; closed if it's disconnected or the DC has enough idle ones."""
+        if not sender.is_connected() or len(self.idle[dc_id]) >= self.max_idle:
+            await self._close(sender)
+            return
+        self.idle[dc_id].append((sender, time.monotonic()))
+        if self._reaper is None or self._reaper.done():
+            self._reaper = asyncio.ensure_future(self._reap())
+
+    async def discard(self, sender: MTProtoSender) -> None:
+        await self._close(sender)
+
+    async def close(self) -> None:
+        """Close every idle connection; called on shutdown."""
+        if self._reaper is not None:
+            self._reaper.cancel()
+            self._reaper = None
+        idle = [sender for senders in self.idle.values() for sender, _ in senders]
+        self.idle.clear()
+        await asyncio.gather(*[self._close(sender) for sender in idle])
+        log.info(f"Sender pool closed ({self.created} connections opened, {self.reused} reuses)")
+
+    async def _connect(self, client: TelegramClient, dc_id: int, auth_key: Optional[AuthKey]) -> MTProtoSender:
+        dc = await client._get_dc(dc_id)
+        sender = MTProtoSender(auth_key, loggers=client._log)
+        await sender.connect(
+            client._connection(
+                dc.ip_address,
+                dc.port,
+                dc.id,
+                loggers=client._log,
+                proxy=client._proxy,
+            )
+        )
+        self.created += 1
+        return sender
+
+    async def _usable(self, sender: MTProtoSender, since: float) -> bool:
+        idle_for = time.monotonic() - since
+        if not sender.is_connected() or idle_for > self.idle_ttl:
+            return False
+        if idle_for < SENDER_PING_AFTER:
+            return True
+        try:
+            await asyncio.wait_for(sender.send(PingRequest(random.getrandbits(63))), SENDER_PING_TIMEOUT)
+            return True
+        except Exception as e:
+            log.info(f"Dropping a pooled connection that failed its health check: {e!r}")
+            return False
+
+    @staticmethod
+    async def _close(sender: MTProtoSender) -> None:
+        try:
+            await sender.disconnect()
+        except Exception as e:
+            log.warning(f"Error closing a transfer connection: {e}")
+
+    async def _reap(self) -> None:
+        while any(self.idle.values()):
+            await asyncio.sleep(max(1, self.idle_ttl / 2))
+            now = time.monotonic()
+            for dc_id, senders in self.idle.items():
+                expired = [sender for sender, since in senders if now - since > self.idle_ttl]
+                senders[:] = [(sender, since) for sender, since in senders if now - since <= self.idle_ttl]
+                for sender in expired:
+                    await self._close(sender)
+
+
+sender_pool = SenderPool()
+
+
+class UploadSender(TransferSender):
     request: Union[SaveFilePartRequest, SaveBigFilePartRequest]
     part_count: int
     stride: int
@@ -103,6 +493,7 @@ class UploadSender:
         self,
         client: TelegramClient,
         sender: MTProtoSender,
+        dc_id: int,
         file_id: int,
         part_count: int,
         big: bool,
@@ -110,8 +501,7 @@ class UploadSender:
         stride: int,
         loop: asyncio.AbstractEventLoop,
     ) -> None:
-        self.client = client
-        self.sender = sender
+        super().__init__(client, sender, dc_id)
         self.part_count = part_count
         if big:
             self.request = SaveBigFilePartRequest(file_id, index, part_count, b"")
@@ -121,49 +511,84 @@ class UploadSender:
         self.previous = None
         self.loop = loop
 
-    async def next(self, data: bytes) -> None:
+    async def next(self, data: bytes, total_parts: Optional[int] = None) -> None:
         if self.previous:
             await self.previous
-        self.previous = self.loop.create_task(self._next(data))
+        self.previous = self.loop.create_task(self._next(data, total_parts))
 
-    async def _next(self, data: bytes) -> None:
+    async def _next(self, data: bytes, total_parts: Optional[int] = None) -> None:
         self.request.bytes = data
-        await self.client._call(self.sender, self.request)
+        if total_parts is not None:
+            # Streamed uploads only learn their part count with the last part
+            self.request.file_total_parts = total_parts
+        await self.call_retrying(self.request)
         self.request.file_part += self.stride
 
-    async def disconnect(self) -> None:
-        if self.previous:
-            await self.previous
-        return await self.sender.disconnect()
+    async def send_part(self, index: int, data: bytes) -> None:
+        """Send the part at index, regardless of this sender's own stride."""
+        self.request.file_part = index
+        self.request.bytes = data
+        await self.call(self.request)
 
 
 class ParallelTransferrer:
     client: TelegramClient
     loop: asyncio.AbstractEventLoop
     dc_id: int
-    senders: Optional[List[Union[DownloadSender, UploadSender]]]
-    auth_key: AuthKey
+    senders: Optional[List[TransferSender]]
     upload_ticker: int
+    spawn: Optional[Callable[[], Awaitable[TransferSender]]]
+    tuning: Optional[Tuple[str, int]]
+    stats: Optional[TransferStats]
 
-    def __init__(self, client: TelegramClient, dc_id: Optional[int] = None) -> None:
+    def __init__(
+        self, client: TelegramClient, dc_id: Optional[int] = None, label: Optional[str] = None
+    ) -> None:
         self.client = client
         self.loop = self.client.loop
         self.dc_id = dc_id or self.client.session.dc_id
-        self.auth_key = (
-            None
-            if dc_id and self.client.session.dc_id != dc_id
-            else self.client.session.auth_key
-        )
+        self.label = label
         self.senders = None
         self.upload_ticker = 0
+        self.spawn = None
+        self.tuning = None
+        self.stats = None
+
+    def _begin(self, direction: str, size: Optional[int]) -> None:
+        self.stats = transfer_monitor.begin(direction, self.dc_id, self.label, size, bandwidth.current_job())
+
+    def _register(self, sender: TransferSender) -> TransferSender:
+        if self.stats:
+            self.stats.senders.append(sender.stats)
+        return sender
 
     async def _cleanup(self) -> None:
-        await asyncio.gather(*[sender.disconnect() for sender in self.senders])
-        self.senders = None
+        if self.stats:
+            transfer_monitor.end(self.stats)
+        senders, self.senders = self.senders, None
+        if senders:
+            # Return every sender even if one of them had a part fail, then report it
+            results = await asyncio.gather(
+                *[self._release(sender) for sender in senders], return_exceptions=True
+            )
+            for result in results:
+                if isinstance(result, BaseException):
+                    raise result
+
+    async def _release(self, sender: TransferSender) -> None:
+        """Hand a sender's connection back to the pool once its last part is done."""
+        try:
+            if isinstance(sender, UploadSender) and sender.previous:
+                await sender.previous
+        finally:
+            if sender.healthy:
+                await sender_pool.release(self.dc_id, sender.sender)
+            else:
+                await sender_pool.discard(sender.sender)
 
     @staticmethod
     def _get_connection_count(
-        file_size: int, max_count: int = 20, full_size: int = 100 * 1024 * 1024
+        file_size: int, max_count: int = MAX_CONNECTIONS, full_size: int = 100 * 1024 * 1024
     ) -> int:
         if file_size > full_size:
             return max_count
@@ -205,15 +630,16 @@ class ParallelTransferrer:
         stride: int,
         part_count: int,
     ) -> DownloadSender:
-        return DownloadSender(
+        return self._register(DownloadSender(
             self.client,
             await self._create_sender(),
+            self.dc_id,
             file,
             index * part_size,
             part_size,
             stride,
             part_count,
-        )
+        ))
 
     async def _init_upload(
         self, connections: int, file_id: int, part_count: int, big: bool
@@ -231,38 +657,20 @@ class ParallelTransferrer:
     async def _create_upload_sender(
         self, file_id: int, part_count: int, big: bool, index: int, stride: int
     ) -> UploadSender:
-        return UploadSender(
+        return self._register(UploadSender(
             self.client,
             await self._create_sender(),
+            self.dc_id,
             file_id,
             part_count,
             big,
             index,
             stride,
             loop=self.loop,
-        )
+        ))
 
     async def _create_sender(self) -> MTProtoSender:
-        dc = await self.client._get_dc(self.dc_id)
-        sender = MTProtoSender(self.auth_key, loggers=self.client._log)
-        await sender.connect(
-            self.client._connection(
-                dc.ip_address,
-                dc.port,
-                dc.id,
-                loggers=self.client._log,
-                proxy=self.client._proxy,
-            )
-        )
-        if not self.auth_key:
-            auth = await self.client(ExportAuthorizationRequest(self.dc_id))
-            self.client._init_request.query = ImportAuthorizationRequest(
-                id=auth.id, bytes=auth.bytes
-            )
-            req = InvokeWithLayerRequest(LAYER, self.client._init_request)
-            await sender.send(req)
-            self.auth_key = sender.auth_key
-        return sender
+        return await sender_pool.acquire(self.client, self.dc_id)
 
     async def init_upload(
         self,
@@ -271,20 +679,217 @@ class ParallelTransferrer:
         part_size_kb: Optional[float] = None,
         connection_count: Optional[int] = None,
     ) -> Tuple[int, int, bool]:
-        connection_count = connection_count or UPLOAD_CONNECTIONS
-        part_size = (part_size_kb or utils.get_appropriated_part_size(file_size)) * 1024
+        """
+        Prepare senders for a file of known size. Without a connection_count the sender
+        count adapts to the measured throughput, starting from the best count this DC
+        has shown before (or UPLOAD_CONNECTIONS).
+        """
+        if not connection_count:
+            limit = self._get_connection_count(file_size)
+            connection_count = transfer_tuning.start_count(self.dc_id, "upload", UPLOAD_CONNECTIONS, limit)
+            self.tuning = ("upload", limit)
+        part_size = int(part_size_kb * 1024) if part_size_kb else pick_part_size(file_size)
         part_count = (file_size + part_size - 1) // part_size
-        is_large = file_size > 10 * 1024 * 1024
+        is_large = file_size > BIG_FILE_THRESHOLD
+        self._begin("upload", file_size)
         await self._init_upload(connection_count, file_id, part_count, is_large)
+        self.spawn = lambda: self._create_upload_sender(file_id, part_count, is_large, 0, 1)
         return part_size, part_count, is_large
 
-    async def upload(self, part: bytes) -> None:
-        await self.senders[self.upload_ticker].next(part)
+    async def init_stream_upload(
+        self, file_id: int, connection_count: Optional[int] = None
+    ) -> int:
+        """Prepare a big-file upload whose size isn't known yet; returns the part size."""
+        connection_count = connection_count or UPLOAD_CONNECTIONS
+        self._begin("upload", None)
+        await self._init_upload(connection_count, file_id, STREAM_TOTAL_PARTS, True)
+        return STREAM_PART_SIZE
+
+    async def upload(self, part: bytes, total_parts: Optional[int] = None) -> None:
+        await self.senders[self.upload_ticker].next(part, total_parts)
         self.upload_ticker = (self.upload_ticker + 1) % len(self.senders)
 
     async def finish_upload(self) -> None:
         await self._cleanup()
 
+    async def _pump(
+        self,
+        parts: Iterator[Tuple[int, Optional[bytes]]],
+        handle: Callable[[TransferSender, int, Optional[bytes]], Awaitable[int]],
+    ) -> None:
+        """
+        Run handle(sender, index, data) for every part; it returns the bytes it moved. Each
+        sender takes the next part as soon as it is free, so a slow connection just ends
+        up with fewer parts. A failed part goes back on the queue for the next free sender
+        while the one that failed backs off (reconnecting if it keeps failing); a long
+        FloodWait only pauses that sender. Raises once a part has failed PART_ATTEMPTS
+        times or sat through more than MAX_PART_FLOOD_WAIT seconds of flood waits, on an
+        error a retry can't fix, or when no sender is left.
+
+        When the transfer is adaptive (self.tuning is set) the sender count is an AIMD
+        probe: one more sender every PROBE_INTERVAL while throughput keeps rising, the
+        last one retired again once it stops paying off, and half of them retired on a
+        flood wait before probing resumes. The best count seen is recorded in
+        transfer_tuning.
+        """
+        retry: Deque[Tuple[int, Optional[bytes]]] = deque()
+        attempts: DefaultDict[int, int] = defaultdict(int)
+        flood_waited: DefaultDict[int, int] = defaultdict(int)
+        retiring: List[TransferSender] = []
+        tasks: List[asyncio.Task] = []
+        in_flight = 0
+        alive = 0
+        moved = 0
+        flooded = False
+        failure: Optional[BaseException] = None
+        changed = asyncio.Event()
+        finished = asyncio.Event()
+
+        async def pause(delay: float) -> None:
+            try:
+                await asyncio.wait_for(finished.wait(), delay)
+            except asyncio.TimeoutError:
+                pass
+
+        def fail(error: BaseException) -> None:
+            nonlocal failure
+            failure = failure or error
+            finished.set()
+
+        async def work(sender: TransferSender) -> None:
+            nonlocal in_flight, alive, moved, flooded
+            try:
+                while not finished.is_set() and sender not in retiring:
+                    # Next() on a shared iterator never yields to the event loop, so no part is taken twice
+                    part = retry.popleft() if retry else next(parts, None)
+                    if part is None:
+                        if not in_flight:
+                            finished.set()
+                            return
+                        # Parts still in flight may fail and come back
+                        changed.clear()
+                        await changed.wait()
+                        continue
+                    index = part[0]
+                    in_flight += 1
+                    try:
+                        count = await handle(sender, *part)
+                        moved += count  # not `moved += await ...`, which would add to a stale total
+                        continue
+                    except Exception as e:
+                        if isinstance(e, errors.FloodWaitError):
+                            flooded = True
+                            flood_waited[index] += e.seconds
+                        else:
+                            attempts[index] += 1
+                        if (not _retryable(e) or attempts[index] >= PART_ATTEMPTS
+                                or flood_waited[index] > MAX_PART_FLOOD_WAIT):
+                            raise
+                        retry.append(part)
+                        error = e
+                    finally:
+                        in_flight -= 1
+                        changed.set()
+                    try:
+                        delay = await sender.recover(error, attempts[index])
+                    except Exception as e:
+                        if alive == 1:
+                            raise
+                        log.warning(f"Dropping a sender that could not reconnect ({e!r}); the others take its parts")
+                        return
+                    log.info(f"Part {index} failed ({error!r}); requeued, this sender pauses {delay}s")
+                    await pause(delay)
+            except Exception as e:
+                fail(e)
+            finally:
+                alive -= 1
+                changed.set()
+                if not alive and not finished.is_set():
+                    fail(ConnectionError("Every sender of the transfer has stopped"))
+
+        def start(sender: TransferSender) -> None:
+            nonlocal alive
+            alive += 1
+            tasks.append(self.loop.create_task(work(sender)))
+
+        rates: Dict[int, float] = {}
+        samples = 0
+
+        async def tune(direction: str, limit: int) -> None:
+            nonlocal flooded, samples
+            probing = True
+            last_moved, last_time = moved, time.monotonic()
+            while True:
+                await pause(PROBE_INTERVAL)
+                if finished.is_set():
+                    return
+                now = time.monotonic()
+                rate = (moved - last_moved) / (now - last_time)
+                last_moved, last_time = moved, now
+                active = [sender for sender in self.senders if sender not in retiring]
+                count = len(active)
+                if flooded:
+                    # Multiplicative decrease, then probe upwards again from there
+                    flooded, probing = False, True
+                    keep = max(1, count // 2)
+                    retiring.extend(active[keep:])
+                    rates.clear()
+                    log.info(f"Flood wait on DC {self.dc_id}: {direction} senders cut from {count} to {keep}")
+                    continue
+                rates[count] = max(rate, rates.get(count, 0.0))
+                samples += 1
+                if not probing:
+                    continue
+                fewer = max((r for c, r in rates.items() if c < count), default=0.0)
+                if fewer and rate < fewer * PROBE_GAIN:
+                    # The last sender added didn't pay off: retire it and hold
+                    retiring.append(active[-1])
+                    rates.pop(count)
+                    probing = False
+                elif count < limit:
+                    try:
+                        sender = await self.spawn()
+                    except Exception as e:
+                        log.warning(f"Could not add a sender to DC {self.dc_id} ({e!r}); holding at {count}")
+                        probing = False
+                        continue
+                    self.senders.append(sender)
+                    if not finished.is_set():
+                        start(sender)
+
+        for sender in list(self.senders):
+            start(sender)
+        tuner = self.loop.create_task(tune(*self.tuning)) if self.tuning else None
+        try:
+            await finished.wait()
+        finally:
+            for task in tasks + ([tuner] if tuner else []):
+                task.cancel()
+            # Let every worker stop before the senders are handed back
+            await asyncio.gather(*tasks, *([tuner] if tuner else []), return_exceptions=True)
+        if tuner and not tuner.cancelled() and tuner.exception():
+            log.warning(f"Connection tuning stopped early: {tuner.exception()!r}")
+        if failure is not None:
+            if self.stats:
+                self.stats.failed = True
+            raise failure
+        if self.tuning and samples >= TUNING_MIN_SAMPLES:
+            best = max(rates, key=rates.get)
+            transfer_tuning.record(self.dc_id, self.tuning[0], best, rates[best])
+
+    async def upload_parts(
+        self,
+        parts: Iterator[Tuple[int, bytes]],
+        on_ack: Callable[[int, int], None],
+    ) -> None:
+        """Send (index, data) parts across all senders; on_ack(index, length) runs as each one is acknowledged."""
+        async def handle(sender: UploadSender, index: int, data: bytes) -> int:
+            await sender.send_part(index, data)
+            on_ack(index, len(data))
+            return len(data)
+
+        await self._pump(parts, handle)
+
     async def download(
         self,
         file: TypeLocation,
@@ -293,22 +898,115 @@ class ParallelTransferrer:
         connection_count: Optional[int] = None,
     ) -> AsyncGenerator[bytes, None]:
         connection_count = connection_count or self._get_connection_count(file_size)
-        part_size = (part_size_kb or utils.get_appropriated_part_size(file_size)) * 1024
+        part_size = int(part_size_kb * 1024) if part_size_kb else pick_part_size(file_size, download=True)
         part_count = math.ceil(file_size / part_size)
+        self._begin("download", file_size)
         await self._init_download(connection_count, file, part_count, part_size)
 
         part = 0
-        while part < part_count:
-            tasks = []
-            for sender in self.senders:
-                tasks.append(self.loop.create_task(sender.next()))
+        tasks = []
+        try:
+            while part < part_count:
+                tasks = []
+                for sender in self.senders:
+                    tasks.append(self.loop.create_task(sender.next()))
+                for task in tasks:
+                    data = await task
+                    if not data:
+                        break
+                    yield data
+                    part += 1
+        finally:
+            # Also runs when a consumer closes the generator early
             for task in tasks:
-                data = await task
-                if not data:
-                    break
-                yield data
-                part += 1
-        await self._cleanup()
+                task.cancel()
+            await self._cleanup()
+
+
+    async def download_to(
+        self,
+        fd: int,
+        file: TypeLocation,
+        file_size: int,
+        progress_callback: callable = None,
+        part_size_kb: Optional[float] = None,
+        connection_count: Optional[int] = None,
+        bitmap: Optional[PartBitmap] = None,
+        refresh_location: Optional[Callable[[], Awaitable[TypeLocation]]] = None,
+    ) -> int:
+        """
+        Download into the open file descriptor fd. Senders share the parts through _pump
+        and hand each one to a DiskWriter for its offset, so throughput follows the sum of
+        the senders, a slow disk never stalls the loop, and a failed part is simply
+        fetched again by another one. With a bitmap only its missing parts are fetched,
+        and each part is recorded in it once it is on disk.
+        refresh_location returns a fresh document when the file reference expires.
+        Without a connection_count the sender count adapts to the measured throughput.
+        Returns the number of bytes on disk.
+        """
+        if not connection_count:
+            limit = self._get_connection_count(file_size)
+            connection_count = transfer_tuning.start_count(self.dc_id, "download", ADAPTIVE_START, limit)
+            self.tuning = ("download", limit)
+        if bitmap:
+            part_size = bitmap.part_size
+        else:
+            part_size = int(part_size_kb * 1024) if part_size_kb else pick_part_size(file_size, download=True)
+        part_count = math.ceil(file_size / part_size)
+        self._begin("download", file_size)
+        await self._init_download(connection_count, file, part_count, part_size)
+        writer = DiskWriter(fd, file_size, self.label or "download")
+
+        written = bitmap.completed_bytes() if bitmap else 0
+        reporting: Optional[asyncio.Future] = None
+        parts = ((index, None) for index in (bitmap.missing() if bitmap else range(part_count)))
+        refresh_lock = asyncio.Lock()
+        location = self.senders[0].request.location
+
+        async def refresh(stale) -> None:
+            nonlocal location
+            async with refresh_lock:
+                if location is not stale:
+                    return  # another sender already refreshed it
+                _, location = utils.get_input_location(await refresh_location())
+                for sender in self.senders:
+                    sender.request.location = location
+                log.info("Refreshed an expired file reference")
+
+        async def pull(sender: DownloadSender, index: int, _) -> int:
+            nonlocal written, reporting
+            offset = index * part_size
+            try:
+                data = await sender.fetch(offset)
+            except errors.FileReferenceExpiredError:
+                if not refresh_location:
+                    raise
+                await refresh(sender.request.location)
+                data = await sender.fetch(offset)
+            if not data:
+                return 0
+
+            def on_disk() -> None:
+                bitmap.mark(index)
+                bitmap.save()
+
+            await writer.write(offset, data, on_disk if bitmap else None)
+            written += len(data)
+            reporting = report_progress(progress_callback, written, file_size, pending=reporting)
+            return len(data)
+
+        # Added senders start from whatever location is current by then
+        self.spawn = lambda: self._create_download_sender(location, 0, part_size, 0, 0)
+        try:
+            try:
+                await self._pump(parts, pull)
+            finally:
+                await self._cleanup()
+        finally:
+            # Parts fetched before a failure still reach the disk and the bitmap
+            await writer.close()
+        await finish_progress(reporting)
+        return written
 
 
 parallel_transfer_locks: DefaultDict[int, asyncio.Lock] = defaultdict(
@@ -316,53 +1014,155 @@ parallel_transfer_locks: DefaultDict[int, asyncio.Lock] = defaultdict(
 )
 
 
-def stream_file(file_to_stream: BinaryIO, chunk_size=1024):
-    while True:
-        data_read = file_to_stream.read(chunk_size)
-        if not data_read:
-            break
-        yield data_read
+def iter_file_parts(
+    file: BinaryIO, part_size: int, indices: Optional[List[int]] = None
+) -> Iterator[bytes]:
+    """
+    Yield the file in part_size-aligned parts, or only the parts at indices. Each part
+    is sliced straight out of a read-only mmap, so it is copied exactly once, into the
+    bytes object Telethon serializes (its TL serializer only accepts bytes, so a
+    memoryview can't go further). Files that can't be mapped (empty files, pipes,
+    in-memory buffers) are read part by part.
+    """
+    try:
+        mapped = mmap.mmap(file.fileno(), 0, access=mmap.ACCESS_READ)
+    except (AttributeError, ValueError, OSError, io.UnsupportedOperation):
+        if indices is not None:
+            for index in indices:
+                file.seek(index * part_size)
+                yield file.read(part_size)
+            return
+        while True:
+            data = file.read(part_size)
+            if not data:
+                return
+            yield data
+    with mapped:
+        if hasattr(mapped, "madvise"):
+            mapped.madvise(mmap.MADV_SEQUENTIAL)
+        offsets = range(0, len(mapped), part_size) if indices is None else (i * part_size for i in indices)
+        for offset in offsets:
+            yield mapped[offset:offset + part_size]
+
+
+def _upload_state_key(path: str) -> str:
+    stat = os.stat(path)
+    return f"{stat.st_size}:{stat.st_mtime_ns}"
+
+
+def load_upload_state(path: str, part_size: int, origin: Optional[str] = None) -> PartBitmap:
+    """
+    The saved state of an earlier upload of path, or a fresh one with a new file_id if
+    there is none, the file has changed since, it was produced from another origin (the
+    caller's id for the source and settings behind it), or Telegram has likely dropped
+    its parts.
+    """
+    size = os.path.getsize(path)
+    state = PartBitmap.load(f"{path}{UPLOAD_STATE_SUFFIX}", _upload_state_key(path), size, part_size)
+    started = state.extra.get("started", 0)
+    if (not state.extra.get("file_id") or time.time() - started > UPLOAD_STATE_TTL
+            or state.extra.get("origin") != origin):
+        state.bits[:] = bytes(len(state.bits))
+        state.extra = {"file_id": helpers.generate_random_long(), "started": time.time(), "origin": origin}
+    state.save(force=True)
+    return state
+
+
+def has_pending_upload(path: str, origin: Optional[str] = None) -> bool:
+    """
+    True if path has upload state from an earlier attempt that still matches the file
+    and has not expired; with origin, only if that attempt was for the same origin.
+    """
+    try:
+        with open(f"{path}{UPLOAD_STATE_SUFFIX}") as f:
+            state = json.load(f)
+        return (
+            state["key"] == _upload_state_key(path)
+            and time.time() - state["extra"]["started"] <= UPLOAD_STATE_TTL
+            and (origin is None or state["extra"].get("origin") == origin)
+        )
+    except (OSError, ValueError, KeyError, TypeError):
+        return False
+
+
+def forget_upload(path: str) -> None:
+    """Drop the upload state of path, once the upload has been sent or is unusable."""
+    try:
+        os.remove(f"{path}{UPLOAD_STATE_SUFFIX}")
+    except FileNotFoundError:
+        pass
 
 
 async def _internal_transfer_to_telegram(
-    client: TelegramClient, response: BinaryIO, progress_callback: callable
+    client: TelegramClient,
+    response: BinaryIO,
+    name: str,
+    progress_callback: callable,
+    resumable: bool = False,
+    origin: Optional[str] = None,
 ) -> Tuple[TypeInputFile, int]:
-    file_id = helpers.generate_random_long()
+    """
+    Upload an open file. Parts are only counted once the server acknowledges them; a
+    failed part is retried by the next free sender, and if the whole transfer still
+    drops, the next attempt resends just the unacknowledged parts under the same file_id.
+    With resumable the file_id and acked parts are also kept in `<file>.upload`, so a
+    later call for the same, unchanged file from the same origin picks up where this one
+    stopped; forget_upload() drops that state once it is sent.
+    """
     file_size = os.path.getsize(response.name)
+    part_size = pick_part_size(file_size)
+    if resumable:
+        state = load_upload_state(response.name, part_size, origin)
+        file_id = state.extra["file_id"]
+        if state.completed_bytes():
+            log.info(f"Resuming upload of {response.name}: {state.completed_bytes()} of {file_size} bytes already sent")
+    else:
+        file_id = helpers.generate_random_long()
+        state = PartBitmap(None, "", file_size, part_size)
+    part_count = state.part_count
+    is_large = file_size > BIG_FILE_THRESHOLD
+
+    uploaded = state.completed_bytes()
+    reporting: Optional[asyncio.Future] = None
+
+    def acked(index: int, length: int) -> None:
+        nonlocal uploaded, reporting
+        state.mark(index)
+        state.save()
+        uploaded += length
+        reporting = report_progress(progress_callback, uploaded, file_size, pending=reporting)
+
+    for attempt in range(1, RESUME_ATTEMPTS + 1):
+        missing = state.missing()
+        if not missing:
+            break
+        uploader = ParallelTransferrer(client, label=response.name)
+        reader = iter_file_parts(response, part_size, missing)
+        try:
+            try:
+                await uploader.init_upload(file_id, file_size)
+                await uploader.upload_parts(zip(missing, reader), acked)
+            finally:
+                reader.close()
+                await uploader.finish_upload()
+        except Exception as e:
+            if attempt == RESUME_ATTEMPTS:
+                raise
+            log.warning(f"Upload of {response.name} failed ({e}); resending {len(state.missing())} unacknowledged parts")
+            await asyncio.sleep(RESUME_BACKOFF * attempt)
+        finally:
+            state.save(force=True)
+    await finish_progress(reporting)
+    if state.missing():
+        raise ValueError(f"Upload incomplete: {len(state.missing())} of {part_count} parts unacknowledged")
 
-    hash_md5 = hashlib.md5()
-    uploader = ParallelTransferrer(client)
-    part_size, part_count, is_large = await uploader.init_upload(file_id, file_size)
-    buffer = bytearray()
-    for data in stream_file(response):
-        if progress_callback:
-            r = progress_callback(response.tell(), file_size)
-            if inspect.isawaitable(r):
-                try:
-                    await r
-                except BaseException:
-                    pass
-        if not is_large:
-            hash_md5.update(data)
-        if len(buffer) == 0 and len(data) == part_size:
-            await uploader.upload(data)
-            continue
-        new_len = len(buffer) + len(data)
-        if new_len >= part_size:
-            cutoff = part_size - len(buffer)
-            buffer.extend(data[:cutoff])
-            await uploader.upload(bytes(buffer))
-            buffer.clear()
-            buffer.extend(data[cutoff:])
-        else:
-            buffer.extend(data)
-    if len(buffer) > 0:
-        await uploader.upload(bytes(buffer))
-    await uploader.finish_upload()
     if is_large:
-        return InputFileBig(file_id, part_count, filename), file_size
-    else:
-        return InputFile(file_id, part_count, filename, hash_md5.hexdigest()), file_size
+        return InputFileBig(file_id, part_count, name), file_size
+    # Small files are sent with the md5 of the whole file, acked parts included
+    hash_md5 = hashlib.md5()
+    for part in iter_file_parts(response, part_size):
+        hash_md5.update(part)
+    return InputFile(file_id, part_count, name, hash_md5.hexdigest()), file_size
 
 
 async def download_file(
@@ -373,20 +1173,127 @@ async def download_file(
 ) -> BinaryIO:
     size = location.size
     dc_id, location = utils.get_input_location(location)
-    # We lock the transfers because telegram has connection count limits
-    downloader = ParallelTransferrer(client, dc_id)
+    if not size:
+        return out
+    downloader = ParallelTransferrer(client, dc_id, getattr(out, "name", None))
+    out.flush()
+    written = await downloader.download_to(out.fileno(), location, size, progress_callback)
+    if written != size:
+        raise ValueError(f"Download incomplete: got {written} of {size} bytes")
+    out.seek(size)
+    return out
+
+
+async def download_resumable(
+    client: TelegramClient,
+    location: TypeLocation,
+    path: str,
+    progress_callback: callable = None,
+    refresh_location: Optional[Callable[[], Awaitable[TypeLocation]]] = None,
+) -> str:
+    """
+    Download a document to path, recording finished parts in `path.parts` so a retry
+    (or the same file queued again after a restart) only fetches the missing ones.
+    A dropped transfer is resumed up to RESUME_ATTEMPTS times. refresh_location returns
+    a fresh copy of the document when its file reference has expired.
+    """
+    size = location.size
+    key = str(getattr(location, "id", ""))
+    dc_id, input_location = utils.get_input_location(location)
+    part_size = pick_part_size(size, download=True)
+    bitmap = PartBitmap.load(f"{path}{PARTS_SUFFIX}", key, size, part_size)
+    if not os.path.exists(path):
+        bitmap = PartBitmap(bitmap.path, key, size, part_size)
+    elif bitmap.completed_bytes():
+        log.info(f"Resuming {path}: {bitmap.completed_bytes()} of {size} bytes already on disk")
+
+    async def refresh() -> TypeLocation:
+        # Later attempts must start from the fresh reference too
+        nonlocal input_location
+        document = await refresh_location()
+        _, input_location = utils.get_input_location(document)
+        return document
+
+    with open(path, "r+b" if bitmap.completed_bytes() else "wb") as out:
+        for attempt in range(1, RESUME_ATTEMPTS + 1):
+            if not bitmap.missing():
+                break  # finished before a restart got to remove the sidecar
+            downloader = ParallelTransferrer(client, dc_id, path)
+            try:
+                await downloader.download_to(
+                    out.fileno(), input_location, size, progress_callback,
+                    bitmap=bitmap, refresh_location=refresh if refresh_location else None,
+                )
+                break
+            except Exception as e:
+                bitmap.save(force=True)
+                if attempt == RESUME_ATTEMPTS:
+                    raise
+                log.warning(f"Download of {path} failed ({e}); resuming {len(bitmap.missing())} missing parts")
+                await asyncio.sleep(RESUME_BACKOFF * attempt)
+            finally:
+                bitmap.save(force=True)
+
+    missing = bitmap.missing()
+    if missing:
+        raise ValueError(f"Download incomplete: {len(missing)} of {bitmap.part_count} parts missing")
+    bitmap.remove()
+    return path
+
+
+async def iter_download(
+    client: TelegramClient,
+    location: TypeLocation,
+    label: Optional[str] = None,
+) -> AsyncGenerator[bytes, None]:
+    """Yield the file's bytes in order as they arrive, without writing them anywhere."""
+    size = location.size
+    dc_id, location = utils.get_input_location(location)
+    downloader = ParallelTransferrer(client, dc_id, label)
     downloaded = downloader.download(location, size)
-    async for x in downloaded:
-        out.write(x)
-        if progress_callback:
-            r = progress_callback(out.tell(), size)
-            if inspect.isawaitable(r):
-                try:
-                    await r
-                except BaseException:
-                    pass
+    try:
+        async for x in downloaded:
+            yield x
+    finally:
+        await downloaded.aclose()
 
-    return out
+
+async def upload_stream(
+    client: TelegramClient,
+    chunks: AsyncIterator[bytes],
+    name: str,
+) -> Tuple[TypeInputFile, int]:
+    """
+    Upload a file while it is still being produced. Full parts are sent as soon as
+    they are available; the part count is finalized with the last part.
+    Returns the InputFileBig and the number of bytes uploaded.
+    """
+    file_id = helpers.generate_random_long()
+    uploader = ParallelTransferrer(client, label=name)
+    part_size = await uploader.init_stream_upload(file_id)
+    buffer = bytearray()
+    part_count = 0
+    file_size = 0
+    try:
+        async for data in chunks:
+            buffer += data
+            file_size += len(data)
+            # Always hold back at least one byte so the final part is sent with the total.
+            # Parts are copied out once, and only the short tail is moved to the front.
+            start = 0
+            with memoryview(buffer) as view:
+                while len(buffer) - start > part_size:
+                    await uploader.upload(view[start:start + part_size].tobytes())
+                    start += part_size
+                    part_count += 1
+            del buffer[:start]
+        if not buffer:
+            raise ValueError("Nothing to upload")
+        part_count += 1
+        await uploader.upload(bytes(buffer), total_parts=part_count)
+    finally:
+        await uploader.finish_upload()
+    return InputFileBig(file_id, part_count, name), file_size
 
 
 async def upload_file(
@@ -394,7 +1301,7 @@ async def upload_file(
     file: BinaryIO,
     name,
     progress_callback: callable = None,
+    resumable: bool = False,
+    origin: Optional[str] = None,
 ) -> TypeInputFile:
-    global filename
-    filename = name
-    return (await _internal_transfer_to_telegram(client, file, progress_callback))[0]
+    return (await _internal_transfer_to_telegram(client, file, name, progress_callback, resumable, origin))[0]
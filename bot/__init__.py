@@ -2,6 +2,7 @@ from telethon import TelegramClient
 
 # Import from config which is now the base for LOGS and settings
 from .config import LOGS, APP_ID, API_HASH, BOT_TOKEN, OWNER, GPU_TYPE
+from .http_client import http_client
 
 try:
     if not all([APP_ID, API_HASH, BOT_TOKEN, OWNER]):
@@ -31,6 +32,9 @@ async def startup():
     LOGS.info("---------------------")
     sys.stdout.flush()
 
+    # One pooled HTTP session for links, thumbnails and Telegraph; closed in main() on shutdown
+    await http_client.start()
+
     owners = [owner_id.strip() for owner_id in OWNER.split()]
     for x in owners:
         if not x: continue
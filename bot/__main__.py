@@ -1,5 +1,6 @@
 import signal
 import sys
+import time
 import asyncio
 import re
 from datetime import datetime as dt
@@ -8,6 +9,7 @@ from telethon import events
 # Import from the correct, specific modules
 from .config import LOGS, BOT_TOKEN, OWNER, MAX_QUEUE_SIZE, GPU_TYPE
 from . import bot, startup
+from .http_client import http_client
 from .funcn import bot_state, uptime, cleanup_temp_files, periodic_cleanup, ts, skip, stats
 from .worker import (
     process_link_download, process_file_encoding, encod, dl_link,
@@ -17,6 +19,10 @@ from .stuff import start, up, help, usage, ihelp, beck
 from .settings_menu import settings_menu
 from .settings_handlers import settings_handlers
 from .settings import settings_manager
+from .result_cache import result_cache
+from .FastTelethon import sender_pool
+from .transfer_stats import transfer_monitor
+from .bandwidth import bandwidth
 
 print("🚀 Starting Enhanced Video Compressor Bot...")  # Immediate output
 LOGS.info("Starting Enhanced Video Compressor Bot...")
@@ -112,15 +118,38 @@ async def _(e):
 @bot.on(events.NewMessage(pattern="/status"))
 async def _(e):
     if not OWNER or str(e.sender_id) not in OWNER.split(): return
+    scheduler = bot_state.scheduler
     status_msg = (
         f"🤖 **Bot Status**\n\n"
-        f"🔧 **Working**: {'Yes' if bot_state.is_working() else 'No'}\n"
+        f"🔧 **Working**: {'Yes' if bot_state.is_working() else 'No'} "
+        f"({scheduler.active_jobs()}/{scheduler.job_slots} jobs)\n"
         f"📋 **Queue Size**: {bot_state.queue_size()}/{MAX_QUEUE_SIZE}\n"
         f"🚀 **GPU Type**: {GPU_TYPE.upper()}\n"
-        f"⏰ **Uptime**: {ts(int((dt.now() - uptime).total_seconds() * 1000))}"
+        f"⏰ **Uptime**: {ts(int((dt.now() - uptime).total_seconds() * 1000))}\n"
+        f"♻️ **Result Cache**: {len(result_cache.entries)} entries\n\n"
+        f"🎛️ **Slots**"
     )
+    now = time.time()
+    for pool in scheduler.pools.values():
+        status_msg += f"\n{pool.title}: {pool.in_use()}/{pool.size}"
+        for label, since in pool.occupants():
+            status_msg += f"\n  • `{label}` ({ts(int((now - since) * 1000))})"
     await e.reply(status_msg)
 
+@bot.on(events.NewMessage(pattern="/purgecache"))
+async def _(e):
+    """Clear the result cache; `/purgecache expired` only drops expired entries"""
+    if not OWNER or str(e.sender_id) not in OWNER.split(): return
+    expired_only = "expired" in e.text.split()[1:]
+    removed = result_cache.purge(expired_only=expired_only)
+    await e.reply(f"♻️ Removed {removed} cached result{'s' if removed != 1 else ''}{' (expired only)' if expired_only else ''}.")
+
+@bot.on(events.NewMessage(pattern="/transfers"))
+async def _(e):
+    """Per-sender throughput of running Telegram transfers and histograms of recent ones"""
+    if not OWNER or str(e.sender_id) not in OWNER.split(): return
+    await e.reply(f"{transfer_monitor.report()}\n\n📶 **Budgets**: {bandwidth.describe()}")
+
 @bot.on(events.NewMessage(pattern="/usage"))
 async def _(e): await usage(e)
 
@@ -263,35 +292,48 @@ async def _(e): await encod(e)
 
 # --- Queue Processor ---
 
+# The loop only keeps weak references to tasks, so running jobs are held here until they finish
+queue_jobs = set()
+
+async def run_queue_item(key, original_event, job_id):
+    """Run one queued job; the job was already registered with the scheduler."""
+    try:
+        if hasattr(original_event, 'text') and original_event.text and original_event.text.startswith('/link'):
+            parts = original_event.text.split(maxsplit=2)
+            if len(parts) < 2:
+                await original_event.reply("❌ Invalid link command in queue. Skipping.")
+                return
+            link = parts[1]
+            name = parts[2] if len(parts) > 2 else ""
+            await process_link_download(original_event, link, name, job_id=job_id)
+        elif hasattr(original_event, 'media'):
+            await process_file_encoding(original_event, job_id=job_id)
+        else:
+            LOGS.warning(f"Unknown item type in queue: {key}. Skipping.")
+    except Exception as err:
+        LOGS.error(f"Queued job '{key}' failed: {err}", exc_info=True)
+    finally:
+        bot_state.scheduler.finish_job(job_id)
+
 async def queue_processor():
+    scheduler = bot_state.scheduler
     while True:
         try:
-            if not bot_state.is_working() and bot_state.queue_size() > 0:
+            # Start as many queued jobs as there are free job slots
+            while scheduler.has_free_job_slot() and bot_state.queue_size() > 0:
                 key, original_event = bot_state.pop_first_queue_item()
                 if not original_event:
-                    await asyncio.sleep(3)
-                    continue
+                    break
                 
                 LOGS.info(f"Processing item '{key}' from queue.")
-
-                if hasattr(original_event, 'text') and original_event.text and original_event.text.startswith('/link'):
-                    parts = original_event.text.split(maxsplit=2)
-                    if len(parts) < 2:
-                        await original_event.reply("❌ Invalid link command in queue. Skipping.")
-                        continue
-                    link = parts[1]
-                    name = parts[2] if len(parts) > 2 else ""
-                    await process_link_download(original_event, link, name)
-                elif hasattr(original_event, 'media'):
-                    await process_file_encoding(original_event)
-                else:
-                    LOGS.warning(f"Unknown item type in queue: {key}. Skipping.")
+                job_id = scheduler.start_job(str(key))
+                task = asyncio.create_task(run_queue_item(key, original_event, job_id))
+                queue_jobs.add(task)
+                task.add_done_callback(queue_jobs.discard)
             
             await asyncio.sleep(3)
         except Exception as err:
             LOGS.error(f"Queue processor error: {err}", exc_info=True)
-            if bot_state.is_working():
-                bot_state.clear_working()
             await asyncio.sleep(5)
 
 # --- Main Execution ---
@@ -302,6 +344,9 @@ async def main():
         queue_task = asyncio.create_task(queue_processor())
         
         await startup()
+        # Budgets set from /settings outlive restarts
+        advanced = settings_manager.get_setting("advanced_settings")
+        bandwidth.configure(advanced.get("bandwidth_upload_mbs"), advanced.get("bandwidth_download_mbs"))
 
         print("🎉 Bot has started successfully and is listening for commands.")  # Immediate output
         LOGS.info("Bot has started successfully and is listening for commands.")
@@ -313,6 +358,8 @@ async def main():
         LOGS.error(f"Bot crashed in main loop: {e}", exc_info=True)
     finally:
         bot_state.clear_working()
+        await sender_pool.close()
+        await http_client.close()
         cleanup_temp_files()
         LOGS.info("Bot shutdown complete.")
 
@@ -0,0 +1,143 @@
+import asyncio
+import heapq
+import itertools
+import time
+from contextvars import ContextVar
+from typing import Dict, List, Optional, Tuple
+
+from .config import LOGS, BANDWIDTH_UPLOAD_MBS, BANDWIDTH_DOWNLOAD_MBS
+
+MB = 1024 * 1024
+DIRECTIONS = ("upload", "download")
+# A full bucket lets this much traffic through at once; never less than one 1 MiB part
+BURST_SECONDS = 0.5
+MIN_BURST = MB
+
+# The job (and its weight) whose transfers are being paced; tasks inherit it from where they were created
+_current_job: ContextVar[Tuple[str, float]] = ContextVar("bandwidth_job", default=("bot", 1.0))
+
+
+class Budget:
+    """
+    Token bucket for one direction. While traffic has to wait, requests are released in
+    weighted fair order: each job's requests are tagged with a virtual finish time that
+    grows by size / weight, so a job with weight 2 gets twice the bytes of a job with
+    weight 1 and a job that just started isn't stuck behind another one's backlog.
+    """
+
+    def __init__(self, direction: str, rate: float = 0) -> None:
+        self.direction = direction
+        self.rate = 0.0
+        self.burst = 0.0
+        self.tokens = 0.0
+        self.updated = time.monotonic()
+        self.virtual = 0.0
+        self.finish: Dict[str, float] = {}  # job -> virtual finish time of its last request
+        self.waiting: List[Tuple[float, int, int, asyncio.Future]] = []
+        self.sequence = itertools.count()
+        self.dispatcher: Optional[asyncio.Task] = None
+        self.set_rate(rate)
+
+    def set_rate(self, rate: float) -> None:
+        """Bytes per second; 0 lifts the limit."""
+        self.rate = max(0.0, rate)
+        self.burst = max(self.rate * BURST_SECONDS, MIN_BURST)
+        self.tokens = min(self.tokens, self.burst) if self.rate else self.burst
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    async def acquire(self, size: int) -> None:
+        if not self.rate:
+            return
+        job, weight = _current_job.get()
+        tag = max(self.virtual, self.finish.get(job, 0.0)) + size / weight
+        self.finish[job] = tag
+        self._refill()
+        # Anything bigger than the bucket goes through on a full one and leaves it in debt
+        if not self.waiting and self.tokens >= min(size, self.burst):
+            self.tokens -= size
+            self.virtual = tag
+            return
+        future = asyncio.get_running_loop().create_future()
+        heapq.heappush(self.waiting, (tag, next(self.sequence), size, future))
+        if self.dispatcher is None or self.dispatcher.done():
+            self.dispatcher = asyncio.ensure_future(self._dispatch())
+        await future
+
+    async def _dispatch(self) -> None:
+        while self.waiting:
+            tag, _, size, future = self.waiting[0]
+            if future.done():  # the transfer was cancelled while it waited
+                heapq.heappop(self.waiting)
+                continue
+            self._refill()
+            needed = min(size, self.burst)
+            if not self.rate or self.tokens >= needed:
+                heapq.heappop(self.waiting)
+                self.tokens -= size
+                self.virtual = tag
+                future.set_result(None)
+                continue
+            await asyncio.sleep((needed - self.tokens) / self.rate)
+
+    def forget(self, job: str) -> None:
+        self.finish.pop(job, None)
+
+
+class BandwidthScheduler:
+    """
+    Process-wide upload and download budgets that every transfer draws from: Telegram
+    parts in FastTelethon, /link downloads and thumbnail fetches. Capping the total a
+    little below the link keeps room for the bot's own traffic (progress edits, menu
+    callbacks). Jobs share a budget in proportion to their weight.
+    """
+
+    def __init__(self, upload_mbs: float = BANDWIDTH_UPLOAD_MBS, download_mbs: float = BANDWIDTH_DOWNLOAD_MBS) -> None:
+        self.budgets = {direction: Budget(direction) for direction in DIRECTIONS}
+        self.configure(upload_mbs, download_mbs)
+
+    def configure(self, upload_mbs: Optional[float] = None, download_mbs: Optional[float] = None) -> None:
+        """Set the budgets in MB/s; 0 means unlimited, None leaves a budget as it is."""
+        for direction, mbs in (("upload", upload_mbs), ("download", download_mbs)):
+            if mbs is not None:
+                self.budgets[direction].set_rate(float(mbs) * MB)
+        LOGS.info(f"Bandwidth budgets: {self.describe()}")
+
+    def limit(self, direction: str) -> float:
+        """The budget for direction in MB/s (0 when unlimited)"""
+        return self.budgets[direction].rate / MB
+
+    def describe(self) -> str:
+        return " · ".join(
+            f"{'⬆️' if direction == 'upload' else '⬇️'} "
+            + (f"{self.limit(direction):g} MB/s" if self.limit(direction) else "unlimited")
+            for direction in DIRECTIONS
+        )
+
+    async def acquire(self, direction: str, size: int) -> None:
+        """Wait until size bytes may be sent or received for the current job."""
+        await self.budgets[direction].acquire(size)
+
+    def start_job(self, name: str, weight: float = 1.0):
+        """
+        Attribute the transfers of the current task, and of the tasks it spawns from now
+        on, to one weighted job. Returns a token for finish_job().
+        """
+        return _current_job.set((name, max(0.1, float(weight))))
+
+    def current_job(self) -> str:
+        """Name of the job the current task's transfers belong to ("bot" outside any job)"""
+        return _current_job.get()[0]
+
+    def finish_job(self, token) -> None:
+        name = _current_job.get()[0]
+        _current_job.reset(token)
+        for budget in self.budgets.values():
+            budget.forget(name)
+
+
+# Global bandwidth scheduler instance
+bandwidth = BandwidthScheduler()
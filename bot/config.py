@@ -57,6 +57,27 @@ def detect_gpu():
 
 GPU_TYPE = detect_gpu()
 
+# --- JOB SCHEDULING ---
+# JOB_SLOTS=1 keeps the classic one-job-at-a-time behaviour. Stage slots cap how many
+# jobs may download, encode or upload at once; ENCODE_SLOTS=0 sizes CPU encodes from
+# the core count and NVENC encodes are bounded by the driver's session limit.
+JOB_SLOTS = config("JOB_SLOTS", default=1, cast=int)
+DOWNLOAD_SLOTS = config("DOWNLOAD_SLOTS", default=2, cast=int)
+UPLOAD_SLOTS = config("UPLOAD_SLOTS", default=2, cast=int)
+ENCODE_SLOTS = config("ENCODE_SLOTS", default=0, cast=int)
+NVENC_SESSION_LIMIT = config("NVENC_SESSION_LIMIT", default=3, cast=int)
+
+# --- RESULT CACHE ---
+# Re-sends an already uploaded output when the same source arrives with the same settings
+# Outputs stay on Telegram, so the entry count (not output size) is what bounds the local index
+RESULT_CACHE_TTL_DAYS = config("RESULT_CACHE_TTL_DAYS", default=30, cast=int)
+RESULT_CACHE_MAX_ENTRIES = config("RESULT_CACHE_MAX_ENTRIES", default=2000, cast=int)
+
+# --- THUMBNAIL CACHE ---
+# Custom thumbnail URLs are kept on disk, resized; a fresh one is reused without asking the server
+THUMB_CACHE_MAX_ENTRIES = config("THUMB_CACHE_MAX_ENTRIES", default=50, cast=int)
+THUMB_CACHE_FRESH_MINUTES = config("THUMB_CACHE_FRESH_MINUTES", default=10, cast=int)
+
 # --- ENCODING PARAMETERS ---
 V_CODEC = config("V_CODEC", default="h264_nvenc" if GPU_TYPE == "nvidia" else "libx264")
 V_PRESET = config("V_PRESET", default="p3")
@@ -74,6 +95,13 @@ WATERMARK_POSITION = config("WATERMARK_POSITION", default="bottom-right")
 
 # --- UPLOAD SETTINGS ---
 UPLOAD_CONNECTIONS = config("UPLOAD_CONNECTIONS", default=5, cast=int)
+# Idle Telegram transfer connections stay open this long for the next download or upload
+SENDER_IDLE_TTL = config("SENDER_IDLE_TTL", default=300, cast=int)
+# Process-wide transfer budgets in MB/s shared by every job (0 = unlimited); also set in /settings
+BANDWIDTH_UPLOAD_MBS = config("BANDWIDTH_UPLOAD_MBS", default=0, cast=float)
+BANDWIDTH_DOWNLOAD_MBS = config("BANDWIDTH_DOWNLOAD_MBS", default=0, cast=float)
+# Parallel HTTP Range connections per /link download (1 = a single stream)
+LINK_CONNECTIONS = config("LINK_CONNECTIONS", default=8, cast=int)
 DEFAULT_UPLOAD_MODE = config("DEFAULT_UPLOAD_MODE", default="Document")
 
 # --- PREVIEW & SCREENSHOTS ---
@@ -0,0 +1,115 @@
+import asyncio
+import os
+import queue
+import threading
+from typing import Callable, Optional
+
+from .config import LOGS
+
+# Bytes handed to the writer thread but not yet on disk; past this, producers wait
+WRITE_BUFFER = 32 * 1024 * 1024
+
+
+def pwrite_all(fd: int, data: bytes, offset: int) -> None:
+    view = memoryview(data)
+    while view:
+        count = os.pwrite(fd, view, offset)
+        view = view[count:]
+        offset += count
+
+
+def preallocate(fd: int, size: int) -> None:
+    """
+    Reserve size bytes for fd so out-of-order writes never extend the file and the
+    filesystem can lay it out in one piece. Filesystems without fallocate (FUSE mounts
+    such as Google Drive) just get a file of the right length.
+    """
+    if hasattr(os, "posix_fallocate"):
+        try:
+            os.posix_fallocate(fd, 0, size)
+        except OSError as e:
+            LOGS.debug(f"posix_fallocate unavailable ({e}); truncating instead")
+    os.ftruncate(fd, size)
+
+
+class DiskWriter:
+    """
+    Writes chunks at their offsets in fd from one background thread, so a slow disk
+    never blocks the event loop. write() returns as soon as the chunk is queued and
+    only waits when more than max_pending bytes are still in flight. done callbacks
+    run on the event loop once their chunk is written, in the order written. close()
+    drains the queue and fsyncs once; a write error is raised by the next write() or
+    by close().
+    """
+
+    def __init__(self, fd: int, size: Optional[int] = None, label: str = "file",
+                 max_pending: int = WRITE_BUFFER, sync: bool = True):
+        self.fd = fd
+        self.label = label
+        self.max_pending = max_pending
+        self.sync = sync
+        self.pending = 0
+        self.error: Optional[BaseException] = None
+        self.loop = asyncio.get_running_loop()
+        self._room = asyncio.Event()
+        self._room.set()
+        self._queue: "queue.SimpleQueue" = queue.SimpleQueue()
+        self._finished = self.loop.create_future()
+        self._closing = False
+        if size:
+            preallocate(fd, size)
+        self._thread = threading.Thread(target=self._run, name=f"writer-{os.path.basename(label)}", daemon=True)
+        self._thread.start()
+
+    def _run(self) -> None:
+        while True:
+            item = self._queue.get()
+            if item is None:
+                break
+            offset, data, done = item
+            if self.error is None:
+                try:
+                    pwrite_all(self.fd, data, offset)
+                except BaseException as e:
+                    self.error = e
+                    done = None
+            self.loop.call_soon_threadsafe(self._written, len(data), done)
+        error = None
+        if self.sync and self.error is None:
+            try:
+                os.fsync(self.fd)
+            except OSError as e:
+                error = e
+        self.loop.call_soon_threadsafe(self._finish, error)
+
+    def _written(self, size: int, done: Optional[Callable[[], None]]) -> None:
+        self.pending -= size
+        if done is not None:
+            done()
+        if self.pending < self.max_pending or self.error is not None:
+            self._room.set()
+
+    def _finish(self, error: Optional[BaseException]) -> None:
+        if not self._finished.done():
+            self._finished.set_result(error)
+
+    async def write(self, offset: int, data: bytes, done: Optional[Callable[[], None]] = None) -> None:
+        """Queue data for offset, waiting first while the writer is too far behind."""
+        while self.pending >= self.max_pending and self.error is None:
+            self._room.clear()
+            await self._room.wait()
+        if self.error is not None:
+            raise self.error
+        self.pending += len(data)
+        self._queue.put((offset, data, done))
+
+    async def close(self) -> None:
+        """Wait for every queued chunk, fsync once, and raise the first write error."""
+        if not self._closing:
+            self._closing = True
+            self._queue.put(None)
+        error = await asyncio.shield(self._finished)
+        if self.error is not None:
+            raise self.error
+        if error is not None:
+            raise error
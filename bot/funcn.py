@@ -1,36 +1,133 @@
 import asyncio
+import inspect
+import itertools
+import json
 import threading
 import time
 import math
 import os
-import re
+import shutil
 from pathlib import Path
 from collections import OrderedDict
+from contextlib import asynccontextmanager
 from datetime import datetime as dt
 import psutil
-import aiohttp
-import pymediainfo
 from telethon import errors, Button
 from html_telegraph_poster import TelegraphPoster
 
 # Import explicitly from config module
 from .config import (
     LOGS, MAX_QUEUE_SIZE, IS_COLAB, COLAB_OUTPUT_DIR, GPU_TYPE,
-    MAX_FILE_SIZE, PROGRESS_UPDATE_INTERVAL, DEFAULT_UPLOAD_MODE
+    MAX_FILE_SIZE, PROGRESS_UPDATE_INTERVAL, DEFAULT_UPLOAD_MODE,
+    JOB_SLOTS, DOWNLOAD_SLOTS, UPLOAD_SLOTS, ENCODE_SLOTS, NVENC_SESSION_LIMIT
 )
+from .http_client import http_client
+from .media_probe import probe_cache
+
+# CPU cores one libx264/libx265 encode can keep busy when ENCODE_SLOTS is auto
+CORES_PER_ENCODE = 8
+
+class SlotPool:
+    """A fixed number of slots for one pipeline stage; `async with pool.slot(label)` waits for a free one."""
+    def __init__(self, title, size):
+        self.title = title
+        self.size = max(1, size)
+        self._slots = [None] * self.size
+        self._semaphore = asyncio.Semaphore(self.size)
+
+    async def acquire(self, label):
+        """Wait for a free slot and return a callable that frees it; calls after the first do nothing."""
+        await self._semaphore.acquire()
+        index = self._slots.index(None)
+        self._slots[index] = (label, time.time())
+        released = False
+
+        def release():
+            nonlocal released
+            if not released:
+                released = True
+                self._slots[index] = None
+                self._semaphore.release()
+        return release
+
+    @asynccontextmanager
+    async def slot(self, label):
+        release = await self.acquire(label)
+        try:
+            yield
+        finally:
+            release()
+
+    def in_use(self): return sum(1 for s in self._slots if s)
+    def occupants(self): return [s for s in self._slots if s]
+
+class JobScheduler:
+    """Tracks running jobs and the per-stage slots they compete for."""
+    def __init__(self):
+        self.job_slots = max(1, JOB_SLOTS)
+        self._jobs = {}  # job id -> label
+        self._dirs = {}  # job directory -> id of the running job that owns it
+        self._job_ids = itertools.count(1)
+        cpu_encodes = ENCODE_SLOTS or max(1, (os.cpu_count() or 1) // CORES_PER_ENCODE)
+        self.pools = {
+            "download": SlotPool("📥 Download", DOWNLOAD_SLOTS),
+            "encode": SlotPool("🔄 Encode (CPU)", cpu_encodes),
+            "upload": SlotPool("📤 Upload", UPLOAD_SLOTS),
+        }
+        if GPU_TYPE == "nvidia":
+            self.pools["nvenc"] = SlotPool("🚀 Encode (NVENC)", NVENC_SESSION_LIMIT)
+
+    def start_job(self, label):
+        job_id = next(self._job_ids)
+        self._jobs[job_id] = label
+        return job_id
+
+    def finish_job(self, job_id):
+        self._jobs.pop(job_id, None)
+        self._dirs = {path: owner for path, owner in self._dirs.items() if owner != job_id}
+
+    def clear_jobs(self):
+        self._jobs.clear()
+        self._dirs.clear()
+
+    def job_dir(self, root, key, job_id):
+        """
+        root/key for the job's files, so a restarted job of the same source finds what it
+        left behind; while another running job holds that directory, root/key-<job id>.
+        """
+        path = os.path.join(root, str(key))
+        if self._dirs.get(path, job_id) != job_id:
+            path = f"{path}-{job_id}"
+        self._dirs[path] = job_id
+        os.makedirs(path, exist_ok=True)
+        return path
+
+    def active_dirs(self): return set(self._dirs)
+
+    def active_jobs(self): return len(self._jobs)
+    def has_free_job_slot(self): return len(self._jobs) < self.job_slots
+
+    def encode_pool(self, v_codec):
+        return "nvenc" if '_nvenc' in v_codec and "nvenc" in self.pools else "encode"
+
+    def slot(self, pool, label):
+        return self.pools[pool].slot(label)
+
+    async def acquire(self, pool, label):
+        return await self.pools[pool].acquire(label)
 
 class BotState:
     """State management for the bot."""
     def __init__(self):
-        self._is_working = False
+        self.scheduler = JobScheduler()
         self._queue = OrderedDict()
         self._ok = {}  # For callback data
         self.last_progress_update = {}
         self.user_upload_modes = {}
+        self._processes = {}  # dl path -> ffmpeg processes that can't be found by their cmdline
     
-    def is_working(self): return self._is_working
-    def set_working(self, value=True): self._is_working = value
-    def clear_working(self): self._is_working = False
+    def is_working(self): return self.scheduler.active_jobs() > 0
+    def clear_working(self): self.scheduler.clear_jobs()
     
     def add_to_queue(self, key, value):
         with threading.Lock():
@@ -56,6 +153,19 @@ class BotState:
     def get_ok(self, key):
         return self._ok.get(str(key))
 
+    def register_process(self, key, process):
+        self._processes.setdefault(key, set()).add(process)
+
+    def unregister_process(self, key, process):
+        processes = self._processes.get(key)
+        if processes:
+            processes.discard(process)
+            if not processes:
+                del self._processes[key]
+
+    def get_processes(self, key):
+        return list(self._processes.get(key, ()))
+
     def set_upload_mode(self, user_id, mode):
         self.user_upload_modes[user_id] = mode
 
@@ -84,6 +194,10 @@ def validate_file_path(file_path):
     except Exception:
         return False
 
+def job_temp_dir(dl):
+    """Per-job scratch directory under temp/, derived from the job directory and name of the downloaded file."""
+    return os.path.join("temp", Path(dl).parent.name, Path(dl).stem)
+
 def ts(milliseconds: int) -> str:
     seconds, _ = divmod(int(milliseconds), 1000)
     minutes, seconds = divmod(seconds, 60)
@@ -106,6 +220,25 @@ def hbs(size):
         n += 1
     return f"{size:.2f} {power_labels[n]}"
 
+def report_progress(callback, *args, pending=None):
+    """
+    Call a progress callback without waiting for it, skipping the call while the previous
+    report is still running: a progress edit can sleep on FloodWait and must never hold
+    up a transfer. Returns the report in flight, to pass back as pending next time.
+    """
+    if callback is None or (pending is not None and not pending.done()):
+        return pending
+    result = callback(*args)
+    return asyncio.ensure_future(result) if inspect.isawaitable(result) else None
+
+async def finish_progress(pending):
+    """Wait for the last report from report_progress; a failed report doesn't fail the transfer."""
+    if pending is not None:
+        try:
+            await pending
+        except (Exception, asyncio.CancelledError):
+            pass
+
 async def progress(current, total, event, start, type_of_ps, file=None):
     message_id = event.id
     now = time.time()
@@ -143,14 +276,59 @@ async def progress(current, total, event, start, type_of_ps, file=None):
     except Exception as e:
         LOGS.error(f"Progress bar error: {e}")
 
+def parse_ffmpeg_progress(stats):
+    """Numbers out of one FFmpeg `-progress` block: (out_time seconds, fps, speed factor, total_size bytes)."""
+    def number(value):
+        try:
+            return float(str(value).rstrip("x"))
+        except (TypeError, ValueError):  # "N/A" until FFmpeg knows better
+            return 0.0
+    out_time_us = stats.get("out_time_us", stats.get("out_time_ms"))
+    return number(out_time_us) / 1_000_000, number(stats.get("fps")), number(stats.get("speed")), int(number(stats.get("total_size")))
+
+async def encode_progress(out_time, fps, speed, total_size, duration, event, header, buttons=None, done=False):
+    """Like progress(), but measured in encoded seconds of the source instead of bytes."""
+    message_id = event.id
+    now = time.time()
+
+    if message_id in bot_state.last_progress_update and (now - bot_state.last_progress_update[message_id]) < PROGRESS_UPDATE_INTERVAL:
+        if not done: return
+
+    bot_state.last_progress_update[message_id] = now
+
+    lines = [header, ""]
+    if duration:
+        percentage = min(out_time * 100 / duration, 100)
+        progress_bar = "●" * math.floor(percentage / 10) + "○" * (10 - math.floor(percentage / 10))
+        lines.append(f"`[{progress_bar}] {percentage:.2f}%`")
+        lines.append(f"`{ts(out_time * 1000)} of {ts(duration * 1000)}`")
+    else:
+        lines.append(f"`Encoded: {ts(out_time * 1000)}`")
+    lines.append(f"`FPS: {fps:.1f} | Speed: {speed:.2f}x`")
+    if total_size:
+        lines.append(f"`Size: {hbs(total_size)}`")
+    if duration and speed > 0:
+        lines.append(f"`ETA: {ts(max(duration - out_time, 0) / speed * 1000)}`")
+
+    try:
+        await event.edit("\n".join(lines), buttons=buttons)
+    except (errors.MessageNotModifiedError, errors.MessageIdInvalidError):
+        pass
+    except errors.FloodWaitError as e:
+        await asyncio.sleep(e.seconds + 2)
+    except Exception as e:
+        LOGS.error(f"Encode progress error: {e}")
+
 async def info(file_path):
+    """Mediainfo HTML for Telegraph, from the probe the job's other stages already made"""
     try:
         if not validate_file_path(file_path):
             LOGS.warning(f"Skipping mediainfo for invalid path: {file_path}")
             return None
-        return pymediainfo.MediaInfo.parse(file_path, output="HTML", full=False)
+        probe = await probe_cache.get(file_path)
+        return probe.html() if probe else None
     except Exception as e:
-        LOGS.error(f"Pymediainfo failed for {file_path}: {e}")
+        LOGS.error(f"Mediainfo failed for {file_path}: {e}")
         return None
 
 def code(data):
@@ -166,18 +344,25 @@ async def skip(e):
         if not wh: return await e.answer("Process already cancelled or finished.", alert=True)
         
         out, dl, _ = wh.split(";")
-        bot_state.clear_working()
         await e.edit("`⛔ Process cancelled by user.`", buttons=None)
         
+        work_dir = job_temp_dir(dl)
         for proc in psutil.process_iter(['pid', 'name', 'cmdline']):
-            if proc.info['name'] == "ffmpeg" and dl in ' '.join(proc.info.get('cmdline', [])):
+            cmdline = ' '.join(proc.info.get('cmdline') or [])
+            if proc.info['name'] == "ffmpeg" and (dl in cmdline or work_dir in cmdline):
                 LOGS.info(f"Terminating ffmpeg process {proc.pid} for {dl}")
                 proc.terminate()
+        # Streamed encodes read from stdin, so their cmdline doesn't mention dl
+        for proc in bot_state.get_processes(dl):
+            try: proc.terminate()
+            except ProcessLookupError: pass
         
         for f in [dl, out]:
             if f and os.path.exists(f) and validate_file_path(f):
                 try: os.remove(f)
                 except OSError as ex: LOGS.error(f"Error removing file {f} on skip: {ex}")
+        if os.path.isdir(work_dir) and validate_file_path(work_dir):
+            shutil.rmtree(work_dir, ignore_errors=True)
     except Exception as ex:
         LOGS.error(f"Error in skip function: {ex}", exc_info=True)
         await e.answer(f"Error cancelling: {ex}", alert=True)
@@ -208,58 +393,111 @@ async def stats(e):
         LOGS.error(f"Error getting stats: {ex}", exc_info=True)
         await e.answer(f"Error getting stats: {ex}", alert=True)
 
-async def fast_download(e, download_url, filename=None):
-    headers = {'User-Agent': 'Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/91.0.4472.124 Safari/537.36'}
+async def fast_download(e, download_url, filename=None, directory="downloads"):
     start_time = time.time()
 
     # Get dynamic file size limit from user settings
     from .settings import settings_manager
+    from .link_download import probe_link, download_link
     user_id = e.sender_id if hasattr(e, 'sender_id') else None
     output_settings = settings_manager.get_setting("output_settings", user_id=user_id)
     max_file_size = output_settings.get("max_file_size", MAX_FILE_SIZE)
 
-    async with aiohttp.ClientSession(headers=headers) as session:
-        async with session.get(download_url, timeout=None, allow_redirects=True) as response:
-            if response.status != 200:
-                raise Exception(f"Download failed: Status {response.status}")
-
-            total_size = int(response.headers.get("content-length", 0))
-            if total_size and total_size > max_file_size * 1024 * 1024:
-                raise ValueError(f"File too large: {hbs(total_size)} > {max_file_size}MB")
-
-            if not filename:
-                content_disposition = response.headers.get('Content-Disposition')
-                if content_disposition and (res := re.findall("filename=\"?(.+)\"?", content_disposition)):
-                    filename = res[0]
-                else:
-                    filename = os.path.basename(download_url.split('?')[0])
-
-            filepath = os.path.join("downloads", "".join(c for c in filename if c.isalnum() or c in "._- "))
-            if not validate_file_path(filepath):
-                raise ValueError("Invalid download path detected")
-            
-            downloaded_size = 0
-            with open(filepath, "wb") as f:
-                async for chunk in response.content.iter_chunked(1024 * 1024):
-                    f.write(chunk)
-                    downloaded_size += len(chunk)
-                    if total_size:
-                       await progress(downloaded_size, total_size, e, start_time, "Downloading Link", filename)
-            return filepath
+    session = http_client.session
+    link = await probe_link(session, download_url)
+    if link.size and link.size > max_file_size * 1024 * 1024:
+        raise ValueError(f"File too large: {hbs(link.size)} > {max_file_size}MB")
+
+    if not filename:
+        filename = link.filename or os.path.basename(download_url.split('?')[0])
+
+    filepath = os.path.join(directory, "".join(c for c in filename if c.isalnum() or c in "._- "))
+    if not validate_file_path(filepath):
+        raise ValueError("Invalid download path detected")
+
+    await download_link(
+        session, link, filepath,
+        progress_callback=lambda done, total: progress(done, total, e, start_time, "Downloading Link", filename)
+    )
+    return filepath
+
+def _remove(path, reason):
+    try:
+        os.remove(path)
+        LOGS.info(f"Deleting {reason}: {path}")
+    except FileNotFoundError:
+        pass
+    except OSError as e:
+        LOGS.warning(f"Failed to cleanup {path}: {e}")
+
+def sweep_resume_state():
+    """
+    Drop what interrupted transfers left behind once it can no longer be resumed:
+    outputs whose upload state has expired (Telegram has dropped their parts), partial
+    downloads whose sidecar hasn't changed for PARTS_TTL, and sidecars of files that
+    are gone.
+    """
+    from .FastTelethon import PARTS_SUFFIX, PARTS_TTL, UPLOAD_STATE_SUFFIX, UPLOAD_STATE_TTL
+    now = time.time()
+    for directory in ["downloads/", "encode/"]:
+        if not os.path.isdir(directory): continue
+        for state_path in Path(directory).rglob(f"*{UPLOAD_STATE_SUFFIX}"):
+            path = str(state_path)[:-len(UPLOAD_STATE_SUFFIX)]
+            try:
+                with open(state_path) as f:
+                    started = json.load(f).get("extra", {}).get("started", 0)
+            except (OSError, ValueError, AttributeError):
+                started = 0
+            if not os.path.exists(path) or now - started > UPLOAD_STATE_TTL:
+                _remove(path, "expired pending upload")
+                _remove(str(state_path), "upload state")
+        for parts_path in Path(directory).rglob(f"*{PARTS_SUFFIX}"):
+            path = str(parts_path)[:-len(PARTS_SUFFIX)]
+            try:
+                stale = now - parts_path.stat().st_mtime > PARTS_TTL
+            except OSError:
+                continue
+            if not os.path.exists(path) or stale:
+                _remove(path, "stale partial download")
+                _remove(str(parts_path), "resume bitmap")
 
 def cleanup_temp_files():
-    """Clean up temporary files older than 1 hour"""
+    """
+    Clean up temporary files older than 1 hour. Files an interrupted transfer can still
+    resume (a live upload state or a resume bitmap next to them) are left to
+    sweep_resume_state, which drops them once they expire. Empty job directories of
+    finished jobs are removed.
+    """
+    from .FastTelethon import PARTS_SUFFIX, UPLOAD_STATE_SUFFIX
     LOGS.info("Running periodic cleanup of temporary files...")
+    sweep_resume_state()
     now = time.time()
     for directory in ["downloads/", "encode/", "temp/"]:
         if not os.path.isdir(directory): continue
-        for file_path in Path(directory).glob("*"):
+        # Downloads and outputs sit in a directory per job
+        files = Path(directory).glob("*") if directory == "temp/" else Path(directory).rglob("*")
+        for file_path in files:
             try:
+                path = str(file_path)
+                if path.endswith((PARTS_SUFFIX, UPLOAD_STATE_SUFFIX)):
+                    continue
+                if os.path.exists(f"{path}{PARTS_SUFFIX}") or os.path.exists(f"{path}{UPLOAD_STATE_SUFFIX}"):
+                    continue
                 if file_path.is_file() and (now - file_path.stat().st_mtime > 3600):
                     LOGS.info(f"Deleting old temp file: {file_path}")
                     file_path.unlink()
             except (OSError, FileNotFoundError) as e:
                 LOGS.warning(f"Failed to cleanup old file {file_path}: {e}")
+    # A running job's directories under encode/ and temp/ are named like its download directory
+    active = {Path(path).name for path in bot_state.scheduler.active_dirs()}
+    for directory in ["downloads/", "encode/", "temp/"]:
+        if not os.path.isdir(directory): continue
+        for job_dir in Path(directory).glob("*"):
+            if job_dir.is_dir() and job_dir.name not in active and not any(job_dir.iterdir()):
+                try:
+                    job_dir.rmdir()
+                except OSError as e:
+                    LOGS.warning(f"Failed to remove empty job directory {job_dir}: {e}")
 
 async def periodic_cleanup():
     while True:
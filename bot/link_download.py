@@ -0,0 +1,292 @@
+import asyncio
+import os
+import re
+from typing import Callable, Optional
+from urllib.parse import unquote
+
+import aiohttp
+
+from .config import LOGS, LINK_CONNECTIONS
+from .bandwidth import bandwidth
+from .disk_writer import DiskWriter
+from .funcn import report_progress, finish_progress
+from .FastTelethon import PartBitmap, PARTS_SUFFIX, RESUME_ATTEMPTS, RESUME_BACKOFF
+
+# Ranges are handed out in pieces of this size, so a slow connection just ends up with fewer of them
+SEGMENT_SIZE = 8 * 1024 * 1024
+# Below this a single connection is as fast as several
+MIN_SEGMENTED_SIZE = 2 * SEGMENT_SIZE
+CHUNK_SIZE = 1024 * 1024
+SEGMENT_ATTEMPTS = 4
+SEGMENT_RETRY_BACKOFF = 2
+# A connection that sends nothing for this long is dropped (and its range retried)
+READ_TIMEOUT = 60
+
+_content_range = re.compile(r"bytes (\d+)-(\d+)/(\d+|\*)")
+
+
+class LinkChanged(Exception):
+    """The file behind a link changed while part of it was already downloaded"""
+
+
+class LinkInfo:
+    """What a HEAD (or one-byte range probe) says about a URL before it is downloaded"""
+
+    def __init__(self, source: str, url: str, size: Optional[int], ranges: bool, filename: Optional[str],
+                 etag: Optional[str] = None, last_modified: Optional[str] = None):
+        self.source = source  # the link as given
+        self.url = url  # after redirects, so segment requests don't repeat them
+        self.size = size
+        self.ranges = ranges
+        self.filename = filename
+        self.etag = etag
+        self.last_modified = last_modified
+
+    @property
+    def validator(self) -> Optional[str]:
+        """What proves a partial file is still the same file: a strong ETag, else Last-Modified"""
+        if self.etag and not self.etag.startswith("W/"):
+            return self.etag
+        return self.last_modified
+
+
+def _filename(headers) -> Optional[str]:
+    disposition = headers.get("Content-Disposition")
+    if not disposition:
+        return None
+    if match := re.search(r"filename\*=(?:UTF-8'')?\"?([^\";]+)\"?", disposition, re.IGNORECASE):
+        return unquote(match.group(1))
+    if match := re.search(r"filename=\"?([^\";]+)\"?", disposition):
+        return match.group(1)
+    return None
+
+
+async def probe_link(session: aiohttp.ClientSession, url: str) -> LinkInfo:
+    """
+    Size, Range support, file name and validators of url. HEAD is tried first; servers
+    that refuse it or don't advertise ranges get a GET for the first byte, which a
+    range-capable server answers with 206 and the full length in Content-Range.
+    """
+    source = url
+    size, ranges, filename, headers = None, False, None, {}
+    try:
+        async with session.head(url, allow_redirects=True) as response:
+            if response.status < 400:
+                url = str(response.url)
+                headers = response.headers
+                filename = _filename(headers)
+                if "Content-Length" in headers and "Content-Encoding" not in headers:
+                    size = int(headers["Content-Length"])
+                ranges = headers.get("Accept-Ranges", "").lower() == "bytes"
+    except aiohttp.ClientError as e:
+        LOGS.info(f"HEAD {url} failed ({e}); probing with a range request")
+    if ranges and size:
+        return LinkInfo(source, url, size, True, filename, headers.get("ETag"), headers.get("Last-Modified"))
+
+    async with session.get(url, headers={"Range": "bytes=0-0"}, allow_redirects=True) as response:
+        if response.status >= 400:
+            raise Exception(f"Download failed: Status {response.status}")
+        url = str(response.url)
+        headers = response.headers
+        filename = filename or _filename(headers)
+        etag, last_modified = headers.get("ETag"), headers.get("Last-Modified")
+        match = _content_range.match(headers.get("Content-Range", ""))
+        if response.status == 206 and match and match.group(3) != "*":
+            return LinkInfo(source, url, int(match.group(3)), True, filename, etag, last_modified)
+        # 200: the server ignored the range and would send everything
+        if "Content-Length" in headers and "Content-Encoding" not in headers:
+            size = int(headers["Content-Length"])
+    return LinkInfo(source, url, size, False, filename, etag, last_modified)
+
+
+class LinkDownloader:
+    """
+    Downloads a probed link into path; all writes go through a DiskWriter thread. With
+    Range support the file is preallocated and LINK_CONNECTIONS connections each fetch
+    the next missing SEGMENT_SIZE range and write it at its offset; a range counts as
+    finished once it is on disk. A failed range goes back for another try, continuing from
+    the last byte it wrote. Finished ranges, and how far unfinished ones got, are
+    recorded in `path.parts` under the link's validator, so a later run asks only for
+    the bytes that are missing. Every range request carries If-Range: a file that
+    changed on the server comes back whole instead, which raises LinkChanged. Without
+    Range support the body is streamed over one connection. Either way the result must
+    match the expected length.
+    """
+
+    def __init__(self, session: aiohttp.ClientSession, link: LinkInfo, path: str,
+                 connections: int = LINK_CONNECTIONS,
+                 progress_callback: Optional[Callable[[int, int], object]] = None):
+        self.session = session
+        self.link = link
+        self.path = path
+        self.connections = max(1, connections)
+        self.progress_callback = progress_callback
+        self.downloaded = 0
+        self._reporting: Optional[asyncio.Future] = None
+
+    def _progress(self, count: int) -> None:
+        self.downloaded += count
+        if self.link.size:
+            self._reporting = report_progress(self.progress_callback, self.downloaded, self.link.size,
+                                              pending=self._reporting)
+
+    def load_parts(self) -> PartBitmap:
+        """
+        The ranges an earlier run of the same link left on disk. Nothing carries over when
+        the link has no validator, or its validator or size no longer match the sidecar.
+        """
+        size = self.link.size
+        if not self.link.validator:
+            return PartBitmap(None, "", size, SEGMENT_SIZE)
+        key = f"{self.link.source}|{self.link.validator}"
+        parts = PartBitmap.load(f"{self.path}{PARTS_SUFFIX}", key, size, SEGMENT_SIZE)
+        if not os.path.exists(self.path) or os.path.getsize(self.path) != size:
+            parts = PartBitmap(parts.path, key, size, SEGMENT_SIZE)
+        return parts
+
+    async def run(self) -> int:
+        """Download and verify; returns the number of bytes on disk."""
+        size = self.link.size
+        try:
+            if self.link.ranges and size:
+                await self._segmented(size)
+            else:
+                await self._single()
+        finally:
+            await finish_progress(self._reporting)
+        actual = os.path.getsize(self.path)
+        if (size is not None and actual != size) or actual != self.downloaded:
+            raise Exception(f"Download incomplete: got {actual} bytes, expected {size or self.downloaded}")
+        return actual
+
+    async def _single(self) -> None:
+        timeout = aiohttp.ClientTimeout(total=None, sock_read=READ_TIMEOUT)
+        async with self.session.get(self.link.url, timeout=timeout) as response:
+            if response.status != 200:
+                raise Exception(f"Download failed: Status {response.status}")
+            fd = os.open(self.path, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+            try:
+                writer = DiskWriter(fd, self.link.size, self.path)
+                try:
+                    async for chunk in response.content.iter_chunked(CHUNK_SIZE):
+                        await bandwidth.acquire("download", len(chunk))
+                        await writer.write(self.downloaded, chunk)
+                        self._progress(len(chunk))
+                finally:
+                    await writer.close()
+                # A server that sent less than it announced leaves the preallocated tail behind
+                if self.link.size and self.downloaded < self.link.size:
+                    os.ftruncate(fd, self.downloaded)
+            finally:
+                os.close(fd)
+
+    async def _segmented(self, size: int) -> None:
+        parts = self.load_parts()
+        # Bytes already written at the start of each unfinished range
+        partial = parts.extra.setdefault("partial", {})
+        resumed = parts.completed_bytes() + sum(partial.values())
+        if resumed:
+            LOGS.info(f"Resuming {self.path}: {resumed} of {size} bytes already on disk")
+        self.downloaded = resumed
+        pending = iter(parts.missing())
+        retry = []
+        attempts = {}
+        fd = os.open(self.path, os.O_RDWR | os.O_CREAT | (0 if resumed else os.O_TRUNC), 0o644)
+
+        async def fetch(index: int) -> None:
+            start = index * SEGMENT_SIZE + partial.get(str(index), 0)
+            end = index * SEGMENT_SIZE + parts.part_length(index)
+            headers = {"Range": f"bytes={start}-{end - 1}"}
+            if self.link.validator:
+                headers["If-Range"] = self.link.validator
+            timeout = aiohttp.ClientTimeout(total=None, sock_read=READ_TIMEOUT)
+            async with self.session.get(self.link.url, headers=headers, timeout=timeout) as response:
+                if response.status == 200 and self.link.validator:
+                    raise LinkChanged(f"{self.link.source} changed on the server")
+                match = _content_range.match(response.headers.get("Content-Range", ""))
+                if response.status != 206 or not match or int(match.group(1)) != start:
+                    raise Exception(f"Range {start}-{end - 1} answered with status {response.status}")
+                offset = start
+
+                def finished() -> None:
+                    partial.pop(str(index), None)
+                    parts.mark(index)
+                    parts.save()
+
+                try:
+                    async for chunk in response.content.iter_chunked(CHUNK_SIZE):
+                        chunk = chunk[:end - offset]
+                        await bandwidth.acquire("download", len(chunk))
+                        offset += len(chunk)
+                        # The range is finished once its last chunk is on disk
+                        await writer.write(offset - len(chunk), chunk, finished if offset >= end else None)
+                        self._progress(len(chunk))
+                        if offset >= end:
+                            break
+                    if offset != end:
+                        raise Exception(f"Range {start}-{end - 1} ended after {offset - start} bytes")
+                finally:
+                    # A retry, now or after a restart, continues from here
+                    if offset < end:
+                        partial[str(index)] = offset - index * SEGMENT_SIZE
+
+        async def worker() -> None:
+            while True:
+                index = retry.pop() if retry else next(pending, None)
+                if index is None:
+                    return
+                try:
+                    await fetch(index)
+                except LinkChanged:
+                    raise
+                except Exception as e:
+                    attempts[index] = attempts.get(index, 0) + 1
+                    if attempts[index] >= SEGMENT_ATTEMPTS:
+                        raise
+                    LOGS.warning(f"Range {index * SEGMENT_SIZE}+{parts.part_length(index)} failed ({e}); retrying")
+                    retry.append(index)
+                    await asyncio.sleep(SEGMENT_RETRY_BACKOFF * attempts[index])
+
+        connections = self.connections if size >= MIN_SEGMENTED_SIZE else 1
+        connections = max(1, min(connections, len(parts.missing())))
+        try:
+            writer = DiskWriter(fd, size, self.path)
+            try:
+                workers = [asyncio.ensure_future(worker()) for _ in range(connections)]
+                try:
+                    await asyncio.gather(*workers)
+                finally:
+                    for task in workers:
+                        task.cancel()
+                    await asyncio.gather(*workers, return_exceptions=True)
+            finally:
+                # Ranges fetched before a failure still reach the disk and the sidecar
+                await writer.close()
+        finally:
+            os.close(fd)
+            parts.save(force=True)
+        parts.remove()
+        LOGS.info(f"Downloaded {self.link.url} over {connections} connections")
+
+
+async def download_link(session: aiohttp.ClientSession, link: LinkInfo, path: str,
+                        progress_callback: Optional[Callable[[int, int], object]] = None,
+                        connections: int = LINK_CONNECTIONS) -> int:
+    """
+    Download link to path. A dropped download is resumed up to RESUME_ATTEMPTS times
+    from the ranges already on disk; if the file changed on the server, the link is
+    probed again and the new validator starts it over from byte zero.
+    """
+    for attempt in range(1, RESUME_ATTEMPTS + 1):
+        try:
+            return await LinkDownloader(session, link, path, connections, progress_callback).run()
+        except LinkChanged as e:
+            if attempt == RESUME_ATTEMPTS:
+                raise
+            LOGS.warning(f"{e}; downloading {path} again from the start")
+            link = await probe_link(session, link.source)
+        except Exception as e:
+            if attempt == RESUME_ATTEMPTS or not (link.ranges and link.validator):
+                raise
+            LOGS.warning(f"Download of {path} failed ({e}); resuming from the ranges already on disk")
+            await asyncio.sleep(RESUME_BACKOFF * attempt)
@@ -0,0 +1,161 @@
+import asyncio
+import json
+import os
+from collections import OrderedDict, defaultdict
+from contextvars import ContextVar
+from html import escape
+from typing import Any, Dict, List, Optional
+
+from .config import LOGS
+
+# Probes kept in memory; a job touches its source and output, so this covers many jobs
+PROBE_CACHE_ENTRIES = 64
+
+# Labels for the ffprobe fields shown on the mediainfo page
+FIELD_LABELS = {
+    "format_long_name": "Format", "codec_long_name": "Codec", "pix_fmt": "Pixel format",
+    "avg_frame_rate": "Frame rate", "bit_rate": "Bit rate", "sample_rate": "Sample rate",
+    "channel_layout": "Channels",
+}
+
+# The job whose ffprobe runs are being counted; tasks inherit it from where they were created
+_current_job: ContextVar[Optional[str]] = ContextVar("probe_job", default=None)
+
+
+def _number(value) -> float:
+    """An ffprobe number ("12.5", "N/A", missing) as a float, 0 if unknown"""
+    try:
+        return float(value)
+    except (TypeError, ValueError):
+        return 0.0
+
+
+class MediaProbe:
+    """What one `ffprobe -show_format -show_streams` says about a file"""
+
+    def __init__(self, path: str, data: Dict[str, Any]):
+        self.path = path
+        self.data = data
+        self.format: Dict[str, Any] = data.get("format", {})
+        self.streams: List[Dict[str, Any]] = data.get("streams", [])
+
+    @property
+    def video(self) -> Optional[Dict[str, Any]]:
+        """The first real video stream (cover art is stored as an attached picture)"""
+        return next((s for s in self.streams if s.get("codec_type") == "video"
+                     and not s.get("disposition", {}).get("attached_pic")), None)
+
+    @property
+    def audio(self) -> Optional[Dict[str, Any]]:
+        return next((s for s in self.streams if s.get("codec_type") == "audio"), None)
+
+    @property
+    def has_audio(self) -> bool:
+        return self.audio is not None
+
+    @property
+    def duration(self) -> float:
+        """Seconds, from the container or else the video stream; 0 when unknown (e.g. piped Matroska)"""
+        return _number(self.format.get("duration")) or _number((self.video or {}).get("duration"))
+
+    @property
+    def width(self) -> int:
+        return int((self.video or {}).get("width") or 0)
+
+    @property
+    def height(self) -> int:
+        return int((self.video or {}).get("height") or 0)
+
+    def html(self) -> str:
+        """Mediainfo-style summary of the container and every stream, for Telegraph"""
+        fields = {
+            "format": ("format_long_name", "duration", "size", "bit_rate"),
+            "video": ("codec_long_name", "profile", "width", "height", "pix_fmt", "avg_frame_rate", "bit_rate"),
+            "audio": ("codec_long_name", "profile", "sample_rate", "channel_layout", "bit_rate"),
+            "subtitle": ("codec_long_name",),
+        }
+
+        def section(title: str, values: Dict[str, Any], keys) -> str:
+            lines = [f"<b>{FIELD_LABELS.get(key, key.replace('_', ' ').title())}</b>: {escape(str(values[key]))}"
+                     for key in keys if values.get(key) not in (None, "", "N/A")]
+            language = values.get("tags", {}).get("language")
+            if language:
+                lines.append(f"<b>Language</b>: {escape(language)}")
+            return f"<h4>{escape(title)}</h4><p>{'<br>'.join(lines)}</p>"
+
+        parts = [section(f"General: {os.path.basename(self.path)}", self.format, fields["format"])]
+        counts: Dict[str, int] = defaultdict(int)
+        for stream in self.streams:
+            kind = stream.get("codec_type", "data")
+            counts[kind] += 1
+            parts.append(section(f"{kind.title()} #{counts[kind]}", stream, fields.get(kind, ("codec_long_name",))))
+        return "".join(parts)
+
+
+class ProbeCache:
+    """
+    MediaProbes by path, valid while the file's mtime and size are unchanged, so every
+    stage of a job (stream-copy planning, thumbnail, preview, screenshots, upload
+    metadata, mediainfo) shares one ffprobe run per file. Concurrent requests for the
+    same file wait for the same run. ffprobe runs are counted per job.
+    """
+
+    def __init__(self, max_entries: int = PROBE_CACHE_ENTRIES):
+        self.max_entries = max_entries
+        self.entries: "OrderedDict[str, tuple]" = OrderedDict()  # path -> (mtime_ns, size, MediaProbe)
+        self._locks: Dict[str, asyncio.Lock] = {}
+        self.job_probes: Dict[str, int] = defaultdict(int)
+        self.total_probes = 0
+
+    async def get(self, path: str) -> Optional[MediaProbe]:
+        """The probe of path, running ffprobe only if the file is new or has changed"""
+        try:
+            stat = os.stat(path)
+        except OSError as e:
+            LOGS.error(f"Cannot probe {path}: {e}")
+            return None
+        signature = (stat.st_mtime_ns, stat.st_size)
+        lock = self._locks.setdefault(path, asyncio.Lock())
+        async with lock:
+            entry = self.entries.get(path)
+            if entry and entry[:2] == signature:
+                self.entries.move_to_end(path)
+                return entry[2]
+            probe = await self._run(path)
+            if probe is not None:
+                self.entries[path] = (*signature, probe)
+                self.entries.move_to_end(path)
+                while len(self.entries) > self.max_entries:
+                    evicted, _ = self.entries.popitem(last=False)
+                    self._locks.pop(evicted, None)
+            return probe
+
+    async def _run(self, path: str) -> Optional[MediaProbe]:
+        job = _current_job.get()
+        self.total_probes += 1
+        if job:
+            self.job_probes[job] += 1
+        try:
+            probe_cmd = f"ffprobe -v error -show_format -show_streams -of json \"{path}\""
+            process = await asyncio.create_subprocess_shell(probe_cmd, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE)
+            stdout, stderr = await process.communicate()
+            if process.returncode == 0:
+                return MediaProbe(path, json.loads(stdout.decode(errors="ignore") or "{}"))
+            LOGS.error(f"ffprobe failed for {path}: {stderr.decode(errors='ignore')}")
+        except Exception as e:
+            LOGS.error(f"Error probing {path}: {e}", exc_info=True)
+        return None
+
+    def start_job(self, name: str):
+        """Count the ffprobe runs of the current task, and of the tasks it spawns, as name's. Returns a token for finish_job()."""
+        return _current_job.set(name)
+
+    def finish_job(self, token) -> int:
+        """Stop counting for the current job; returns how many ffprobe runs it made"""
+        name = _current_job.get()
+        _current_job.reset(token)
+        return self.job_probes.pop(name, 0) if name else 0
+
+
+# Global probe cache instance
+probe_cache = ProbeCache()
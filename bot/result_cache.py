@@ -0,0 +1,186 @@
+import json
+import os
+import time
+import asyncio
+import hashlib
+from typing import Dict, Any, List, Optional
+
+from telethon import errors
+from telethon.tl.types import InputDocument
+
+from .config import LOGS, RESULT_CACHE_TTL_DAYS, RESULT_CACHE_MAX_ENTRIES
+from .settings import settings_manager
+
+
+class ResultCache:
+    """
+    Persistent map from (source, effective settings) to an output the bot already uploaded.
+    Entries only point at documents Telegram keeps; nothing is stored on local disk, so
+    the cost of an entry is its few hundred bytes in the index whatever the output's
+    size, and bounding the entry count bounds the cache. A result's preview and
+    screenshots are replayed with it.
+    """
+
+    def __init__(self, cache_file: str = "result_cache.json", ttl_days: int = RESULT_CACHE_TTL_DAYS,
+                 max_entries: int = RESULT_CACHE_MAX_ENTRIES):
+        self.cache_file = cache_file
+        self.ttl = ttl_days * 24 * 3600
+        self.max_entries = max_entries
+        self.entries: Dict[str, Dict[str, Any]] = {}
+        self.load()
+
+    def load(self):
+        """Load cache entries from JSON file"""
+        try:
+            if os.path.exists(self.cache_file):
+                with open(self.cache_file, 'r') as f:
+                    self.entries = json.load(f)
+                LOGS.info(f"✅ Result cache loaded ({len(self.entries)} entries)")
+        except Exception as e:
+            LOGS.error(f"Error loading result cache: {e}")
+            self.entries = {}
+
+    def save(self):
+        """Save cache entries to JSON file"""
+        try:
+            with open(self.cache_file, 'w') as f:
+                json.dump(self.entries, f, indent=2)
+        except Exception as e:
+            LOGS.error(f"Error saving result cache: {e}")
+
+    @staticmethod
+    def document_source(document) -> str:
+        """Source id of a Telegram document; forwards of the same file share it"""
+        return f"tg:{document.id}"
+
+    @staticmethod
+    async def content_source(path: str) -> str:
+        """Source id of a downloaded file, from a hash of its content"""
+        def digest():
+            sha = hashlib.sha256()
+            with open(path, "rb") as f:
+                for chunk in iter(lambda: f.read(1024 * 1024), b""):
+                    sha.update(chunk)
+            return sha.hexdigest()
+        return f"sha256:{await asyncio.to_thread(digest)}"
+
+    def settings_hash(self, user_id: int = None) -> str:
+        """Hash of every setting that changes the uploaded output for this user"""
+        advanced = settings_manager.get_setting("advanced_settings", user_id=user_id)
+        output = settings_manager.get_setting("output_settings", user_id=user_id)
+        effective = {
+            "compression": settings_manager.get_active_compression_settings(user_id),
+            "watermark": [advanced.get(k) for k in ("watermark_enabled", "watermark_text", "watermark_position")],
+            "stream_copy": advanced.get("stream_copy", True),
+            "output": [output.get(k) for k in ("filename_template", "output_format", "default_upload_mode")],
+            "thumbnail": settings_manager.get_setting("thumbnail_settings", user_id=user_id),
+            "preview": settings_manager.get_setting("preview_settings", user_id=user_id),
+        }
+        return hashlib.sha256(json.dumps(effective, sort_keys=True, default=str).encode()).hexdigest()[:16]
+
+    def make_key(self, source: str, user_id: int = None) -> str:
+        return f"{source}:{self.settings_hash(user_id)}"
+
+    def get(self, key: str) -> Optional[Dict[str, Any]]:
+        """Look up an entry, dropping it if it has expired"""
+        entry = self.entries.get(key)
+        if entry is None:
+            return None
+        if time.time() - entry["created"] > self.ttl:
+            del self.entries[key]
+            self.save()
+            return None
+        return entry
+
+    def put(self, key: str, message, caption: str, stats_msg: str, extras: Optional[List[Dict[str, Any]]] = None):
+        """
+        Remember the document in a sent message as the result for key. extras are the
+        messages sent along with it ({"caption", "message_ids"}: preview, screenshots).
+        """
+        document = getattr(message, "document", None)
+        if document is None:
+            return
+        self.entries[key] = {
+            "id": document.id,
+            "access_hash": document.access_hash,
+            "file_reference": document.file_reference.hex(),
+            "chat_id": message.chat_id,
+            "message_id": message.id,
+            "size": document.size,
+            "caption": caption,
+            "stats": stats_msg,
+            "extras": extras or [],
+            "created": time.time(),
+            "last_used": time.time(),
+        }
+        self.evict()
+        self.save()
+        LOGS.info(f"Cached result for {key} ({len(self.entries)} entries)")
+
+    def evict(self):
+        """Drop expired entries, then the least recently used ones over max_entries"""
+        now = time.time()
+        for key in [k for k, v in self.entries.items() if now - v["created"] > self.ttl]:
+            del self.entries[key]
+        overflow = len(self.entries) - self.max_entries
+        if overflow > 0:
+            for key in sorted(self.entries, key=lambda k: self.entries[k]["last_used"])[:overflow]:
+                del self.entries[key]
+
+    def purge(self, expired_only: bool = False) -> int:
+        """Remove all (or only expired) entries; returns how many were removed"""
+        before = len(self.entries)
+        if expired_only:
+            self.evict()
+        else:
+            self.entries = {}
+        self.save()
+        return before - len(self.entries)
+
+    def total_size(self) -> int:
+        return sum(entry.get("size") or 0 for entry in self.entries.values())
+
+    async def send(self, client, chat_id: int, key: str):
+        """
+        Re-send a cached result to chat_id. Returns (message, entry), or None when there is
+        no usable entry and the job has to run.
+        """
+        entry = self.get(key)
+        if entry is None:
+            return None
+        document = InputDocument(entry["id"], entry["access_hash"], bytes.fromhex(entry["file_reference"]))
+        try:
+            try:
+                message = await client.send_file(chat_id, file=document, caption=entry["caption"])
+            except errors.FileReferenceExpiredError:
+                # Refresh the reference from the message the result was first sent in
+                original = await client.get_messages(entry["chat_id"], ids=entry["message_id"])
+                if not original or not original.document:
+                    raise
+                message = await client.send_file(chat_id, file=original.document, caption=entry["caption"])
+        except Exception as e:
+            LOGS.warning(f"Cached result for {key} is no longer usable, dropping it: {e}")
+            self.entries.pop(key, None)
+            self.save()
+            return None
+
+        entry["file_reference"] = message.document.file_reference.hex()
+        entry["last_used"] = time.time()
+        self.save()
+        await self._send_extras(client, chat_id, key, entry)
+        return message, entry
+
+    async def _send_extras(self, client, chat_id: int, key: str, entry: Dict[str, Any]):
+        """Re-send the preview and screenshots that went out with the result, from their original messages"""
+        for extra in entry.get("extras", []):
+            try:
+                originals = await client.get_messages(entry["chat_id"], ids=extra["message_ids"])
+                media = [m.media for m in originals if m and m.media]
+                if media:
+                    await client.send_file(chat_id, file=media if len(media) > 1 else media[0], caption=extra["caption"])
+            except Exception as e:
+                LOGS.warning(f"Could not re-send {extra['caption']} for {key}: {e}")
+
+
+# Global result cache instance
+result_cache = ResultCache()
@@ -2,7 +2,7 @@ import json
 import os
 import asyncio
 from typing import Dict, Any, Optional
-from .config import LOGS, GPU_TYPE
+from .config import LOGS, GPU_TYPE, BANDWIDTH_UPLOAD_MBS, BANDWIDTH_DOWNLOAD_MBS
 
 class SettingsManager:
     """Dynamic settings manager for the bot with JSON persistence"""
@@ -26,6 +26,9 @@ class SettingsManager:
                 "nvidia_fast": {"v_codec": "h264_nvenc", "v_preset": "p1", "v_qp": 28, "v_scale": 1080},
                 "nvidia_balanced": {"v_codec": "h264_nvenc", "v_preset": "p3", "v_qp": 26, "v_scale": 1080},
                 "nvidia_quality": {"v_codec": "h264_nvenc", "v_preset": "p6", "v_qp": 22, "v_scale": 1080},
+                # target_size (MB) switches from CRF to a two-pass / capped bitrate encode that fits the size
+                "fit_2gb": {"v_codec": "libx264", "v_preset": "medium", "v_qp": 26, "v_scale": 1080, "target_size": 1990},
+                "nvidia_fit_2gb": {"v_codec": "h264_nvenc", "v_preset": "p5", "v_qp": 26, "v_scale": 1080, "target_size": 1990},
             },
             
             # Current Active Settings
@@ -42,6 +45,9 @@ class SettingsManager:
                 "v_fps": 30,
                 "a_bitrate": "192k",
                 "enable_hardware_acceleration": True if GPU_TYPE != "cpu" else False,
+                "auto_quality": False,  # pick v_qp per title from sampled clips
+                "auto_quality_metric": "ssim",  # ssim or psnr
+                "auto_quality_floor": 0.98,
             },
             
             # Output Settings
@@ -70,6 +76,16 @@ class SettingsManager:
                 "watermark_position": "bottom-right",
                 "upload_connections": 5,
                 "progress_update_interval": 5,
+                "parallel_encoding": False,
+                "stream_encoding": False,
+                "stream_keep_source": True,
+                "overlap_upload": False,
+                "stream_copy": True,
+                "result_cache": True,
+                # Budgets are shared by the whole bot (MB/s, 0 = unlimited); the weight is per user
+                "bandwidth_upload_mbs": BANDWIDTH_UPLOAD_MBS,
+                "bandwidth_download_mbs": BANDWIDTH_DOWNLOAD_MBS,
+                "bandwidth_weight": 1,
                 "enable_eval": False,
                 "enable_bash": False,
             },
@@ -239,6 +255,8 @@ class SettingsManager:
             "nvidia_fast": "🚀 NVIDIA Fast - Hardware accelerated, fast",
             "nvidia_balanced": "⚖️ NVIDIA Balanced - Hardware accelerated, balanced",
             "nvidia_quality": "💎 NVIDIA Quality - Hardware accelerated, high quality",
+            "fit_2gb": "📏 Fit 2GB - Two-pass encode sized to stay under 2 GB",
+            "nvidia_fit_2gb": "📏 NVIDIA Fit 2GB - Hardware accelerated, sized to stay under 2 GB",
             "custom": "🔧 Custom - User-defined settings"
         }
         
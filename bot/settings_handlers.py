@@ -4,6 +4,7 @@ from telethon import Button, events
 from .settings import settings_manager
 from .settings_menu import settings_menu
 from .config import LOGS, OWNER
+from .bandwidth import bandwidth
 
 class SettingsHandlers:
     """Handlers for settings interactions"""
@@ -94,6 +95,16 @@ class SettingsHandlers:
         elif setting == "quality":
             await self.request_text_input(event, user_id, "custom_quality", 
                 "🎯 **Set Quality (CRF)**\n\nEnter CRF value (0-51):\n• Lower = Better quality, larger file\n• Higher = Lower quality, smaller file\n• Recommended: 18-28")
+        elif setting == "auto_quality":
+            await self.toggle_auto_quality(event, user_id)
+        elif setting == "auto_metric":
+            await self.toggle_auto_quality_metric(event, user_id)
+        elif setting == "auto_floor":
+            await self.request_text_input(event, user_id, "custom_auto_floor",
+                "🎚️ **Set Quality Floor**\n\nEnter the lowest score a sampled clip may have:\n• SSIM: 0.90-0.999 (recommended 0.98)\n• PSNR: 30-60 dB (recommended 40)\n• Higher = better quality, larger file")
+        elif setting == "target_size":
+            await self.request_text_input(event, user_id, "custom_target_size",
+                "📏 **Set Target Size**\n\nEnter the output size in MB (0 = off, use CRF):\n• Encodes with a bitrate budget instead of CRF\n• Always capped at Max File Size\n• Example: 1990 to fit a 2 GB upload")
         elif setting == "resolution":
             await self.show_resolution_selection(event, user_id)
         elif setting == "fps":
@@ -155,6 +166,31 @@ class SettingsHandlers:
         
         await event.edit(menu_text, buttons=buttons)
     
+    async def toggle_auto_quality(self, event, user_id: int):
+        """Toggle per-title CRF selection"""
+        current = self.settings_manager.get_setting("custom_compression", "auto_quality", user_id)
+        new_value = not current
+
+        if self.settings_manager.set_setting("custom_compression", "auto_quality", new_value, user_id):
+            status = "✅ Enabled" if new_value else "❌ Disabled"
+            await event.answer(f"Auto Quality {status}")
+            await self.settings_menu.show_custom_compression(event, user_id)
+        else:
+            await event.answer("❌ Failed to toggle setting", alert=True)
+
+    async def toggle_auto_quality_metric(self, event, user_id: int):
+        """Switch the auto quality metric between SSIM and PSNR"""
+        current = self.settings_manager.get_setting("custom_compression", "auto_quality_metric", user_id) or "ssim"
+        new_value = "psnr" if current == "ssim" else "ssim"
+
+        # The floors aren't comparable across metrics, so start from the recommended one
+        if (self.settings_manager.set_setting("custom_compression", "auto_quality_metric", new_value, user_id) and
+                self.settings_manager.set_setting("custom_compression", "auto_quality_floor", 40.0 if new_value == "psnr" else 0.98, user_id)):
+            await event.answer(f"Quality metric set to {new_value.upper()}")
+            await self.settings_menu.show_custom_compression(event, user_id)
+        else:
+            await event.answer("❌ Failed to change setting", alert=True)
+
     async def toggle_hardware_acceleration(self, event, user_id: int):
         """Toggle hardware acceleration"""
         current = self.settings_manager.get_setting("custom_compression", "enable_hardware_acceleration", user_id)
@@ -276,6 +312,16 @@ class SettingsHandlers:
                 value = int(text)
                 if 0 <= value <= 51:
                     return self.settings_manager.set_setting("custom_compression", "v_qp", value, user_id)
+            elif setting_key == "custom_auto_floor":
+                value = float(text)
+                metric = self.settings_manager.get_setting("custom_compression", "auto_quality_metric", user_id) or "ssim"
+                low, high = (0.9, 0.999) if metric == "ssim" else (30, 60)
+                if low <= value <= high:
+                    return self.settings_manager.set_setting("custom_compression", "auto_quality_floor", value, user_id)
+            elif setting_key == "custom_target_size":
+                value = int(text)
+                if 0 <= value <= 8000:
+                    return self.settings_manager.set_setting("custom_compression", "target_size", value, user_id)
             elif setting_key == "custom_fps":
                 value = int(text)
                 if 0 <= value <= 120:
@@ -322,6 +368,18 @@ class SettingsHandlers:
                 value = int(text)
                 if 1 <= value <= 30:
                     return self.settings_manager.set_setting("advanced_settings", "progress_update_interval", value, user_id)
+            elif setting_key in ("advanced_bw_up", "advanced_bw_down"):
+                value = float(text)
+                if 0 <= value <= 1000:
+                    # One budget for the whole bot, so it is stored globally rather than per user
+                    direction = "upload" if setting_key == "advanced_bw_up" else "download"
+                    if self.settings_manager.set_setting("advanced_settings", f"bandwidth_{direction}_mbs", value):
+                        bandwidth.configure(**{f"{direction}_mbs": value})
+                        return True
+            elif setting_key == "advanced_bw_weight":
+                value = int(text)
+                if 1 <= value <= 10:
+                    return self.settings_manager.set_setting("advanced_settings", "bandwidth_weight", value, user_id)
             # Add more text input processors as needed
             
         except ValueError:
@@ -473,6 +531,27 @@ class SettingsHandlers:
         elif setting == "progress":
             await self.request_text_input(event, user_id, "advanced_progress",
                 "⏱️ **Set Progress Update Interval**\n\nEnter interval in seconds (1-30):")
+        elif setting == "parallel":
+            await self.toggle_parallel_encoding(event, user_id)
+        elif setting == "stream":
+            await self.toggle_stream_encoding(event, user_id)
+        elif setting == "stream_keep":
+            await self.toggle_stream_keep_source(event, user_id)
+        elif setting == "overlap":
+            await self.toggle_overlap_upload(event, user_id)
+        elif setting == "copy":
+            await self.toggle_stream_copy(event, user_id)
+        elif setting == "cache":
+            await self.toggle_result_cache(event, user_id)
+        elif setting == "bw_up":
+            await self.request_text_input(event, user_id, "advanced_bw_up",
+                "📶 **Set Upload Budget**\n\nEnter the upload limit for all jobs together in MB/s (0 = unlimited):")
+        elif setting == "bw_down":
+            await self.request_text_input(event, user_id, "advanced_bw_down",
+                "📶 **Set Download Budget**\n\nEnter the download limit for all jobs together in MB/s (0 = unlimited):")
+        elif setting == "bw_weight":
+            await self.request_text_input(event, user_id, "advanced_bw_weight",
+                "⚖️ **Set Bandwidth Weight**\n\nEnter your jobs' share of the budgets against other jobs (1-10):")
 
     async def toggle_watermark(self, event, user_id: int):
         """Toggle watermark"""
@@ -486,6 +565,78 @@ class SettingsHandlers:
         else:
             await event.answer("❌ Failed to toggle setting", alert=True)
 
+    async def toggle_parallel_encoding(self, event, user_id: int):
+        """Toggle segment-parallel encoding"""
+        current = self.settings_manager.get_setting("advanced_settings", "parallel_encoding", user_id)
+        new_value = not current
+
+        if self.settings_manager.set_setting("advanced_settings", "parallel_encoding", new_value, user_id):
+            status = "✅ Enabled" if new_value else "❌ Disabled"
+            await event.answer(f"Parallel Encoding {status}")
+            await self.settings_menu.show_advanced_settings(event, user_id)
+        else:
+            await event.answer("❌ Failed to toggle setting", alert=True)
+
+    async def toggle_stream_encoding(self, event, user_id: int):
+        """Toggle encoding while the file is still downloading"""
+        current = self.settings_manager.get_setting("advanced_settings", "stream_encoding", user_id)
+        new_value = not current
+
+        if self.settings_manager.set_setting("advanced_settings", "stream_encoding", new_value, user_id):
+            status = "✅ Enabled" if new_value else "❌ Disabled"
+            await event.answer(f"Streaming Encode {status}")
+            await self.settings_menu.show_advanced_settings(event, user_id)
+        else:
+            await event.answer("❌ Failed to toggle setting", alert=True)
+
+    async def toggle_stream_keep_source(self, event, user_id: int):
+        """Toggle keeping an on-disk copy of streamed sources"""
+        current = self.settings_manager.get_setting("advanced_settings", "stream_keep_source", user_id)
+        new_value = not (True if current is None else current)
+
+        if self.settings_manager.set_setting("advanced_settings", "stream_keep_source", new_value, user_id):
+            status = "✅ Enabled" if new_value else "❌ Disabled"
+            await event.answer(f"Keep Streamed Source {status}")
+            await self.settings_menu.show_advanced_settings(event, user_id)
+        else:
+            await event.answer("❌ Failed to toggle setting", alert=True)
+
+    async def toggle_overlap_upload(self, event, user_id: int):
+        """Toggle uploading the output while it is being encoded"""
+        current = self.settings_manager.get_setting("advanced_settings", "overlap_upload", user_id)
+        new_value = not current
+
+        if self.settings_manager.set_setting("advanced_settings", "overlap_upload", new_value, user_id):
+            status = "✅ Enabled" if new_value else "❌ Disabled"
+            await event.answer(f"Upload While Encoding {status}")
+            await self.settings_menu.show_advanced_settings(event, user_id)
+        else:
+            await event.answer("❌ Failed to toggle setting", alert=True)
+
+    async def toggle_stream_copy(self, event, user_id: int):
+        """Toggle remuxing instead of re-encoding sources that already meet the target"""
+        current = self.settings_manager.get_setting("advanced_settings", "stream_copy", user_id)
+        new_value = not (True if current is None else current)
+
+        if self.settings_manager.set_setting("advanced_settings", "stream_copy", new_value, user_id):
+            status = "✅ Enabled" if new_value else "❌ Disabled"
+            await event.answer(f"Skip Needless Re-encodes {status}")
+            await self.settings_menu.show_advanced_settings(event, user_id)
+        else:
+            await event.answer("❌ Failed to toggle setting", alert=True)
+
+    async def toggle_result_cache(self, event, user_id: int):
+        """Toggle re-sending cached results for repeated sources"""
+        current = self.settings_manager.get_setting("advanced_settings", "result_cache", user_id)
+        new_value = not (True if current is None else current)
+
+        if self.settings_manager.set_setting("advanced_settings", "result_cache", new_value, user_id):
+            status = "✅ Enabled" if new_value else "❌ Disabled"
+            await event.answer(f"Result Cache {status}")
+            await self.settings_menu.show_advanced_settings(event, user_id)
+        else:
+            await event.answer("❌ Failed to toggle setting", alert=True)
+
     async def show_watermark_position_selection(self, event, user_id: int):
         """Show watermark position selection"""
         menu_text = "📍 **Select Watermark Position**\n\nChoose position:"
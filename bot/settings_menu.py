@@ -2,6 +2,7 @@ import asyncio
 from telethon import Button
 from .settings import settings_manager
 from .config import LOGS, OWNER, GPU_TYPE
+from .bandwidth import bandwidth
 
 class SettingsMenu:
     """Settings menu interface for the bot"""
@@ -113,6 +114,8 @@ class SettingsMenu:
             f"**Codec**: `{custom_settings.get('v_codec', 'libx264')}`\n"
             f"**Preset**: `{custom_settings.get('v_preset', 'medium')}`\n"
             f"**Quality (CRF)**: `{custom_settings.get('v_qp', 26)}`\n"
+            f"**Auto Quality**: `{'✅' if custom_settings.get('auto_quality') else '❌'} ({custom_settings.get('auto_quality_metric', 'ssim').upper()} ≥ {custom_settings.get('auto_quality_floor', 0.98)})`\n"
+            f"**Target Size**: `{str(custom_settings['target_size']) + 'MB' if custom_settings.get('target_size') else 'Off (CRF)'}`\n"
             f"**Resolution**: `{custom_settings.get('v_scale', 1080)}p`\n"
             f"**FPS**: `{custom_settings.get('v_fps', 30)}`\n"
             f"**Audio Bitrate**: `{custom_settings.get('a_bitrate', '192k')}`\n"
@@ -124,6 +127,9 @@ class SettingsMenu:
             [Button.inline("🎥 Video Codec", data="custom_codec")],
             [Button.inline("⚡ Preset/Speed", data="custom_preset")],
             [Button.inline("🎯 Quality (CRF)", data="custom_quality")],
+            [Button.inline("🤖 Auto Quality", data="custom_auto_quality"), Button.inline("📊 Quality Metric", data="custom_auto_metric")],
+            [Button.inline("🎚️ Quality Floor", data="custom_auto_floor")],
+            [Button.inline("📏 Target Size", data="custom_target_size")],
             [Button.inline("📐 Resolution", data="custom_resolution")],
             [Button.inline("🎞️ Frame Rate", data="custom_fps")],
             [Button.inline("🔊 Audio Bitrate", data="custom_audio")],
@@ -196,7 +202,15 @@ class SettingsMenu:
             f"**Watermark Text**: `{advanced_settings.get('watermark_text', 'Compressed by Bot')}`\n"
             f"**Watermark Position**: `{advanced_settings.get('watermark_position', 'bottom-right')}`\n"
             f"**Upload Connections**: `{advanced_settings.get('upload_connections', 5)}`\n"
-            f"**Progress Update Interval**: `{advanced_settings.get('progress_update_interval', 5)}s`\n\n"
+            f"**Progress Update Interval**: `{advanced_settings.get('progress_update_interval', 5)}s`\n"
+            f"**Parallel Encoding**: `{'✅' if advanced_settings.get('parallel_encoding') else '❌'}`\n"
+            f"**Streaming Encode**: `{'✅' if advanced_settings.get('stream_encoding') else '❌'}`\n"
+            f"**Keep Streamed Source**: `{'✅' if advanced_settings.get('stream_keep_source', True) else '❌'}`\n"
+            f"**Upload While Encoding**: `{'✅' if advanced_settings.get('overlap_upload') else '❌'}`\n"
+            f"**Skip Needless Re-encodes**: `{'✅' if advanced_settings.get('stream_copy', True) else '❌'}`\n"
+            f"**Result Cache**: `{'✅' if advanced_settings.get('result_cache', True) else '❌'}`\n"
+            f"**Bandwidth (all jobs)**: `{bandwidth.describe()}`\n"
+            f"**Bandwidth Weight**: `{advanced_settings.get('bandwidth_weight', 1)}`\n\n"
             "Select setting to modify:"
         )
         
@@ -206,6 +220,15 @@ class SettingsMenu:
             [Button.inline("📍 Watermark Position", data="advanced_watermark_pos")],
             [Button.inline("🔗 Upload Connections", data="advanced_upload_conn")],
             [Button.inline("⏱️ Progress Interval", data="advanced_progress")],
+            [Button.inline("🧩 Toggle Parallel Encoding", data="advanced_parallel")],
+            [Button.inline("📡 Toggle Streaming Encode", data="advanced_stream")],
+            [Button.inline("💾 Toggle Keep Streamed Source", data="advanced_stream_keep")],
+            [Button.inline("📤 Toggle Upload While Encoding", data="advanced_overlap")],
+            [Button.inline("⚡ Toggle Skip Needless Re-encodes", data="advanced_copy")],
+            [Button.inline("♻️ Toggle Result Cache", data="advanced_cache")],
+            [Button.inline("📶 Upload Budget", data="advanced_bw_up"),
+             Button.inline("📶 Download Budget", data="advanced_bw_down")],
+            [Button.inline("⚖️ Bandwidth Weight", data="advanced_bw_weight")],
             [Button.inline("🔙 Back to Settings", data="settings_main")]
         ]
         
@@ -101,6 +101,8 @@ async def help(event):
         "• `/link` - Process video from URL\n"
         "• `/watermark` - Toggle watermark on/off\n"
         "• `/toggle_upload_mode` - Switch upload mode\n"
+        "• `/purgecache` - Clear cached results (`expired` = only expired)\n"
+        "• `/transfers` - Telegram transfer speeds per connection\n"
         "• `/usage` - Show system stats\n\n"
         "**How to use:**\n"
         "1. Send or forward a video file\n"
@@ -127,6 +129,8 @@ async def ihelp(event):
         "• `/link` - Process video from URL\n"
         "• `/watermark` - Toggle watermark on/off\n"
         "• `/toggle_upload_mode` - Switch upload mode\n"
+        "• `/purgecache` - Clear cached results (`expired` = only expired)\n"
+        "• `/transfers` - Telegram transfer speeds per connection\n"
         "• `/usage` - Show system stats\n\n"
         "**Features:**\n"
         "• GPU-accelerated encoding\n"
@@ -0,0 +1,153 @@
+import asyncio
+import hashlib
+import json
+import os
+import time
+from typing import Any, Dict, Optional
+
+from PIL import Image
+
+from .config import LOGS, THUMB_CACHE_MAX_ENTRIES, THUMB_CACHE_FRESH_MINUTES
+from .bandwidth import bandwidth
+from .disk_writer import DiskWriter
+from .http_client import http_client
+
+# Telegram ignores thumbnails larger than 320px on either side
+THUMB_SIZE = 320
+CHUNK_SIZE = 64 * 1024
+
+
+def _resize(source: str, target: str) -> None:
+    """Shrink an image to fit THUMB_SIZE and store it as JPEG (what Telegram expects)"""
+    with Image.open(source) as image:
+        image.thumbnail((THUMB_SIZE, THUMB_SIZE), Image.LANCZOS)
+        image.convert("RGB").save(target, "JPEG", quality=90)
+
+
+class ThumbnailCache:
+    """
+    Custom thumbnails by URL, already resized for Telegram. A URL fetched within the
+    last THUMB_CACHE_FRESH_MINUTES is served from disk; after that it is revalidated
+    with If-None-Match / If-Modified-Since, so an unchanged image costs a 304 and no
+    download. The least recently used images are dropped beyond max_entries.
+    """
+
+    def __init__(self, cache_dir: str = "thumb/cache", max_entries: int = THUMB_CACHE_MAX_ENTRIES,
+                 fresh_minutes: int = THUMB_CACHE_FRESH_MINUTES):
+        self.cache_dir = cache_dir
+        self.index_file = os.path.join(cache_dir, "index.json")
+        self.max_entries = max(1, max_entries)
+        self.fresh = fresh_minutes * 60
+        self.entries: Dict[str, Dict[str, Any]] = {}
+        self._locks: Dict[str, asyncio.Lock] = {}
+        self.load()
+
+    def load(self):
+        """Load the index, forgetting entries whose image is gone"""
+        try:
+            if os.path.exists(self.index_file):
+                with open(self.index_file, 'r') as f:
+                    self.entries = {
+                        url: entry for url, entry in json.load(f).items()
+                        if os.path.exists(self.path_for(url))
+                    }
+                LOGS.info(f"✅ Thumbnail cache loaded ({len(self.entries)} entries)")
+        except Exception as e:
+            LOGS.error(f"Error loading thumbnail cache: {e}")
+            self.entries = {}
+
+    def save(self):
+        """Save the index to JSON file"""
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            with open(self.index_file, 'w') as f:
+                json.dump(self.entries, f, indent=2)
+        except Exception as e:
+            LOGS.error(f"Error saving thumbnail cache: {e}")
+
+    def path_for(self, url: str) -> str:
+        return os.path.join(self.cache_dir, f"{hashlib.sha256(url.encode()).hexdigest()[:24]}.jpg")
+
+    def owns(self, path: str) -> bool:
+        """Whether path is a cached image, which callers must not delete"""
+        return os.path.abspath(os.path.dirname(path)) == os.path.abspath(self.cache_dir)
+
+    async def get(self, url: str) -> Optional[str]:
+        """Path of the resized image for url, fetching or revalidating it as needed"""
+        lock = self._locks.setdefault(url, asyncio.Lock())
+        async with lock:
+            path = self.path_for(url)
+            entry = self.entries.get(url)
+            if entry and not os.path.exists(path):
+                entry = None
+            if entry and time.time() - entry["checked"] < self.fresh:
+                return self._use(url, entry)
+            try:
+                return await self._fetch(url, path, entry)
+            except Exception as e:
+                if entry:
+                    LOGS.warning(f"Could not revalidate thumbnail {url} ({e}); using the cached copy")
+                    return self._use(url, entry)
+                raise
+
+    def _use(self, url: str, entry: Dict[str, Any]) -> str:
+        entry["used"] = time.time()
+        self.save()
+        return self.path_for(url)
+
+    async def _fetch(self, url: str, path: str, entry: Optional[Dict[str, Any]]) -> Optional[str]:
+        headers = {}
+        if entry and entry.get("etag"):
+            headers["If-None-Match"] = entry["etag"]
+        if entry and entry.get("last_modified"):
+            headers["If-Modified-Since"] = entry["last_modified"]
+        download = f"{path}.download"
+        async with http_client.session.get(url, headers=headers) as response:
+            if response.status == 304 and entry:
+                LOGS.info(f"Custom thumbnail unchanged: {url}")
+                entry["checked"] = time.time()
+                return self._use(url, entry)
+            if response.status != 200:
+                raise Exception(f"Thumbnail download failed: Status {response.status}")
+            os.makedirs(self.cache_dir, exist_ok=True)
+            fd = os.open(download, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+            try:
+                # Only read back by _resize, so not worth an fsync
+                writer = DiskWriter(fd, label=download, sync=False)
+                offset = 0
+                try:
+                    async for chunk in response.content.iter_chunked(CHUNK_SIZE):
+                        await bandwidth.acquire("download", len(chunk))
+                        await writer.write(offset, chunk)
+                        offset += len(chunk)
+                finally:
+                    await writer.close()
+            finally:
+                os.close(fd)
+            validators = {"etag": response.headers.get("ETag"), "last_modified": response.headers.get("Last-Modified")}
+        try:
+            await asyncio.to_thread(_resize, download, path)
+        finally:
+            if os.path.exists(download):
+                os.remove(download)
+        LOGS.info(f"Custom thumbnail cached: {url} -> {path}")
+        self.entries[url] = {**validators, "checked": time.time(), "used": time.time()}
+        self._evict()
+        return self._use(url, self.entries[url])
+
+    def _evict(self):
+        """Drop the least recently used images beyond max_entries"""
+        excess = len(self.entries) - self.max_entries
+        if excess <= 0:
+            return
+        for url in sorted(self.entries, key=lambda u: self.entries[u]["used"])[:excess]:
+            del self.entries[url]
+            self._locks.pop(url, None)
+            try:
+                os.remove(self.path_for(url))
+            except OSError:
+                pass
+
+
+# Global thumbnail cache instance
+thumb_cache = ThumbnailCache()
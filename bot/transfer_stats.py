@@ -0,0 +1,197 @@
+import os
+import time
+from bisect import bisect_left
+from collections import defaultdict, deque
+from typing import Deque, Dict, List, Optional
+
+from .funcn import hbs
+
+# Histogram bucket upper bounds; each histogram has one more, open-ended, bucket
+LATENCY_BUCKETS_MS = (50, 100, 200, 500, 1000, 2000, 5000)
+RATE_BUCKETS_MBS = (1, 2, 5, 10, 20, 50, 100)
+RECENT_TRANSFERS = 50
+MB = 1024 * 1024
+
+
+class SenderStats:
+    """Counters for one sender of a transfer. The hot path only ever increments them."""
+
+    __slots__ = ("requests", "bytes", "latency_total", "latency", "errors", "reconnects")
+
+    def __init__(self):
+        self.requests = 0
+        self.bytes = 0
+        self.latency_total = 0.0
+        self.latency = [0] * (len(LATENCY_BUCKETS_MS) + 1)
+        self.errors: Dict[str, int] = defaultdict(int)
+        self.reconnects = 0
+
+    def record(self, seconds: float, size: int):
+        self.requests += 1
+        self.bytes += size
+        self.latency_total += seconds
+        self.latency[bisect_left(LATENCY_BUCKETS_MS, seconds * 1000)] += 1
+
+    def record_error(self, error: BaseException):
+        self.errors[type(error).__name__] += 1
+
+    def error_count(self) -> int:
+        return sum(self.errors.values())
+
+    def mean_latency_ms(self) -> float:
+        return self.latency_total / self.requests * 1000 if self.requests else 0.0
+
+
+class TransferStats:
+    """One ParallelTransferrer run: what it moved, how fast, through which senders, and for which job."""
+
+    def __init__(self, direction: str, dc_id: int, label: Optional[str], size: Optional[int], job: str = "bot"):
+        self.direction = direction
+        self.job = job
+        self.dc_id = dc_id
+        self.label = os.path.basename(label) if label else "stream"
+        self.size = size
+        self.started = time.monotonic()
+        self.finished: Optional[float] = None
+        self.failed = False
+        self.senders: List[SenderStats] = []
+
+    @property
+    def bytes(self) -> int:
+        return sum(sender.bytes for sender in self.senders)
+
+    def elapsed(self) -> float:
+        return (self.finished or time.monotonic()) - self.started
+
+    def rate(self) -> float:
+        """Aggregate bytes per second over the whole transfer"""
+        elapsed = self.elapsed()
+        return self.bytes / elapsed if elapsed > 0 else 0.0
+
+    def errors(self) -> Dict[str, int]:
+        merged: Dict[str, int] = defaultdict(int)
+        for sender in self.senders:
+            for name, count in sender.errors.items():
+                merged[name] += count
+        return dict(merged)
+
+    def latency(self) -> List[int]:
+        return [sum(counts) for counts in zip(*(sender.latency for sender in self.senders))] if self.senders else []
+
+    def summary(self) -> str:
+        """Short line for the job stats: rate, senders and errors"""
+        arrow = "⬇️" if self.direction == "download" else "⬆️"
+        errors = sum(self.errors().values())
+        line = f"{arrow} {self.rate() / MB:.1f} MB/s ({len(self.senders)} senders"
+        if errors:
+            line += f", {errors} errors"
+        return line + ")"
+
+
+def _percentile(counts: List[int], bounds, q: float) -> str:
+    """Bucket holding the q-th quantile of a histogram, as its upper bound"""
+    total = sum(counts)
+    if not total:
+        return "-"
+    seen = 0
+    for index, count in enumerate(counts):
+        seen += count
+        if seen >= q * total:
+            return f"≤{bounds[index]}" if index < len(bounds) else f">{bounds[-1]}"
+    return f">{bounds[-1]}"
+
+
+def _histogram(counts: List[int], bounds, unit: str) -> str:
+    labels = [f"≤{bound}" for bound in bounds] + [f">{bounds[-1]}"]
+    peak = max(counts) if counts and max(counts) else 1
+    return "\n".join(
+        f"`{label:>6}{unit} {'█' * round(count / peak * 12):<12} {count}`"
+        for label, count in zip(labels, counts) if count
+    )
+
+
+class TransferMonitor:
+    """Active and recent transfers. Everything beyond the counters is computed when read."""
+
+    def __init__(self, keep: int = RECENT_TRANSFERS):
+        self.active: List[TransferStats] = []
+        self.recent: Deque[TransferStats] = deque(maxlen=keep)
+
+    def begin(self, direction: str, dc_id: int, label: Optional[str], size: Optional[int],
+              job: str = "bot") -> TransferStats:
+        stats = TransferStats(direction, dc_id, label, size, job)
+        self.active.append(stats)
+        return stats
+
+    def end(self, stats: TransferStats):
+        if stats.finished is None:
+            stats.finished = time.monotonic()
+            if stats in self.active:
+                self.active.remove(stats)
+            self.recent.append(stats)
+
+    def latest(self, job: str, direction: str) -> Optional[TransferStats]:
+        """Most recent transfer in direction made by job (the bandwidth job name, unique per run)"""
+        # Active transfers started after every finished one
+        for stats in reversed([*self.recent, *self.active]):
+            if stats.job == job and stats.direction == direction:
+                return stats
+        return None
+
+    def job_summary(self, job: str) -> Optional[str]:
+        """One line for a job's stats message covering its latest download and upload"""
+        parts = [stats.summary() for stats in (self.latest(job, d) for d in ("download", "upload")) if stats]
+        return " · ".join(parts) if parts else None
+
+    def rate_histogram(self) -> List[int]:
+        counts = [0] * (len(RATE_BUCKETS_MBS) + 1)
+        for stats in self.recent:
+            if not stats.failed:
+                counts[bisect_left(RATE_BUCKETS_MBS, stats.rate() / MB)] += 1
+        return counts
+
+    def report(self, max_senders: int = 8) -> str:
+        """The /transfers view: active transfers per sender, then recent ones as histograms"""
+        msg = "📡 **Transfers**\n"
+        if not self.active:
+            msg += "\nNo transfer running."
+        for stats in self.active:
+            size = f"{hbs(stats.bytes)}" + (f" of {hbs(stats.size)}" if stats.size else "")
+            msg += (
+                f"\n{'⬇️' if stats.direction == 'download' else '⬆️'} `{stats.label}` (DC {stats.dc_id})\n"
+                f"  {size} · {stats.rate() / MB:.1f} MB/s · {len(stats.senders)} senders\n"
+            )
+            busiest = sorted(stats.senders, key=lambda sender: sender.bytes, reverse=True)
+            for index, sender in enumerate(busiest[:max_senders], 1):
+                msg += (
+                    f"  `#{index:<2} {hbs(sender.bytes):>10} {sender.requests:>5} req "
+                    f"{sender.mean_latency_ms():>6.0f} ms {sender.error_count():>3} err"
+                    f"{f' {sender.reconnects} recon' if sender.reconnects else ''}`\n"
+                )
+            if len(busiest) > max_senders:
+                msg += f"  …and {len(busiest) - max_senders} more\n"
+
+        finished = list(self.recent)
+        if finished:
+            failed = sum(1 for stats in finished if stats.failed)
+            moved = sum(stats.bytes for stats in finished)
+            msg += f"\n\n**Last {len(finished)} transfers** ({hbs(moved)}, {failed} failed)\n"
+            msg += f"MB/s per transfer:\n{_histogram(self.rate_histogram(), RATE_BUCKETS_MBS, '')}\n"
+            latency = [sum(counts) for counts in zip(*(stats.latency() for stats in finished if stats.senders))]
+            if latency:
+                msg += (
+                    f"Request latency (p50 {_percentile(latency, LATENCY_BUCKETS_MS, 0.5)} ms, "
+                    f"p95 {_percentile(latency, LATENCY_BUCKETS_MS, 0.95)} ms):\n"
+                    f"{_histogram(latency, LATENCY_BUCKETS_MS, 'ms')}\n"
+                )
+            errors: Dict[str, int] = defaultdict(int)
+            for stats in finished:
+                for name, count in stats.errors().items():
+                    errors[name] += count
+            if errors:
+                msg += "Errors: " + ", ".join(f"{name} ×{count}" for name, count in sorted(errors.items(), key=lambda e: -e[1]))
+        return msg.strip()
+
+
+# Global transfer monitor instance
+transfer_monitor = TransferMonitor()
@@ -1,19 +1,32 @@
 import re
 import os
 import time
+import shutil
+import hashlib
 import asyncio
-import aiohttp
 from datetime import datetime
 from pathlib import Path
 
-from telethon import Button
+from telethon import Button, errors
 from telethon.tl.types import DocumentAttributeVideo
-from html_telegraph_poster import TelegraphPoster
 
-from .FastTelethon import download_file, upload_file
-from .funcn import bot_state, code, ts, hbs, progress, info, validate_file_path
+from .FastTelethon import (
+    download_resumable, upload_file, iter_download, upload_stream, has_pending_upload, forget_upload,
+    BIG_FILE_THRESHOLD,
+)
+from .funcn import (
+    bot_state, code, ts, hbs, progress, encode_progress, parse_ffmpeg_progress,
+    info, validate_file_path, job_temp_dir
+)
 from .config import LOGS, OWNER, GPU_TYPE
 from .settings import settings_manager
+from .result_cache import result_cache, ResultCache
+from .transfer_stats import transfer_monitor
+from .bandwidth import bandwidth
+from .http_client import http_client
+from .thumb_cache import thumb_cache
+from .media_probe import probe_cache
+from .disk_writer import DiskWriter
 
 
 def get_watermark_filter(user_id: int = None):
@@ -56,14 +69,691 @@ def get_watermark_filter(user_id: int = None):
     return watermark_filter
 
 
-async def process_compression(event, dl, start_time, user_id: int):
+# Segment-parallel encoding: never cut a segment shorter than this, and give
+# each concurrent libx264/libx265 process this many threads.
+MIN_SEGMENT_DURATION = 30
+THREADS_PER_SEGMENT = 4
+
+# key=value lines written by `-progress`; anything else on stderr is FFmpeg's error log
+PROGRESS_LINE = re.compile(r"^[a-z0-9_]+=")
+
+# Target-size mode: share of the budget left for container overhead, peak bitrate allowed
+# above the average, the lowest video bitrate worth encoding at, and how far below the
+# budget a retry aims after an oversized result.
+CONTAINER_OVERHEAD = 0.02
+TARGET_MAXRATE_FACTOR = 1.5
+MIN_VIDEO_BITRATE = 100_000
+TARGET_RETRY_MARGIN = 0.97
+TARGET_SIZE_ATTEMPTS = 2
+
+
+def build_encode_command(input_path, out, compression_settings, user_id: int = None, audio=True, threads=None, to_pipe=False,
+                         video_bitrate=None, pass_number=None, passlog=None):
+    """Builds the FFmpeg command (as a list of shell-quoted parts) that encodes input_path into out."""
+    v_codec = compression_settings.get("v_codec", "libx264")
+    v_preset = compression_settings.get("v_preset", "medium")
+    v_scale = compression_settings.get("v_scale", 1080)
+
+    # Determine if the codec is hardware-accelerated
+    is_hardware_codec = '_nvenc' in v_codec
+    enable_hardware_acceleration = compression_settings.get("enable_hardware_acceleration", True)
+    use_cuda = GPU_TYPE == "nvidia" and enable_hardware_acceleration and is_hardware_codec
+
+    advanced_settings = settings_manager.get_setting("advanced_settings", user_id=user_id)
+    watermark_enabled = advanced_settings.get("watermark_enabled", False)
+
+    # FFmpeg Command Builder; progress blocks go to stderr next to the error log
+    cmd_parts = ['ffmpeg', '-y', '-hide_banner', '-loglevel', 'error', '-progress', 'pipe:2', '-nostats']
+
+    # Get all needed settings
+    v_profile = compression_settings.get("v_profile", "high")
+    v_level = compression_settings.get("v_level", "4.0")
+    v_qp = compression_settings.get("v_qp", 26)
+    v_fps = compression_settings.get("v_fps", 30)
+    a_bitrate = compression_settings.get("a_bitrate", "192k")
+
+    # Input options (before -i)
+    if use_cuda:
+        cmd_parts.extend(['-hwaccel', 'cuda', '-hwaccel_output_format', 'cuda'])
+
+    # Input file
+    cmd_parts.extend(['-i', f'"{input_path}"'])
+
+    # Output options (after -i, before output file)
+    filters = []
+    if v_scale != -1:
+        if use_cuda:
+            filters.append(f'scale_cuda=-2:{v_scale}')
+        else:
+            filters.append(f'scale=-2:{v_scale}:force_original_aspect_ratio=decrease')
+
+    if watermark_enabled:
+        watermark_filter = get_watermark_filter(user_id)
+        if watermark_filter:  # Only add if watermark filter is valid
+            if use_cuda:
+                # For hardware acceleration, we need to download from GPU, apply watermark, then upload back
+                filters.append(f'hwdownload,format=nv12,{watermark_filter},hwupload_cuda')
+            else:
+                # For software encoding, apply watermark directly
+                filters.append(watermark_filter)
+
+    if filters:
+        cmd_parts.extend(['-vf', f'"{",".join(filters)}"'])
+
+    # Encoding parameters with custom settings
+    cmd_parts.extend([
+        '-c:v', v_codec,          # libx265
+        '-preset', v_preset,      # p3
+        '-profile:v', v_profile,  # high
+        '-level:v', v_level,
+    ])
+    # A video_bitrate replaces the CRF with an average bitrate; pass_number/passlog make it a two-pass run
+    if not video_bitrate:
+        cmd_parts.extend(['-crf', str(v_qp)])  # 26
+    elif is_hardware_codec:
+        # NVENC has no two-pass over the whole file; cap the VBV at the average so it can't overshoot
+        cmd_parts.extend([
+            '-rc', 'vbr', '-multipass', 'fullres', '-b:v', str(video_bitrate),
+            '-maxrate', str(video_bitrate), '-bufsize', str(video_bitrate * 2)
+        ])
+    else:
+        cmd_parts.extend([
+            '-b:v', str(video_bitrate),
+            '-maxrate', str(int(video_bitrate * TARGET_MAXRATE_FACTOR)), '-bufsize', str(video_bitrate * 2)
+        ])
+        if pass_number and 'x265' in v_codec:
+            cmd_parts.extend(['-x265-params', f'"pass={pass_number}:stats={passlog}.log"'])
+        elif pass_number:
+            cmd_parts.extend(['-pass', str(pass_number), '-passlogfile', f'"{passlog}"'])
+    cmd_parts.extend(['-r', str(v_fps)])  # 120
+    if threads:
+        cmd_parts.extend(['-threads', str(threads)])
+
+    if audio and pass_number != 1:
+        cmd_parts.extend(['-c:a', 'aac', '-b:a', a_bitrate])  # 384k
+    else:
+        cmd_parts.append('-an')
+
+    # Pass 1 only writes the stats; a pipe gets a container that never seeks back
+    if pass_number == 1:
+        cmd_parts.extend(['-f', 'null', os.devnull])
+    elif not to_pipe:
+        cmd_parts.extend(['-movflags', '+faststart', f'"{out}"'])
+    elif out.endswith(".mp4"):
+        cmd_parts.extend(['-movflags', 'frag_keyframe+empty_moov+default_base_moof', '-f', 'mp4', 'pipe:1'])
+    else:
+        cmd_parts.extend(['-f', 'matroska', 'pipe:1'])
+    return cmd_parts
+
+
+def get_segment_plan(duration, cpu_count=None):
+    """Returns (segment_count, worker_count) for a segment-parallel encode of a source of this duration."""
+    cpu_count = cpu_count or os.cpu_count() or 1
+    workers = max(1, cpu_count // THREADS_PER_SEGMENT)
+    if not duration or workers < 2:
+        return 1, 1
+
+    # Two segments per worker keeps the pool busy when some segments encode faster than others.
+    segments = min(workers * 2, int(duration // MIN_SEGMENT_DURATION))
+    if segments < 2:
+        return 1, 1
+    return segments, min(workers, segments)
+
+
+# Stream-copy fast path: encoder name -> codec name ffprobe reports for its output,
+# and the pixel formats the `high`/`main` profiles we encode with can carry.
+CODEC_FAMILIES = {"libx264": "h264", "h264_nvenc": "h264", "libx265": "hevc", "hevc_nvenc": "hevc"}
+COPYABLE_PIX_FMTS = {"yuv420p", "yuvj420p"}
+# Rough libx264 output at CRF 23 in bits per pixel; every 6 CRF steps halves or doubles it,
+# and HEVC gets to the same quality in roughly 60% of the bits.
+CRF23_BITS_PER_PIXEL = 0.1
+HEVC_BITRATE_FACTOR = 0.6
+
+
+def parse_rate(value):
+    """Parses an ffprobe rate ("30000/1001", "25") or bitrate ("192k") into a float, 0 if unknown."""
+    try:
+        value = str(value).strip().lower()
+        if "/" in value:
+            num, den = value.split("/", 1)
+            return float(num) / float(den) if float(den) else 0.0
+        multiplier = {"k": 1000, "m": 1000 ** 2}.get(value[-1:], 1)
+        return float(value.rstrip("km")) * multiplier
+    except (ValueError, IndexError):
+        return 0.0
+
+
+def estimate_crf_bitrate(width, height, fps, crf, v_codec):
+    """Ballpark video bitrate (bit/s) the encoder would produce at this CRF for a picture of this size."""
+    bits_per_pixel = CRF23_BITS_PER_PIXEL * 2 ** ((23 - crf) / 6)
+    if CODEC_FAMILIES.get(v_codec) == "hevc":
+        bits_per_pixel *= HEVC_BITRATE_FACTOR
+    return bits_per_pixel * width * height * fps
+
+
+async def probe_source(path):
+    """Parsed ffprobe JSON (format + streams) of path from the shared probe cache, or None."""
+    probe = await probe_cache.get(path)
+    return probe.data if probe else None
+
+
+def plan_stream_copy(probe, compression_settings, watermark_enabled=False):
+    """Decides from an ffprobe result whether re-encoding can gain anything; returns (mode, reason)."""
+    # mode is "encode", "copy_video" (copy video, transcode audio) or "remux" (copy everything)
+    if not probe:
+        return "encode", "source could not be probed"
+    streams = probe.get("streams", [])
+    video = next((s for s in streams if s.get("codec_type") == "video" and not s.get("disposition", {}).get("attached_pic")), None)
+    audio = next((s for s in streams if s.get("codec_type") == "audio"), None)
+    if video is None:
+        return "encode", "no video stream found"
+
+    v_codec = compression_settings.get("v_codec", "libx264")
+    v_scale = compression_settings.get("v_scale", 1080)
+    v_fps = compression_settings.get("v_fps", 30)
+    v_qp = compression_settings.get("v_qp", 26)
+    target_family = CODEC_FAMILIES.get(v_codec)
+    source_codec = video.get("codec_name", "unknown")
+    width, height = int(video.get("width") or 0), int(video.get("height") or 0)
+    fps = parse_rate(video.get("avg_frame_rate")) or parse_rate(video.get("r_frame_rate"))
+
+    if watermark_enabled:
+        return "encode", "watermark needs a re-encode"
+    if source_codec != target_family:
+        return "encode", f"source is {source_codec}, target is {target_family or v_codec}"
+    if video.get("pix_fmt") not in COPYABLE_PIX_FMTS:
+        return "encode", f"source pixel format {video.get('pix_fmt')} is not 8-bit 4:2:0"
+    if v_scale != -1 and height > v_scale:
+        return "encode", f"source is {height}p, target is {v_scale}p"
+    if fps > v_fps + 0.5:
+        return "encode", f"source is {fps:.2f} fps, target is {v_fps} fps"
+
+    video_bitrate = parse_rate(video.get("bit_rate"))
+    if not video_bitrate:
+        # Matroska usually only stores the overall bitrate
+        audio_bitrate = parse_rate(audio.get("bit_rate")) if audio else 0
+        video_bitrate = parse_rate(probe.get("format", {}).get("bit_rate")) - audio_bitrate
+    if video_bitrate <= 0 or not width or not height or not fps:
+        return "encode", "source bitrate unknown"
+    expected_bitrate = estimate_crf_bitrate(width, height, fps, v_qp, v_codec)
+    if video_bitrate > expected_bitrate:
+        return "encode", f"source video {video_bitrate / 1000:.0f} kb/s, CRF {v_qp} would give ~{expected_bitrate / 1000:.0f} kb/s"
+
+    reason = f"source is already {source_codec} {height}p at {video_bitrate / 1000:.0f} kb/s (CRF {v_qp} ≈ {expected_bitrate / 1000:.0f} kb/s)"
+    target_audio_bitrate = parse_rate(compression_settings.get("a_bitrate", "192k"))
+    if audio is None or (audio.get("codec_name") == "aac" and 0 < parse_rate(audio.get("bit_rate")) <= target_audio_bitrate):
+        return "remux", reason
+    return "copy_video", f"{reason}; audio is {audio.get('codec_name')}, transcoding to AAC"
+
+
+def build_copy_command(input_path, out, compression_settings, copy_audio):
+    """Builds the FFmpeg command (list of shell-quoted parts) that remuxes input_path into out without touching the video."""
+    a_bitrate = compression_settings.get("a_bitrate", "192k")
+    cmd_parts = [
+        'ffmpeg', '-y', '-hide_banner', '-loglevel', 'error', '-progress', 'pipe:2', '-nostats',
+        '-i', f'"{input_path}"', '-map', '0:v:0', '-map', '0:a:0?', '-c:v', 'copy'
+    ]
+    if copy_audio:
+        cmd_parts.extend(['-c:a', 'copy'])
+    else:
+        cmd_parts.extend(['-c:a', 'aac', '-b:a', a_bitrate])
+    cmd_parts.extend(['-movflags', '+faststart', f'"{out}"'])
+    return cmd_parts
+
+
+def get_size_budget(compression_settings, output_settings):
+    """Output size budget in bytes for target-size mode (0 = CRF mode), never above max_file_size."""
+    target_size = int(compression_settings.get("target_size") or 0)
+    if not target_size:
+        return 0
+    return min(target_size, output_settings.get("max_file_size", 4000)) * 1024 * 1024
+
+
+def compute_video_bitrate(size_budget, duration, a_bitrate, has_audio=True):
+    """Average video bitrate (bit/s) that fits size_budget bytes over duration seconds next to the audio."""
+    total_bitrate = size_budget * 8 * (1 - CONTAINER_OVERHEAD) / duration
+    audio_bitrate = parse_rate(a_bitrate) if has_audio else 0
+    return int(total_bitrate - audio_bitrate)
+
+
+async def encode_to_size(dl, out, compression_settings, user_id: int, duration: float, size_budget: int,
+                         has_audio=True, on_progress=None):
+    """Encodes dl to fit size_budget bytes; returns (returncode, stderr_output, video_bitrate)."""
+    work_dir = job_temp_dir(dl)
+    os.makedirs(work_dir, exist_ok=True)
+    passlog = os.path.join(work_dir, "passlog")
+    # NVENC gets one capped-VBV pass, libx264/libx265 two passes
+    passes = [None] if '_nvenc' in compression_settings.get("v_codec", "libx264") else [1, 2]
+    video_bitrate = compute_video_bitrate(size_budget, duration, compression_settings.get("a_bitrate", "192k"), has_audio)
+    stderr_output = ""
+
+    def pass_progress(index):
+        # Report both passes as one run over the source: out_time and speed are scaled so
+        # the percentage and ETA cover the whole job.
+        async def report(stats):
+            if not on_progress:
+                return
+            out_time, _, speed, _ = parse_ffmpeg_progress(stats)
+            stats = dict(stats, out_time_us=str(int((index * duration + out_time) / len(passes) * 1_000_000)))
+            stats["speed"] = f"{speed / len(passes)}x"
+            if index < len(passes) - 1:
+                stats["progress"] = "continue"
+            await on_progress(stats)
+        return report
+
+    try:
+        for attempt in range(TARGET_SIZE_ATTEMPTS):
+            if video_bitrate < MIN_VIDEO_BITRATE:
+                return 1, f"Target size {hbs(size_budget)} is too small for {ts(duration * 1000)} of video", video_bitrate
+
+            for index, pass_number in enumerate(passes):
+                cmd = ' '.join(build_encode_command(
+                    dl, out, compression_settings, user_id, audio=has_audio,
+                    video_bitrate=video_bitrate, pass_number=pass_number, passlog=passlog
+                ))
+                LOGS.info(f"Executing FFmpeg command: {cmd}")
+                returncode, stderr_output = await run_encoder(cmd, dl, on_progress=pass_progress(index))
+                if returncode != 0:
+                    return returncode, stderr_output, video_bitrate
+
+            out_size = os.path.getsize(out)
+            if out_size <= size_budget:
+                return 0, stderr_output, video_bitrate
+            LOGS.warning(f"{out} came out at {hbs(out_size)}, over the {hbs(size_budget)} budget (attempt {attempt + 1})")
+            # Still too big: try again at a proportionally lower bitrate
+            video_bitrate = int(video_bitrate * size_budget / out_size * TARGET_RETRY_MARGIN)
+
+        return 1, f"Output is still {hbs(out_size)}, over the {hbs(size_budget)} budget", video_bitrate
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+# Auto quality: sample this many short clips, spend at most this share of the full encode's
+# work on them, and search CRFs from 4 below to 8 above the configured v_qp.
+AUTO_CRF_SAMPLES = 3
+AUTO_CRF_SAMPLE_SECONDS = 2
+AUTO_CRF_BUDGET = 0.05
+AUTO_CRF_RANGE = (-4, 8)
+DEFAULT_QUALITY_FLOORS = {"ssim": 0.98, "psnr": 40.0}
+METRIC_SCORE = {"ssim": re.compile(r"All:([0-9.]+)"), "psnr": re.compile(r"average:([0-9.]+|inf)")}
+
+
+def get_auto_crf_candidates(v_qp, duration):
+    """CRFs to try around v_qp whose samples fit in AUTO_CRF_BUDGET of the duration; empty if fewer than two fit."""
+    low, high = AUTO_CRF_RANGE
+    ladder = list(range(max(0, v_qp + low), min(51, v_qp + high) + 1, 2))
+    # Samples and the full encode use the same settings, so seconds of video stand in for encode time
+    count = min(len(ladder), int(duration * AUTO_CRF_BUDGET // (AUTO_CRF_SAMPLES * AUTO_CRF_SAMPLE_SECONDS)))
+    if count < 2:
+        return []
+    # Keep both ends of the ladder and spread the rest evenly between them
+    step = (len(ladder) - 1) / (count - 1)
+    return sorted({ladder[round(i * step)] for i in range(count)})
+
+
+async def measure_sample_quality(dl, sample, start, crf, compression_settings, metric):
+    """Encodes AUTO_CRF_SAMPLE_SECONDS of dl from start at crf and returns its SSIM/PSNR against the source, or None."""
+    v_scale = compression_settings.get("v_scale", 1080)
+    scale = f"scale=-2:{v_scale}:force_original_aspect_ratio=decrease," if v_scale != -1 else ""
+    clip = ['-ss', f'{start:.3f}', '-t', str(AUTO_CRF_SAMPLE_SECONDS), '-i', f'"{dl}"']
+
+    encode_cmd = [
+        'ffmpeg', '-y', '-hide_banner', '-loglevel', 'error', *clip,
+        '-vf', f'"{scale}format=yuv420p"', '-c:v', compression_settings.get("v_codec", "libx264"),
+        '-preset', compression_settings.get("v_preset", "medium"), '-crf', str(crf),
+        '-threads', str(THREADS_PER_SEGMENT), '-an', f'"{sample}"'
+    ]
+    returncode, stderr_output = await run_encoder(' '.join(encode_cmd), dl)
+    if returncode != 0:
+        LOGS.warning(f"Auto quality sample at CRF {crf} failed: {stderr_output[:500]}")
+        return None
+
+    # The metric filters print their summary at info level
+    metric_cmd = [
+        'ffmpeg', '-hide_banner', '-nostats', '-i', f'"{sample}"', *clip,
+        '-lavfi', f'"[0:v]format=yuv420p[dist];[1:v]{scale}format=yuv420p[ref];[dist][ref]{metric}"',
+        '-f', 'null', '-'
+    ]
+    returncode, stderr_output = await run_encoder(' '.join(metric_cmd), dl)
+    match = METRIC_SCORE[metric].search(stderr_output)
+    if returncode != 0 or not match:
+        LOGS.warning(f"Auto quality {metric} measurement at CRF {crf} failed: {stderr_output[-500:]}")
+        return None
+    return 100.0 if match.group(1) == "inf" else float(match.group(1))
+
+
+async def pick_auto_crf(dl, compression_settings, duration):
+    """Highest CRF whose sample clips meet the quality floor, as a dict (crf, score, metric, floor, elapsed), or None."""
+    metric = compression_settings.get("auto_quality_metric", "ssim")
+    metric = metric if metric in METRIC_SCORE else "ssim"
+    floor = float(compression_settings.get("auto_quality_floor") or DEFAULT_QUALITY_FLOORS[metric])
+    candidates = get_auto_crf_candidates(compression_settings.get("v_qp", 26), duration or 0)
+    if not candidates:
+        return None
+
+    started = time.time()
+    work_dir = job_temp_dir(dl)
+    os.makedirs(work_dir, exist_ok=True)
+    starts = [
+        max(0.0, duration * (i + 1) / (AUTO_CRF_SAMPLES + 1) - AUTO_CRF_SAMPLE_SECONDS / 2)
+        for i in range(AUTO_CRF_SAMPLES)
+    ]
+    workers = asyncio.Semaphore(max(1, (os.cpu_count() or 1) // THREADS_PER_SEGMENT))
+
+    async def score(crf, index, start):
+        async with workers:
+            sample = os.path.join(work_dir, f"crf{crf}_{index}.mkv")
+            return crf, await measure_sample_quality(dl, sample, start, crf, compression_settings, metric)
+
+    try:
+        results = await asyncio.gather(*[
+            score(crf, index, start) for crf in candidates for index, start in enumerate(starts)
+        ])
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+    averages = {}
+    for crf in candidates:
+        scores = [value for c, value in results if c == crf and value is not None]
+        if len(scores) == AUTO_CRF_SAMPLES:
+            averages[crf] = sum(scores) / len(scores)
+    if not averages:
+        return None
+
+    passing = [crf for crf, value in averages.items() if value >= floor]
+    # Nothing meets the floor: the content needs the most bits we were willing to spend
+    crf = max(passing) if passing else min(averages)
+    result = {"crf": crf, "score": averages[crf], "metric": metric, "floor": floor, "elapsed": time.time() - started}
+    LOGS.info(f"Auto quality for {dl}: {metric} by CRF {averages}, picked {result}")
+    return result
+
+
+async def encode_segmented(dl, out, compression_settings, user_id: int, duration: float, on_progress=None):
+    """Encodes keyframe-split segments concurrently, then joins them with the original audio; returns (returncode, stderr_output)."""
+    segment_count, workers = get_segment_plan(duration)
+    work_dir = job_temp_dir(dl)
+    os.makedirs(work_dir, exist_ok=True)
+    segment_time = duration / segment_count
+
+    try:
+        # 1. Split the video stream without re-encoding; cuts land on the next keyframe.
+        split_cmd = (
+            f"ffmpeg -y -hide_banner -loglevel error -i \"{dl}\" -map 0:v:0 -an -c copy "
+            f"-f segment -segment_time {segment_time:.3f} -reset_timestamps 1 "
+            f"\"{work_dir}/src_%03d.mkv\""
+        )
+        LOGS.info(f"Splitting {dl} into ~{segment_count} segments of {segment_time:.1f}s")
+        process = await asyncio.create_subprocess_shell(split_cmd, stderr=asyncio.subprocess.PIPE)
+        _, stderr = await process.communicate()
+        if process.returncode != 0:
+            return process.returncode, stderr.decode(errors='ignore')
+
+        sources = sorted(str(p) for p in Path(work_dir).glob("src_*.mkv"))
+        if not sources:
+            return 1, "Segmenter produced no output"
+
+        # 2. Encode every segment, at most `workers` FFmpeg processes at a time.
+        semaphore = asyncio.Semaphore(workers)
+        threads = max(1, (os.cpu_count() or 1) // workers)
+        failures = []
+        segment_stats = {}
+
+        # on_progress sees the segments' stats summed into one block
+        async def segment_progress(index, stats):
+            segment_stats[index] = parse_ffmpeg_progress(stats)
+            if on_progress:
+                out_time, fps, speed, total_size = (sum(values) for values in zip(*segment_stats.values()))
+                await on_progress({
+                    "out_time_us": out_time * 1_000_000, "fps": fps,
+                    "speed": speed, "total_size": total_size,
+                })
+
+        async def encode_segment(index, source):
+            async with semaphore:
+                if failures:
+                    return None
+                encoded = f"{work_dir}/enc_{index:03d}.mkv"
+                cmd = ' '.join(build_encode_command(source, encoded, compression_settings, user_id, audio=False, threads=threads))
+                returncode, stderr_output = await run_encoder(
+                    cmd, dl, on_progress=lambda stats: segment_progress(index, stats)
+                )
+                if returncode != 0:
+                    failures.append((returncode, stderr_output))
+                    return None
+                return encoded
+
+        LOGS.info(f"Encoding {len(sources)} segments with {workers} workers ({threads} threads each)")
+        encoded = await asyncio.gather(*[encode_segment(i, s) for i, s in enumerate(sources)])
+        if failures:
+            return failures[0]
+
+        # 3. Concatenate the encoded video and bring the original audio back in.
+        concat_file = f"{work_dir}/concat_list.txt"
+        with open(concat_file, 'w') as f:
+            for segment in encoded:
+                f.write(f"file '{os.path.abspath(segment)}'\n")
+
+        a_bitrate = compression_settings.get("a_bitrate", "192k")
+        concat_cmd = (
+            f"ffmpeg -y -hide_banner -loglevel error -f concat -safe 0 -i \"{concat_file}\" -i \"{dl}\" "
+            f"-map 0:v:0 -map 1:a:0? -c:v copy -c:a aac -b:a {a_bitrate} "
+            f"-movflags +faststart \"{out}\""
+        )
+        process = await asyncio.create_subprocess_shell(concat_cmd, stderr=asyncio.subprocess.PIPE)
+        _, stderr = await process.communicate()
+        return process.returncode, stderr.decode(errors='ignore')
+    finally:
+        shutil.rmtree(work_dir, ignore_errors=True)
+
+
+def is_streamable_container(head: bytes) -> bool:
+    """Whether FFmpeg can demux the source from a pipe, judged from its first bytes."""
+    if head[:4] == b"\x1a\x45\xdf\xa3":  # Matroska / WebM
+        return True
+    if head[:3] == b"FLV":
+        return True
+    if head[:1] == b"\x47" and head[188:189] == b"\x47":  # MPEG-TS sync bytes
+        return True
+    if head[4:8] != b"ftyp":
+        return False
+
+    # MP4/MOV only qualify when the moov atom comes before mdat
+    offset = 0
+    while offset + 8 <= len(head):
+        size = int.from_bytes(head[offset:offset + 4], "big")
+        box = head[offset + 4:offset + 8]
+        if box == b"moov":
+            return True
+        if box == b"mdat":
+            return False
+        if size == 1:  # 64-bit box size follows the type
+            if offset + 16 > len(head):
+                return False
+            size = int.from_bytes(head[offset + 8:offset + 16], "big")
+        if size < 8:  # size 0 means "to the end of the file"
+            return False
+        offset += size
+    return False
+
+
+async def _prepend_chunk(head, chunks, on_done=None):
+    """Re-attach an already consumed first chunk to a download stream; on_done runs once the stream ends or is closed."""
+    try:
+        yield head
+        async for chunk in chunks:
+            yield chunk
+    finally:
+        await chunks.aclose()
+        if on_done:
+            on_done()
+
+
+async def tail_file(path, finished: asyncio.Event, chunk_size=1024 * 1024, poll_interval=0.5):
+    """Yield the bytes of a file that is still being written until `finished` is set and EOF is reached."""
+    while not os.path.exists(path):
+        if finished.is_set():
+            return
+        await asyncio.sleep(poll_interval)
+    with open(path, "rb") as f:
+        while True:
+            data = f.read(chunk_size)
+            if data:
+                yield data
+            elif finished.is_set():
+                # Whatever was flushed before `finished` was set is readable now
+                data = f.read()
+                if data:
+                    yield data
+                return
+            else:
+                await asyncio.sleep(poll_interval)
+
+
+async def run_encoder(cmd, dl, source=None, keep_source=True, output=None, output_done=None, on_progress=None):
+    """Run one FFmpeg command, optionally fed from source and writing to output; returns (returncode, stderr_output)."""
+    process = await asyncio.create_subprocess_shell(
+        cmd,
+        stdin=asyncio.subprocess.PIPE if source is not None else None,
+        stdout=asyncio.subprocess.PIPE if output else None,
+        stderr=asyncio.subprocess.PIPE,
+    )
+    bot_state.register_process(dl, process)
+
+    # source is piped into stdin (pipe:0); with keep_source it is also kept in dl
+    async def feed():
+        fd = os.open(dl, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644) if keep_source else None
+        mirror, offset = None, 0
+        try:
+            mirror = DiskWriter(fd, label=dl) if keep_source else None
+            async for chunk in source:
+                if mirror:
+                    await mirror.write(offset, chunk)
+                    offset += len(chunk)
+                process.stdin.write(chunk)
+                await process.stdin.drain()
+        except (BrokenPipeError, ConnectionResetError):
+            LOGS.warning(f"FFmpeg closed its input early while streaming {dl}")
+        finally:
+            await source.aclose()
+            process.stdin.close()
+            try:
+                if mirror:
+                    await mirror.close()
+            finally:
+                if fd is not None:
+                    os.close(fd)
+
+    # stdout (pipe:1) goes to output; output_done tells tail_file the last byte is on disk
+    async def write_output():
+        fd = os.open(output, os.O_WRONLY | os.O_CREAT | os.O_TRUNC, 0o644)
+        offset = 0
+        try:
+            # Read back right away by tail_file and the upload, so not worth an fsync
+            writer = DiskWriter(fd, label=output, sync=False)
+            try:
+                while True:
+                    chunk = await process.stdout.read(1024 * 1024)
+                    if not chunk:
+                        break
+                    await writer.write(offset, chunk)
+                    offset += len(chunk)
+            finally:
+                await writer.close()
+        finally:
+            os.close(fd)
+            if output_done:
+                output_done.set()
+
+    async def read_stderr():
+        log_lines, block = [], {}
+        reporting = None
+        while True:
+            line = await process.stderr.readline()
+            if not line:
+                break
+            text = line.decode(errors='ignore').rstrip()
+            if PROGRESS_LINE.match(text):
+                key, _, value = text.partition("=")
+                block[key] = value
+                if key == "progress":
+                    # Skipped while the last report runs, so a slow Telegram edit never stalls stderr
+                    if on_progress and (reporting is None or reporting.done()):
+                        reporting = asyncio.create_task(on_progress(block))
+                    block = {}
+            elif text:
+                log_lines.append(text)
+        if reporting:
+            await reporting
+        return "\n".join(log_lines)
+
+    feeder = asyncio.create_task(feed()) if source is not None else None
+    writer = asyncio.create_task(write_output()) if output else None
+    try:
+        stderr_output = await read_stderr()
+        await process.wait()
+        if writer:
+            await writer
+    finally:
+        bot_state.unregister_process(dl, process)
+        if feeder and process.returncode != 0 and not feeder.done():
+            feeder.cancel()
+
+    if feeder:
+        try:
+            await feeder
+        except asyncio.CancelledError:
+            pass
+        except Exception as e:
+            # FFmpeg treats a broken download as a normal EOF, so a truncated source must fail here.
+            LOGS.error(f"Source stream failed for {dl}: {e}", exc_info=True)
+            return 1, f"Source stream failed: {e}"
+    return process.returncode, stderr_output
+
+
+async def finish_overlapped_upload(upload_task, encode_succeeded):
+    """Wait for an upload_stream run alongside the encoder; returns its InputFile, or None to upload the regular way."""
+    if not encode_succeeded:
+        upload_task.cancel()
+        try:
+            await upload_task
+        except BaseException:
+            pass
+        return None
+    try:
+        uploaded_file, uploaded_size = await upload_task
+    except Exception as e:
+        LOGS.error(f"Overlapped upload failed, falling back to a regular upload: {e}", exc_info=True)
+        return None
+    # Files under 10 MB can't be sent as big-file parts
+    if uploaded_size <= BIG_FILE_THRESHOLD:
+        return None
+    return uploaded_file
+
+
+async def send_cached_result(event, status_message, cache_key):
+    """Re-sends the cached output for cache_key instead of running the job. Returns True on a hit."""
+    hit = await result_cache.send(event.client, event.chat_id, cache_key)
+    if not hit:
+        return False
+    message, entry = hit
+    LOGS.info(f"Result cache hit for {cache_key}")
+    await status_message.delete()
+    encoded_at = datetime.fromtimestamp(entry["created"]).strftime("%Y-%m-%d %H:%M")
+    await message.reply(f"♻️ **Served from cache** (encoded {encoded_at})\n\n{entry['stats']}", link_preview=False)
+    return True
+
+
+async def process_compression(event, dl, start_time, user_id: int, source=None, keep_source=True, source_size=None,
+                              cache_key=None, source_id=None):
     """Main compression logic with dynamic command building, watermarking, and renaming."""
     out = None
-    process = None
+    successful_compression = False
     try:
         compress_start_time = datetime.now()
         original_name = Path(dl).stem
-        os.makedirs("encode/", exist_ok=True)
+        # Named like the job's download directory, which no other running job shares
+        out_dir = os.path.join("encode", Path(dl).parent.name)
+        os.makedirs(out_dir, exist_ok=True)
 
         # Get dynamic settings for this user
         compression_settings = settings_manager.get_active_compression_settings(user_id)
@@ -85,12 +775,27 @@ async def process_compression(event, dl, start_time, user_id: int):
         }
         new_filename_base = filename_template.format(**filename_map)
         sanitized_filename = re.sub(r'[\\/*?:"<>|]', "", new_filename_base)
-        out = f"encode/{sanitized_filename}.{output_format}"
+        out = os.path.join(out_dir, f"{sanitized_filename}.{output_format}")
         
         dtime = ts(int((compress_start_time - start_time).total_seconds()) * 1000)
 
         wah = code(f"{out};{dl};{event.id}")
 
+        # The same output name can come from other settings or another source with the same name
+        upload_origin = result_cache.make_key(source_id, user_id) if source_id else None
+
+        # An earlier run already produced this output and died mid-upload: send the rest instead of re-encoding
+        if source is None and upload_origin and has_pending_upload(out, upload_origin):
+            LOGS.info(f"Found an interrupted upload of {out}, resuming it")
+            successful_compression = True
+            await event.edit(f"`📥 Downloaded in {dtime}`\n`♻️ Resuming the upload of an earlier encode...`")
+            return await deliver_output(event, dl, out, dtime, compress_start_time, user_id, source_size,
+                                        copy_reason="resumed an interrupted upload of an earlier encode",
+                                        cache_key=cache_key, upload_origin=upload_origin)
+        if has_pending_upload(out):
+            LOGS.info(f"Interrupted upload of {out} was for another source or settings, encoding again")
+            forget_upload(out)
+
         # Enhanced compression status with more details
         gpu_info = f"🚀 {GPU_TYPE.upper()}" if GPU_TYPE != "cpu" else "💻 CPU"
         codec_info = v_codec.replace('_nvenc', ' (HW)').replace('lib', '').upper()
@@ -98,118 +803,172 @@ async def process_compression(event, dl, start_time, user_id: int):
         advanced_settings = settings_manager.get_setting("advanced_settings", user_id=user_id)
         watermark_enabled = advanced_settings.get("watermark_enabled", False)
 
-        status_parts = [f"📥 Downloaded in {dtime}", f"🔄 Compressing with {codec_info}", f"⚙️ Engine: {gpu_info}"]
+        # Pre-flight: skip the re-encode when the source already meets the target.
+        # A streamed source can't be probed before FFmpeg starts reading it.
+        copy_mode, copy_reason, probe = "encode", None, None
+        if advanced_settings.get("stream_copy", True) and source is None:
+            probe = await probe_source(dl)
+            copy_mode, copy_reason = plan_stream_copy(probe, compression_settings, watermark_enabled)
+            LOGS.info(f"Stream copy decision for {dl}: {copy_mode} ({copy_reason})")
+
+        # Target-size mode spends a bitrate budget instead of a CRF; it needs two passes over a file on disk
+        size_budget = get_size_budget(compression_settings, output_settings)
+        if size_budget and copy_mode != "encode" and os.path.getsize(dl) > size_budget:
+            copy_mode, copy_reason = "encode", f"source is {hbs(os.path.getsize(dl))}, over the {hbs(size_budget)} target"
+        target_mode = bool(size_budget) and copy_mode == "encode" and source is None
+        has_audio = not probe or any(s.get("codec_type") == "audio" for s in probe.get("streams", []))
+
+        # Segment-parallel mode only helps software encoders; NVENC is already bound by the GPU.
+        # It also needs the whole file on disk, so it never applies to a streamed source.
+        parallel_encoding = (
+            advanced_settings.get("parallel_encoding", False) and '_nvenc' not in v_codec
+            and source is None and copy_mode == "encode" and not target_mode
+        )
+        segment_count = 1
+        if parallel_encoding:
+            duration = await get_video_duration(dl)
+            segment_count, _ = get_segment_plan(duration)
+        overlap_upload = (
+            advanced_settings.get("overlap_upload", False) and segment_count == 1
+            and copy_mode == "encode" and not target_mode
+        )
+
+        # Percentages are relative to the source duration, which a streamed source can't tell us yet
+        if probe and probe.get("format", {}).get("duration"):
+            duration = parse_rate(probe["format"]["duration"])
+        elif not parallel_encoding:
+            duration = await get_video_duration(dl) if source is None else None
+
+        buttons = [[Button.inline("📊 STATS", data=f"stats{wah}"), Button.inline("❌ CANCEL", data=f"skip{wah}")]]
+
+        # Per-title CRF from sampled clips; NVENC ignores -crf and target mode spends a bitrate instead
+        auto_crf = None
+        if (compression_settings.get("auto_quality", False) and copy_mode == "encode" and not target_mode
+                and '_nvenc' not in v_codec and source is None and duration):
+            await event.edit(f"`📥 Downloaded in {dtime}`\n`🤖 Sampling clips to pick the quality...`", buttons=buttons)
+            scheduler = bot_state.scheduler
+            async with scheduler.slot(scheduler.encode_pool(v_codec), Path(dl).name):
+                auto_crf = await pick_auto_crf(dl, compression_settings, duration)
+            if auto_crf:
+                compression_settings = dict(compression_settings, v_qp=auto_crf["crf"])
+                quality_note = (
+                    f"auto CRF {auto_crf['crf']} ({auto_crf['metric'].upper()} {auto_crf['score']:.3f}, "
+                    f"floor {auto_crf['floor']}, sampled in {auto_crf['elapsed']:.0f}s)"
+                )
+                copy_reason = f"{copy_reason}; {quality_note}" if copy_reason else quality_note
+
+        if source is not None:
+            dtime = "streamed"
+            status_parts = ["📡 Streaming from Telegram", f"🔄 Compressing with {codec_info}", f"⚙️ Engine: {gpu_info}"]
+        elif copy_mode != "encode":
+            action = "Remuxing" if copy_mode == "remux" else "Copying video, encoding audio"
+            status_parts = [f"📥 Downloaded in {dtime}", f"⚡ {action}", f"💡 {copy_reason}"]
+        else:
+            status_parts = [f"📥 Downloaded in {dtime}", f"🔄 Compressing with {codec_info}", f"⚙️ Engine: {gpu_info}"]
         if watermark_enabled:
             status_parts.append(f"🏷️ Adding watermark")
-        if v_scale > 0:
+        if v_scale > 0 and copy_mode == "encode":
             status_parts.append(f"📐 Target: {v_scale}p")
+        if target_mode:
+            status_parts.append(f"🎯 Target size: {hbs(size_budget)}")
+        if auto_crf:
+            status_parts.append(f"🤖 Auto CRF {auto_crf['crf']} ({auto_crf['metric'].upper()} {auto_crf['score']:.3f})")
+        if segment_count > 1:
+            status_parts.append(f"🧩 Parallel: {segment_count} segments")
+        if overlap_upload:
+            status_parts.append("📤 Uploading while encoding")
 
         status_msg = "\n".join([f"`{part}`" for part in status_parts])
 
-        await event.edit(
-            status_msg,
-            buttons=[[Button.inline("📊 STATS", data=f"stats{wah}"), Button.inline("❌ CANCEL", data=f"skip{wah}")]]
-        )
-
-        # Determine if the codec is hardware-accelerated
-        is_hardware_codec = '_nvenc' in v_codec
-        enable_hardware_acceleration = compression_settings.get("enable_hardware_acceleration", True)
-
-        # FFmpeg Command Builder
-        cmd_parts = ['ffmpeg', '-y', '-hide_banner', '-loglevel', 'error']
-
-        # Get all needed settings
-        v_profile = compression_settings.get("v_profile", "high")
-        v_level = compression_settings.get("v_level", "4.0")
-        v_qp = compression_settings.get("v_qp", 26)
-        v_fps = compression_settings.get("v_fps", 30)
-        a_bitrate = compression_settings.get("a_bitrate", "192k")
-
-        # Input options (before -i)
-        if GPU_TYPE == "nvidia" and enable_hardware_acceleration and is_hardware_codec:
-            cmd_parts.extend(['-hwaccel', 'cuda', '-hwaccel_output_format', 'cuda'])
+        await event.edit(status_msg, buttons=buttons)
 
-        # Input file
-        cmd_parts.extend(['-i', f'"{dl}"'])
+        async def on_progress(stats):
+            out_time, fps, speed, total_size = parse_ffmpeg_progress(stats)
+            await encode_progress(
+                out_time, fps, speed, total_size, duration, event, status_msg,
+                buttons=buttons, done=stats.get("progress") == "end"
+            )
 
-        # Output options (after -i, before output file)
-        filters = []
-        if v_scale != -1:
-            if GPU_TYPE == "nvidia" and enable_hardware_acceleration and is_hardware_codec:
-                filters.append(f'scale_cuda=-2:{v_scale}')
+        uploaded_file = None
+        scheduler = bot_state.scheduler
+        async with scheduler.slot(scheduler.encode_pool(v_codec), Path(dl).name):
+            if copy_mode != "encode":
+                cmd = ' '.join(build_copy_command(dl, out, compression_settings, copy_audio=copy_mode == "remux"))
+                LOGS.info(f"Executing FFmpeg command: {cmd}")
+                returncode, stderr_output = await run_encoder(cmd, dl, on_progress=on_progress)
+            elif target_mode and not duration:
+                returncode, stderr_output = 1, "Target size needs the source duration, which could not be read"
+            elif target_mode:
+                returncode, stderr_output, video_bitrate = await encode_to_size(
+                    dl, out, compression_settings, user_id, duration, size_budget, has_audio, on_progress
+                )
+                size_note = f"sized to fit {hbs(size_budget)} at {video_bitrate / 1000:.0f} kb/s"
+                copy_reason = f"{copy_reason}; {size_note}" if copy_reason else size_note
+            elif segment_count > 1:
+                returncode, stderr_output = await encode_segmented(dl, out, compression_settings, user_id, duration, on_progress)
             else:
-                filters.append(f'scale=-2:{v_scale}:force_original_aspect_ratio=decrease')
-
-        if watermark_enabled:
-            watermark_filter = get_watermark_filter(user_id)
-            if watermark_filter:  # Only add if watermark filter is valid
-                if GPU_TYPE == "nvidia" and enable_hardware_acceleration and is_hardware_codec:
-                    # For hardware acceleration, we need to download from GPU, apply watermark, then upload back
-                    filters.append(f'hwdownload,format=nv12,{watermark_filter},hwupload_cuda')
+                # A streamed source (async iterator of bytes) is read from stdin while it downloads
+                input_path = "pipe:0" if source is not None else dl
+                cmd = ' '.join(build_encode_command(input_path, out, compression_settings, user_id, to_pipe=overlap_upload))
+                LOGS.info(f"Executing FFmpeg command: {cmd}")
+                if overlap_upload:
+                    # Upload finished parts of the output while FFmpeg is still producing it
+                    async with scheduler.slot("upload", Path(out).name):
+                        encoded = asyncio.Event()
+                        upload_task = asyncio.create_task(upload_stream(event.client, tail_file(out, encoded), Path(out).name))
+                        returncode, stderr_output = await run_encoder(
+                            cmd, dl, source, keep_source, output=out, output_done=encoded, on_progress=on_progress
+                        )
+                        uploaded_file = await finish_overlapped_upload(upload_task, returncode == 0)
                 else:
-                    # For software encoding, apply watermark directly
-                    filters.append(watermark_filter)
-
-        if filters:
-            cmd_parts.extend(['-vf', f'"{",".join(filters)}"'])
+                    returncode, stderr_output = await run_encoder(cmd, dl, source, keep_source, on_progress=on_progress)
+
+        # A CRF encode (or remux) can still overshoot the upload limit; redo it on a bitrate
+        # budget here rather than leaving the job to be re-run by hand.
+        # A streamed source only has a duration once it is on disk, and may not have been kept at all.
+        max_size = output_settings.get("max_file_size", 4000) * 1024 * 1024
+        if (returncode == 0 and not target_mode
+                and os.path.exists(out) and os.path.getsize(out) > max_size):
+            oversize = f"Output is {hbs(os.path.getsize(out))}, over max_file_size ({hbs(max_size)})"
+            uploaded_file = None
+            if not os.path.exists(dl):
+                returncode, stderr_output = 1, f"{oversize}, and the streamed source was not kept to re-encode it"
+            else:
+                if source is not None:
+                    probe = await probe_source(dl)
+                    has_audio = not probe or any(s.get("codec_type") == "audio" for s in probe.get("streams", []))
+                duration = duration or await get_video_duration(dl) or await get_video_duration(out)
+                if not duration:
+                    returncode, stderr_output = 1, f"{oversize}, and its duration could not be read to re-encode it"
+            if returncode == 0:
+                LOGS.warning(f"{out}: {oversize}; re-encoding to fit")
+                await event.edit(f"{status_msg}\n`🎯 Output over {hbs(max_size)}, re-encoding to fit`", buttons=buttons)
+                async with scheduler.slot(scheduler.encode_pool(v_codec), Path(dl).name):
+                    returncode, stderr_output, video_bitrate = await encode_to_size(
+                        dl, out, compression_settings, user_id, duration, max_size, has_audio, on_progress
+                    )
+                copy_mode = "encode"
+                copy_reason = f"first encode was over {hbs(max_size)}; re-encoded at {video_bitrate / 1000:.0f} kb/s to fit"
+            else:
+                LOGS.error(f"{out}: {stderr_output}")
 
-        # Encoding parameters with custom settings
-        cmd_parts.extend([
-            '-c:v', v_codec,          # libx265
-            '-preset', v_preset,      # p3
-            '-profile:v', v_profile,  # high
-            '-level:v', v_level,
-            '-crf', str(v_qp),        # 26
-            '-r', str(v_fps),         # 120
-            '-c:a', 'aac',
-            '-b:a', a_bitrate,        # 384k
-            '-movflags', '+faststart',
-            f'"{out}"'
-        ])
-        
-        cmd = ' '.join(cmd_parts)
-        LOGS.info(f"Executing FFmpeg command: {cmd}")
-        process = await asyncio.create_subprocess_shell(cmd, stderr=asyncio.subprocess.PIPE)
-        _, stderr = await process.communicate()
-        
-        stderr_output = stderr.decode(errors='ignore')
-        if process.returncode != 0:
+        successful_compression = returncode == 0
+        if returncode != 0:
             error_message = f"❌ **COMPRESSION ERROR**\n`{stderr_output[:3500]}`"
             return await event.edit(error_message)
         
         if not os.path.exists(out) or os.path.getsize(out) == 0:
             return await event.edit(f"❌ **COMPRESSION FAILED**\nOutput file not created or empty.\n\n**FFmpeg Logs:**\n`{stderr_output[:3000]}`")
         
-        # Generate thumbnail, preview, and screenshots
-        thumbnail_path = await generate_thumbnail(out, user_id)
-        preview_path, screenshots = None, []
-
-        preview_settings = settings_manager.get_setting("preview_settings", user_id=user_id)
-        enable_video_preview = preview_settings.get("enable_video_preview", False)
-        enable_screenshots = preview_settings.get("enable_screenshots", False)
-
-        LOGS.info(f"Preview settings - Video preview: {enable_video_preview}, Screenshots: {enable_screenshots}")
-
-        if enable_video_preview:
-            LOGS.info("Generating video preview...")
-            preview_path = await generate_preview(out, user_id)
-            LOGS.info(f"Preview generated: {preview_path}")
-
-        if enable_screenshots:
-            LOGS.info("Generating screenshots...")
-            screenshots = await generate_screenshots(out, user_id)
-            LOGS.info(f"Screenshots generated: {len(screenshots) if screenshots else 0} files")
-
-        await upload_compressed_file(event, dl, out, dtime, compress_start_time, preview_path, screenshots, thumbnail_path, user_id)
+        await deliver_output(event, dl, out, dtime, compress_start_time, user_id, source_size,
+                             uploaded_file, copy_mode, copy_reason, cache_key, upload_origin)
         
     except Exception as e:
         LOGS.error(f"Compression process error: {e}", exc_info=True)
         await event.edit(f"❌ **FATAL COMPRESSION ERROR**: `{str(e)}`")
     finally:
-        successful_compression = process and process.returncode == 0
-        
-        # Clean up output file
-        if out and os.path.exists(out) and validate_file_path(out):
+        # Clean up output file, unless a failed upload left parts on Telegram for a retry to resume
+        if out and os.path.exists(out) and validate_file_path(out) and not has_pending_upload(out):
             try:
                 os.remove(out)
             except OSError as e:
@@ -226,6 +985,32 @@ async def process_compression(event, dl, start_time, user_id: int):
                     LOGS.error(f"Failed to delete original file {dl}: {e}")
 
 
+async def deliver_output(event, dl, out, dtime, compress_start_time, user_id, source_size=None,
+                         uploaded_file=None, copy_mode="encode", copy_reason=None, cache_key=None,
+                         upload_origin=None):
+    """Generate the thumbnail, preview and screenshots for a finished output, then upload it"""
+    thumbnail_path = await generate_thumbnail(out, user_id)
+    preview_path, screenshots = None, []
+
+    preview_settings = settings_manager.get_setting("preview_settings", user_id=user_id)
+    enable_video_preview = preview_settings.get("enable_video_preview", False)
+    enable_screenshots = preview_settings.get("enable_screenshots", False)
+
+    LOGS.info(f"Preview settings - Video preview: {enable_video_preview}, Screenshots: {enable_screenshots}")
+
+    if enable_video_preview:
+        LOGS.info("Generating video preview...")
+        preview_path = await generate_preview(out, user_id)
+        LOGS.info(f"Preview generated: {preview_path}")
+
+    if enable_screenshots:
+        LOGS.info("Generating screenshots...")
+        screenshots = await generate_screenshots(out, user_id)
+        LOGS.info(f"Screenshots generated: {len(screenshots) if screenshots else 0} files")
+
+    return await upload_compressed_file(event, dl, out, dtime, compress_start_time, preview_path, screenshots, thumbnail_path, user_id, source_size, uploaded_file, copy_mode, copy_reason, cache_key, upload_origin)
+
+
 async def generate_preview(video_path, user_id: int = None):
     """Generate a preview compilation from multiple clips throughout the video"""
     try:
@@ -233,20 +1018,16 @@ async def generate_preview(video_path, user_id: int = None):
         total_preview_duration = preview_settings.get("preview_duration", 10)
         preview_quality = preview_settings.get("preview_quality", 28)
 
-        preview_output = f"encode/{Path(video_path).stem}_preview.mp4"
-        temp_dir = "temp/preview_clips"
+        preview_output = os.path.join(os.path.dirname(video_path), f"{Path(video_path).stem}_preview.mp4")
+        temp_dir = f"{job_temp_dir(video_path)}_preview"
         os.makedirs(temp_dir, exist_ok=True)
 
         # Get video duration first
-        duration_cmd = f"ffprobe -v error -show_entries format=duration -of default=noprint_wrappers=1:nokey=1 \"{video_path}\""
-        process = await asyncio.create_subprocess_shell(duration_cmd, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE)
-        stdout, stderr = await process.communicate()
-
-        if process.returncode != 0:
-            LOGS.error(f"Failed to get video duration for preview: {stderr.decode(errors='ignore')}")
+        duration = await get_video_duration(video_path)
+        if not duration:
+            LOGS.error(f"Failed to get video duration for preview: {video_path}")
             return None
 
-        duration = float(stdout.decode().strip())
         LOGS.info(f"Video duration: {duration:.2f} seconds")
 
         # Calculate clip parameters
@@ -334,15 +1115,11 @@ async def generate_screenshots(video_path, user_id: int = None):
         LOGS.info(f"Screenshot settings for user {user_id}: count={screenshot_count}, settings={preview_settings}")
 
         # Get video duration first
-        duration_cmd = f"ffprobe -v error -show_entries format=duration -of default=noprint_wrappers=1:nokey=1 \"{video_path}\""
-        process = await asyncio.create_subprocess_shell(duration_cmd, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE)
-        stdout, stderr = await process.communicate()
-
-        if process.returncode != 0:
-            LOGS.error(f"Failed to get video duration for screenshots: {stderr.decode(errors='ignore')}")
+        duration = await get_video_duration(video_path)
+        if not duration:
+            LOGS.error(f"Failed to get video duration for screenshots: {video_path}")
             return []
 
-        duration = float(stdout.decode().strip())
         LOGS.info(f"Generating {screenshot_count} screenshots from {duration:.2f}s video")
 
         # Calculate timestamps for screenshots (avoid first and last 5% of video)
@@ -359,7 +1136,7 @@ async def generate_screenshots(video_path, user_id: int = None):
 
         for i in range(screenshot_count):
             timestamp = start_offset + (interval * i) + (interval / 2)  # Take from middle of each interval
-            screenshot_path = f"encode/screenshot_{i+1}.jpg"
+            screenshot_path = os.path.join(os.path.dirname(video_path), f"{Path(video_path).stem}_screenshot_{i+1}.jpg")
 
             # Generate screenshot with good quality and reasonable size
             cmd = (f"ffmpeg -y -ss {timestamp} -i \"{video_path}\" -vframes 1 "
@@ -399,18 +1176,14 @@ async def generate_thumbnail(video_path, user_id: int = None):
         except:
             timestamp_seconds = 10  # Default to 10 seconds
 
-        thumb_path = "thumb.jpg"
+        thumb_path = f"thumb/{Path(video_path).parent.name}_{Path(video_path).stem}.jpg"
 
-        # If custom URL is provided, try to download it first
+        # If custom URL is provided, use the cached copy (fetched or revalidated as needed)
         if custom_url:
             try:
-                async with aiohttp.ClientSession() as session:
-                    async with session.get(custom_url) as response:
-                        if response.status == 200:
-                            with open(thumb_path, 'wb') as f:
-                                f.write(await response.read())
-                            LOGS.info(f"Custom thumbnail downloaded: {thumb_path}")
-                            return thumb_path
+                cached = await thumb_cache.get(custom_url)
+                if cached:
+                    return cached
             except Exception as e:
                 LOGS.error(f"Failed to download custom thumbnail: {e}")
                 # Fall back to auto-generation if custom URL fails
@@ -418,15 +1191,11 @@ async def generate_thumbnail(video_path, user_id: int = None):
         # Auto-generate thumbnail from video if no custom URL or custom URL failed
         if auto_generate or custom_url:  # Generate if auto_generate is True OR if custom URL failed
             # Get video duration first
-            duration_cmd = f"ffprobe -v error -show_entries format=duration -of default=noprint_wrappers=1:nokey=1 \"{video_path}\""
-            process = await asyncio.create_subprocess_shell(duration_cmd, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE)
-            stdout, _ = await process.communicate()
-
-            if process.returncode != 0:
+            duration = await get_video_duration(video_path)
+            if not duration:
                 LOGS.error("Failed to get video duration for thumbnail")
                 return None
 
-            duration = float(stdout.decode().strip())
             # Use the specified timestamp, but ensure it's not beyond video duration
             timestamp = min(timestamp_seconds, duration - 1)
 
@@ -452,57 +1221,37 @@ async def generate_thumbnail(video_path, user_id: int = None):
 
 async def get_video_duration(video_path):
     """Get video duration in seconds"""
-    try:
-        duration_cmd = f"ffprobe -v error -show_entries format=duration -of default=noprint_wrappers=1:nokey=1 \"{video_path}\""
-        process = await asyncio.create_subprocess_shell(duration_cmd, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE)
-        stdout, _ = await process.communicate()
-
-        if process.returncode == 0:
-            duration = float(stdout.decode().strip())
-            return duration
-        else:
-            LOGS.error("Failed to get video duration")
-            return None
-    except Exception as e:
-        LOGS.error(f"Error getting video duration: {e}", exc_info=True)
-        return None
+    probe = await probe_cache.get(video_path)
+    if probe and probe.duration:
+        return probe.duration
+    LOGS.error("Failed to get video duration")
+    return None
 
 
 async def get_video_metadata(video_path):
     """Get comprehensive video metadata (duration, width, height)"""
-    try:
-        # Get duration, width, and height in one command
-        metadata_cmd = (
-            f"ffprobe -v error -select_streams v:0 "
-            f"-show_entries stream=width,height:format=duration "
-            f"-of csv=p=0:s=, \"{video_path}\""
-        )
-        process = await asyncio.create_subprocess_shell(
-            metadata_cmd, stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE
-        )
-        stdout, stderr = await process.communicate()
-
-        if process.returncode == 0:
-            output = stdout.decode().strip()
-            # Output format: width,height,duration
-            parts = output.split(',')
-            if len(parts) >= 3:
-                width = int(parts[0]) if parts[0] else 0
-                height = int(parts[1]) if parts[1] else 0
-                duration = float(parts[2]) if parts[2] else 0.0
-                return {
-                    'width': width,
-                    'height': height,
-                    'duration': duration
-                }
-
-        LOGS.error(f"Failed to get video metadata: {stderr.decode(errors='ignore')}")
-        return None
-    except Exception as e:
-        LOGS.error(f"Error getting video metadata: {e}", exc_info=True)
+    probe = await probe_cache.get(video_path)
+    if probe is None:
+        LOGS.error(f"Failed to get video metadata for {video_path}")
         return None
+    # Piped Matroska output carries no duration (0.0)
+    return {
+        'width': probe.width,
+        'height': probe.height,
+        'duration': probe.duration
+    }
+
+async def upload_output(client, out, upload_name, status_message=None, upload_start_time=None, origin=None):
+    """Upload out in parallel parts, resuming parts acknowledged for the same origin (source and settings)"""
+    def on_progress(d, t):
+        if status_message is not None:
+            return progress(d, t, status_message, upload_start_time, "Uploading File", upload_name)
+    with open(out, "rb") as f:
+        return await upload_file(client=client, file=f, name=upload_name, progress_callback=on_progress,
+                                 resumable=True, origin=origin)
 
-async def upload_compressed_file(event, dl, out, dtime, compress_start_time, preview_path=None, screenshots=None, thumbnail_path=None, user_id=None):
+
+async def upload_compressed_file(event, dl, out, dtime, compress_start_time, preview_path=None, screenshots=None, thumbnail_path=None, user_id=None, source_size=None, uploaded_file=None, copy_mode="encode", copy_reason=None, cache_key=None, upload_origin=None):
     try:
         # Store user info before deleting event
         if user_id is None:
@@ -525,13 +1274,15 @@ async def upload_compressed_file(event, dl, out, dtime, compress_start_time, pre
         
         upload_name = Path(out).name
         upload_start_time = time.time()
-        with open(out, "rb") as f:
-            uploaded_file = await upload_file(
-                client=client, file=f, name=upload_name,
-                progress_callback=lambda d, t: progress(d, t, nnn, upload_start_time, "Uploading File", upload_name)
-            )
+        if uploaded_file is not None:
+            # Already uploaded part by part while the encoder was running
+            upload_time = "overlapped with encode"
+        else:
+            async with bot_state.scheduler.slot("upload", upload_name):
+                upload_start_time = time.time()  # don't count the wait for a slot
+                uploaded_file = await upload_output(client, out, upload_name, nnn, upload_start_time, upload_origin)
+            upload_time = ts(int((time.time() - upload_start_time) * 1000))
         
-        upload_time = ts(int((time.time() - upload_start_time) * 1000))
         await nnn.delete()
 
         # Use generated thumbnail or fallback to existing thumb.jpg
@@ -551,6 +1302,8 @@ async def upload_compressed_file(event, dl, out, dtime, compress_start_time, pre
         video_duration = video_metadata['duration'] if video_metadata else None
         video_width = video_metadata['width'] if video_metadata else 0
         video_height = video_metadata['height'] if video_metadata else 0
+        if not video_duration and os.path.exists(dl):
+            video_duration = await get_video_duration(dl)
 
         duration_str = f"{int(video_duration//60)}:{int(video_duration%60):02d}" if video_duration else "Unknown"
         LOGS.info(f"Video metadata - Duration: {video_duration}s, Resolution: {video_width}x{video_height}")
@@ -574,45 +1327,68 @@ async def upload_compressed_file(event, dl, out, dtime, compress_start_time, pre
             )]
             LOGS.info(f"Using DocumentAttributeVideo: duration={int(video_duration)}, size={video_width}x{video_height}")
 
-        final_message = await client.send_file(
-            chat_id,
-            file=uploaded_file,
-            force_document=force_document,
-            thumb=thumb_path,
-            caption=caption,
-            attributes=attributes
-        )
+        try:
+            final_message = await client.send_file(
+                chat_id,
+                file=uploaded_file,
+                force_document=force_document,
+                thumb=thumb_path,
+                caption=caption,
+                attributes=attributes
+            )
+        except (errors.FilePartMissingError, errors.FilePartsInvalidError) as e:
+            # Telegram dropped parts of a resumed upload; send the whole file once more
+            LOGS.warning(f"Resumed upload of {out} is unusable ({e}), uploading it again")
+            forget_upload(out)
+            uploaded_file = await upload_output(client, out, upload_name, None, time.time(), upload_origin)
+            final_message = await client.send_file(
+                chat_id,
+                file=uploaded_file,
+                force_document=force_document,
+                thumb=thumb_path,
+                caption=caption,
+                attributes=attributes
+            )
+        forget_upload(out)
         
+        # Kept with the cached result so a cache hit sends them too
+        extras = []
         if preview_path and os.path.exists(preview_path):
             LOGS.info(f"Sending video preview: {preview_path}")
-            await client.send_file(chat_id, file=preview_path, caption="**Video Preview**")
+            sent = await client.send_file(chat_id, file=preview_path, caption="**Video Preview**")
+            extras.append({"caption": "**Video Preview**", "message_ids": [sent.id]})
             os.remove(preview_path)
         else:
             LOGS.info(f"No preview to send - path: {preview_path}, exists: {os.path.exists(preview_path) if preview_path else False}")
 
         if screenshots and len(screenshots) > 0:
             LOGS.info(f"Sending {len(screenshots)} screenshots")
-            await client.send_file(chat_id, file=screenshots, caption="**Screenshots**")
+            sent = await client.send_file(chat_id, file=screenshots, caption="**Screenshots**")
+            sent = sent if isinstance(sent, list) else [sent]
+            extras.append({"caption": "**Screenshots**", "message_ids": [m.id for m in sent]})
             for ss in screenshots:
                 if os.path.exists(ss):
                     os.remove(ss)
         else:
             LOGS.info(f"No screenshots to send - count: {len(screenshots) if screenshots else 0}")
         
-        org_size, com_size = os.path.getsize(dl), os.path.getsize(out)
+        # A streamed source may not have been kept on disk
+        has_source = os.path.exists(dl)
+        org_size = os.path.getsize(dl) if has_source else (source_size or 0)
+        com_size = os.path.getsize(out)
         reduction = 100 - (com_size / org_size * 100) if org_size > 0 else 0
         
-        info_before_html = await info(dl)
+        info_before_html = await info(dl) if has_source else None
         info_after_html = await info(out)
         
-        tgp_client = TelegraphPoster(use_api=True)
         info_before_url, info_after_url = None, None
         try:
-            tgp_client.create_api_token("Mediainfo", author_name="CompressorBot")
-            if info_before_html:
-                info_before_url = tgp_client.post(title="Mediainfo (Before)", author="CompressorBot", text=info_before_html)["url"]
-            if info_after_html:
-                info_after_url = tgp_client.post(title="Mediainfo (After)", author="CompressorBot", text=info_after_html)["url"]
+            # Both pages go out together over the shared HTTP session
+            posts = await asyncio.gather(
+                http_client.telegraph_post("Mediainfo (Before)", info_before_html) if info_before_html else asyncio.sleep(0),
+                http_client.telegraph_post("Mediainfo (After)", info_after_html) if info_after_html else asyncio.sleep(0),
+            )
+            info_before_url, info_after_url = posts
         except Exception as e:
             LOGS.error(f"Telegraph post failed: {e}")
             
@@ -630,13 +1406,21 @@ async def upload_compressed_file(event, dl, out, dtime, compress_start_time, pre
             f"  - **Compress**: {comp_time}\n"
             f"  - **Upload**: {upload_time}{gpu_info}\n\n"
         )
+        if copy_reason:
+            mode_label = {"remux": "Remuxed (stream copy)", "copy_video": "Video copied, audio re-encoded"}.get(copy_mode, "Re-encoded")
+            stats_msg += f"💡 **Mode**: {mode_label} — {copy_reason}\n\n"
+        transfer_summary = transfer_monitor.job_summary(bandwidth.current_job())
+        if transfer_summary:
+            stats_msg += f"📡 **Transfers**: {transfer_summary}\n\n"
         if info_before_url and info_after_url:
             stats_msg += f"📋 **MediaInfo**: [Before]({info_before_url}) | [After]({info_after_url})"
         
         await final_message.reply(stats_msg, link_preview=False)
+        if cache_key:
+            result_cache.put(cache_key, final_message, caption, stats_msg, extras)
 
-        # Clean up thumbnail file
-        if thumb_path and os.path.exists(thumb_path) and validate_file_path(thumb_path):
+        # Clean up thumbnail file (cached custom thumbnails are reused by later jobs)
+        if thumb_path and os.path.exists(thumb_path) and validate_file_path(thumb_path) and not thumb_cache.owns(thumb_path):
             try:
                 os.remove(thumb_path)
                 LOGS.info(f"Cleaned up thumbnail: {thumb_path}")
@@ -645,7 +1429,10 @@ async def upload_compressed_file(event, dl, out, dtime, compress_start_time, pre
 
     except Exception as e:
         LOGS.error(f"Upload error: {e}", exc_info=True)
-        await event.client.send_message(event.chat_id, f"❌ **UPLOAD ERROR**: `{str(e)}`")
+        error_message = f"❌ **UPLOAD ERROR**: `{str(e)}`"
+        if has_pending_upload(out):
+            error_message += "\n♻️ The parts already sent are kept; send the same file again soon to resume the upload."
+        await event.client.send_message(event.chat_id, error_message)
 
 
 async def dl_link(event):
@@ -661,7 +1448,7 @@ async def dl_link(event):
     output_settings = settings_manager.get_setting("output_settings", user_id=event.sender_id)
     max_queue_size = output_settings.get("max_queue_size", 15)
 
-    if bot_state.is_working() or bot_state.queue_size() > 0:
+    if not bot_state.scheduler.has_free_job_slot() or bot_state.queue_size() > 0:
         if not bot_state.add_to_queue(link, event):
             return await event.reply(f"❌ Queue is full (max {max_queue_size}) or item already exists.")
         return await event.reply(f"✅ Added to queue at position #{bot_state.queue_size()}")
@@ -670,19 +1457,49 @@ async def dl_link(event):
     await process_link_download(event, link, name)
 
 
-async def process_link_download(event, link, name):
+def start_bandwidth_job(user_id, job_id):
+    """Pace this job's transfers against the others with the user's bandwidth weight"""
+    weight = settings_manager.get_setting("advanced_settings", "bandwidth_weight", user_id) or 1
+    return bandwidth.start_job(f"job-{job_id}", weight)
+
+
+def finish_probe_job(job_id, token):
+    """Log how many ffprobe runs the job made; more than one per file means a stage bypassed the cache"""
+    probes = probe_cache.finish_job(token)
+    LOGS.info(f"Job {job_id} ran ffprobe {probes} time(s)")
+
+
+async def process_link_download(event, link, name, job_id=None):
     user_id = event.sender_id
-    bot_state.set_working(True)
-    xxx = await event.reply("`Analysing link...`")
+    # Registered before the first await so concurrent handlers see the slot as taken
+    job_id = job_id or bot_state.scheduler.start_job(name or link)
+    bandwidth_job = start_bandwidth_job(user_id, job_id)
+    probe_job = probe_cache.start_job(f"job-{job_id}")
+    xxx = None
     try:
+        xxx = await event.reply("`Analysing link...`")
         from .funcn import fast_download
-        dl = await fast_download(xxx, link, name)
-        await process_compression(xxx, dl, datetime.now(), user_id)
+        # Keyed by link, so a restarted job resumes its partial download
+        directory = bot_state.scheduler.job_dir("downloads", hashlib.sha1(link.encode()).hexdigest()[:16], job_id)
+        async with bot_state.scheduler.slot("download", name or link):
+            dl = await fast_download(xxx, link, name, directory)
+
+        # A URL says nothing about what it serves, so link results (and resumed uploads) are keyed by content
+        source_id = await ResultCache.content_source(dl)
+        cache_key = None
+        if settings_manager.get_setting("advanced_settings", user_id=user_id).get("result_cache", True):
+            cache_key = result_cache.make_key(source_id, user_id)
+            if await send_cached_result(event, xxx, cache_key):
+                return
+        await process_compression(xxx, dl, datetime.now(), user_id, cache_key=cache_key, source_id=source_id)
     except Exception as er:
         LOGS.error(f"Link download failed: {er}", exc_info=True)
-        await xxx.edit(f"❌ **Download failed:**\n`{str(er)}`")
+        if xxx:
+            await xxx.edit(f"❌ **Download failed:**\n`{str(er)}`")
     finally:
-        bot_state.clear_working()
+        bandwidth.finish_job(bandwidth_job)
+        finish_probe_job(job_id, probe_job)
+        bot_state.scheduler.finish_job(job_id)
 
 
 async def toggle_upload_mode(event):
@@ -761,7 +1578,7 @@ async def encod(event):
     if doc_attr.size > max_file_size * 1024 * 1024:
         return await event.reply(f"❌ File too large: {hbs(doc_attr.size)} > {max_file_size}MB.")
 
-    if bot_state.is_working() or bot_state.queue_size() > 0:
+    if not bot_state.scheduler.has_free_job_slot() or bot_state.queue_size() > 0:
         if not bot_state.add_to_queue(doc_attr.id, event):
             return await event.reply(f"❌ Queue is full (max {max_queue_size}) or item already exists.")
         return await event.reply(f"`✅ Added to queue at position #{bot_state.queue_size()}`")
@@ -769,12 +1586,24 @@ async def encod(event):
     await process_file_encoding(event)
 
 
-async def process_file_encoding(event):
+async def refetch_document(event):
+    """Fetches the message's document again, with a fresh file reference."""
+    message = await event.client.get_messages(event.chat_id, ids=event.id)
+    if not message or not message.document:
+        raise ValueError("The original message is no longer available")
+    return message.document
+
+
+async def process_file_encoding(event, job_id=None):
     user_id = event.sender_id
-    bot_state.set_working(True)
-    xxx = await event.reply("`Preparing to download...`")
+    # Registered before the first await so concurrent handlers see the slot as taken
+    job_id = job_id or bot_state.scheduler.start_job(getattr(event.file, 'name', None) or "video")
+    bandwidth_job = start_bandwidth_job(user_id, job_id)
+    probe_job = probe_cache.start_job(f"job-{job_id}")
+    xxx = None
     dl = None
     try:
+        xxx = await event.reply("`Preparing to download...`")
         file = event.media.document
         filename = getattr(event.file, 'name', f"video_{file.id}.mp4")
         if not filename:
@@ -782,20 +1611,55 @@ async def process_file_encoding(event):
         
         sanitized_filename = "".join(c for c in filename if c.isalnum() or c in "._- ")
         
-        os.makedirs("downloads/", exist_ok=True)
-        dl = os.path.join("downloads/", sanitized_filename)
-        
-        with open(dl, "wb") as f:
-            await download_file(
+        scheduler = bot_state.scheduler
+        # Keyed by document, so a restarted job resumes its partial download
+        dl = os.path.join(scheduler.job_dir("downloads", file.id, job_id), sanitized_filename)
+
+        advanced_settings = settings_manager.get_setting("advanced_settings", user_id=user_id)
+        source_id = ResultCache.document_source(file)
+        cache_key = None
+        if advanced_settings.get("result_cache", True):
+            cache_key = result_cache.make_key(source_id, user_id)
+            if await send_cached_result(event, xxx, cache_key):
+                return
+
+        # A size budget needs the duration up front and two passes over a file on disk
+        target_size = settings_manager.get_active_compression_settings(user_id).get("target_size")
+        if advanced_settings.get("stream_encoding", False) and not target_size:
+            # A streamed job holds its download slot until the encoder has read everything,
+            # then gives it back while the encode finishes and the output uploads
+            release_download = await scheduler.acquire("download", sanitized_filename)
+            try:
+                chunks = iter_download(event.client, file, dl)
+                head = await chunks.__anext__()
+                if is_streamable_container(head):
+                    keep_source = advanced_settings.get("stream_keep_source", True)
+                    return await process_compression(
+                        xxx, dl, datetime.now(), user_id,
+                        source=_prepend_chunk(head, chunks, on_done=release_download),
+                        keep_source=keep_source, source_size=file.size,
+                        cache_key=cache_key, source_id=source_id
+                    )
+                await chunks.aclose()
+            finally:
+                release_download()
+            LOGS.info(f"{sanitized_filename} needs seekable input, falling back to a full download")
+
+        async with scheduler.slot("download", sanitized_filename):
+            # Picks up a partial download of the same document left by a failed or restarted job
+            await download_resumable(
                 client=event.client,
                 location=file,
-                out=f,
-                progress_callback=lambda d, t: progress(d, t, xxx, time.time(), "Downloading File", sanitized_filename)
+                path=dl,
+                progress_callback=lambda d, t: progress(d, t, xxx, time.time(), "Downloading File", sanitized_filename),
+                refresh_location=lambda: refetch_document(event)
             )
-        await process_compression(xxx, dl, datetime.now(), user_id)
+        await process_compression(xxx, dl, datetime.now(), user_id, cache_key=cache_key, source_id=source_id)
     except Exception as er:
         LOGS.error(f"File encoding failed: {er}", exc_info=True)
         if xxx:
             await xxx.edit(f"❌ **Processing failed:**\n`{str(er)}`")
     finally:
-        bot_state.clear_working()
\ No newline at end of file
+        bandwidth.finish_job(bandwidth_job)
+        finish_probe_job(job_id, probe_job)
+        bot_state.scheduler.finish_job(job_id)
\ No newline at end of file
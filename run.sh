@@ -40,7 +40,7 @@ fi
 
 # Check Python dependencies
 echo "📦 Checking Python dependencies..."
-python3 -c "import telethon, aiohttp, psutil, pymediainfo" 2>/dev/null || {
+python3 -c "import telethon, aiohttp, psutil, PIL" 2>/dev/null || {
     echo "📦 Installing Python dependencies..."
     pip3 install -r requirements.txt
 }
@@ -0,0 +1,8 @@
+import os
+import sys
+
+# bot.config reads these at import time; the tests never connect to Telegram
+for name, value in {"APP_ID": "1", "API_HASH": "test", "BOT_TOKEN": "test", "OWNER": "1"}.items():
+    os.environ.setdefault(name, value)
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
@@ -0,0 +1,81 @@
+import asyncio
+import os
+import threading
+
+import pytest
+
+from bot import disk_writer
+from bot.disk_writer import DiskWriter
+
+
+def test_writes_land_at_their_offsets(tmp_path):
+    path = str(tmp_path / "out.bin")
+    chunks = [(offset, bytes([offset // 100]) * 100) for offset in range(0, 1000, 100)]
+    written = []
+
+    async def main():
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            writer = DiskWriter(fd, 1000, path)
+            for offset, data in reversed(chunks):
+                await writer.write(offset, data, lambda offset=offset: written.append(offset))
+            await writer.close()
+        finally:
+            os.close(fd)
+
+    asyncio.run(main())
+    with open(path, "rb") as f:
+        assert f.read() == b"".join(data for _, data in chunks)
+    assert written == [offset for offset, _ in reversed(chunks)]
+
+
+def test_write_waits_while_the_writer_is_behind(tmp_path, monkeypatch):
+    path = str(tmp_path / "out.bin")
+    disk = threading.Event()
+    real_pwrite = disk_writer.pwrite_all
+
+    def slow_pwrite(fd, data, offset):
+        disk.wait()
+        real_pwrite(fd, data, offset)
+
+    monkeypatch.setattr(disk_writer, "pwrite_all", slow_pwrite)
+
+    async def main():
+        fd = os.open(path, os.O_RDWR | os.O_CREAT, 0o644)
+        try:
+            writer = DiskWriter(fd, 400, path, max_pending=200, sync=False)
+            await writer.write(0, b"a" * 100)
+            await writer.write(100, b"b" * 100)
+            third = asyncio.ensure_future(writer.write(200, b"c" * 100))
+            await asyncio.sleep(0.1)
+            assert not third.done() and writer.pending == 200
+            disk.set()
+            await asyncio.wait_for(third, 5)
+            await writer.write(300, b"d" * 100)
+            await writer.close()
+            assert writer.pending == 0
+        finally:
+            os.close(fd)
+
+    asyncio.run(main())
+    with open(path, "rb") as f:
+        assert f.read() == b"a" * 100 + b"b" * 100 + b"c" * 100 + b"d" * 100
+
+
+def test_write_error_is_raised(tmp_path):
+    path = str(tmp_path / "out.bin")
+    open(path, "wb").close()
+
+    async def main():
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            writer = DiskWriter(fd, label=path, sync=False)
+            await writer.write(0, b"data", lambda: pytest.fail("done ran for a failed write"))
+            with pytest.raises(OSError):
+                await writer.close()
+            with pytest.raises(OSError):
+                await writer.write(4, b"more")
+        finally:
+            os.close(fd)
+
+    asyncio.run(main())
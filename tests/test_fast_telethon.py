@@ -0,0 +1,78 @@
+import os
+
+from bot.FastTelethon import (
+    BIG_FILE_THRESHOLD, MAX_DOWNLOAD_PART_SIZE, MAX_UPLOAD_PART_SIZE, PartBitmap, pick_part_size
+)
+
+PART = 512 * 1024
+SIZE = 10 * PART + 1000
+
+
+def test_part_bitmap_layout():
+    parts = PartBitmap(None, "key", SIZE, PART)
+    assert parts.part_count == 11
+    assert parts.part_length(0) == PART
+    assert parts.part_length(10) == 1000
+    parts.mark(3)
+    parts.mark(10)
+    assert parts.has(3) and not parts.has(4)
+    assert parts.missing() == [0, 1, 2, 4, 5, 6, 7, 8, 9]
+    assert parts.completed_bytes() == PART + 1000
+
+
+def test_part_bitmap_round_trip(tmp_path):
+    path = str(tmp_path / "video.mkv.parts")
+    parts = PartBitmap(path, "doc:1", SIZE, PART)
+    for index in (0, 1, 9):
+        parts.mark(index)
+    parts.extra["file_id"] = 42
+    parts.save(force=True)
+
+    resumed = PartBitmap.load(path, "doc:1", SIZE, PART)
+    assert resumed.missing() == [2, 3, 4, 5, 6, 7, 8, 10]
+    assert resumed.extra == {"file_id": 42}
+
+    resumed.remove()
+    assert not os.path.exists(path)
+    resumed.remove()  # already gone
+
+
+def test_part_bitmap_starts_over_for_another_transfer(tmp_path):
+    path = str(tmp_path / "video.mkv.parts")
+    parts = PartBitmap(path, "doc:1", SIZE, PART)
+    parts.mark(0)
+    parts.save(force=True)
+    for key, size, part_size in (("doc:2", SIZE, PART), ("doc:1", SIZE + 1, PART), ("doc:1", SIZE, PART * 2)):
+        other = PartBitmap.load(path, key, size, part_size)
+        assert len(other.missing()) == other.part_count and other.extra == {}
+
+    with open(path, "w") as f:
+        f.write("{not json")
+    assert PartBitmap.load(path, "doc:1", SIZE, PART).missing() == list(range(11))
+    assert PartBitmap.load(str(tmp_path / "missing.parts"), "doc:1", SIZE, PART).completed_bytes() == 0
+
+
+def test_part_bitmap_saves_are_throttled(tmp_path):
+    path = str(tmp_path / "video.mkv.parts")
+    parts = PartBitmap(path, "doc:1", SIZE, PART)
+    parts.save(force=True)
+    parts.mark(5)
+    parts.save()
+    assert not PartBitmap.load(path, "doc:1", SIZE, PART).has(5)
+    parts.save(force=True)
+    assert PartBitmap.load(path, "doc:1", SIZE, PART).has(5)
+
+
+def test_part_size_stays_within_telegram_limits():
+    # upload.saveFilePart: a divisor of 512 KiB in whole KiB; upload.getFile: a divisor of 1 MiB in 4 KiB steps
+    for size in (0, 1, 100 * 1024, 9 * 1024 * 1024, BIG_FILE_THRESHOLD + 1, 1536 * 1024 * 1024, 4000 * 1024 * 1024):
+        upload = pick_part_size(size)
+        assert upload % 1024 == 0 and MAX_UPLOAD_PART_SIZE % upload == 0, size
+        download = pick_part_size(size, download=True)
+        assert download % 4096 == 0 and MAX_DOWNLOAD_PART_SIZE % download == 0, size
+
+
+def test_big_files_use_the_largest_parts():
+    size = BIG_FILE_THRESHOLD + 1
+    assert pick_part_size(size) == MAX_UPLOAD_PART_SIZE
+    assert pick_part_size(size, download=True) == MAX_DOWNLOAD_PART_SIZE
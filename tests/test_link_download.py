@@ -0,0 +1,146 @@
+import asyncio
+import os
+import re
+
+import aiohttp
+import pytest
+from aiohttp import web
+from aiohttp.test_utils import TestServer
+
+from bot import link_download
+from bot.FastTelethon import PARTS_SUFFIX, PartBitmap
+from bot.link_download import LinkChanged, LinkDownloader, LinkInfo, download_link, probe_link
+
+SEGMENT = 64 * 1024
+PAYLOAD = bytes(range(256)) * (4 * SEGMENT // 256) + b"tail" * 30
+
+
+class FileServer:
+    """Serves one file at /file with Range and If-Range, recording every request"""
+
+    def __init__(self, payload=PAYLOAD, etag='"v1"', last_modified=None, head=True, ranges=True):
+        self.payload = payload
+        self.etag = etag
+        self.last_modified = last_modified
+        self.head = head
+        self.ranges = ranges
+        self.requests = []
+        app = web.Application()
+        app.router.add_route("*", "/file", self.handle)
+        self.server = TestServer(app)
+
+    @property
+    def url(self):
+        return str(self.server.make_url("/file"))
+
+    def validators(self):
+        headers = {}
+        if self.etag:
+            headers["ETag"] = self.etag
+        if self.last_modified:
+            headers["Last-Modified"] = self.last_modified
+        return headers
+
+    async def handle(self, request):
+        self.requests.append((request.method, request.headers.get("Range")))
+        headers = self.validators()
+        if self.ranges:
+            headers["Accept-Ranges"] = "bytes"
+        if request.method == "HEAD":
+            if not self.head:
+                return web.Response(status=405)
+            return web.Response(headers={**headers, "Content-Length": str(len(self.payload))})
+        match = re.match(r"bytes=(\d+)-(\d+)", request.headers.get("Range", ""))
+        if_range = request.headers.get("If-Range")
+        if not self.ranges or not match or (if_range and if_range not in (self.etag, self.last_modified)):
+            return web.Response(body=self.payload, headers=headers)
+        start, end = int(match.group(1)), min(int(match.group(2)), len(self.payload) - 1)
+        headers["Content-Range"] = f"bytes {start}-{end}/{len(self.payload)}"
+        return web.Response(status=206, body=self.payload[start:end + 1], headers=headers)
+
+    async def __aenter__(self):
+        await self.server.start_server()
+        return self
+
+    async def __aexit__(self, *exc):
+        await self.server.close()
+
+
+@pytest.fixture(autouse=True)
+def small_segments(monkeypatch):
+    monkeypatch.setattr(link_download, "SEGMENT_SIZE", SEGMENT)
+    monkeypatch.setattr(link_download, "SEGMENT_RETRY_BACKOFF", 0)
+
+
+def test_probe_falls_back_to_one_byte_range():
+    async def main():
+        async with FileServer(head=False) as server, aiohttp.ClientSession() as session:
+            link = await probe_link(session, server.url)
+        assert (link.size, link.ranges, link.etag) == (len(PAYLOAD), True, '"v1"')
+        assert server.requests == [("HEAD", None), ("GET", "bytes=0-0")]
+
+    asyncio.run(main())
+
+
+def test_segmented_resumes_from_recorded_offsets(tmp_path):
+    path = str(tmp_path / "video.mkv")
+    kept = SEGMENT + 1000
+
+    async def main():
+        async with FileServer() as server, aiohttp.ClientSession() as session:
+            link = await probe_link(session, server.url)
+            # An earlier run finished range 0 and got 1000 bytes into range 1
+            with open(path, "wb") as f:
+                f.write(PAYLOAD[:kept] + bytes(len(PAYLOAD) - kept))
+            parts = PartBitmap(f"{path}{PARTS_SUFFIX}", f"{link.source}|{link.validator}", len(PAYLOAD), SEGMENT)
+            parts.mark(0)
+            parts.extra["partial"] = {"1": 1000}
+            parts.save(force=True)
+            server.requests.clear()
+            size = await download_link(session, link, path, connections=2)
+        assert size == len(PAYLOAD)
+        with open(path, "rb") as f:
+            assert f.read() == PAYLOAD
+        starts = sorted(int(re.match(r"bytes=(\d+)", r).group(1)) for _, r in server.requests)
+        assert starts == [kept, 2 * SEGMENT, 3 * SEGMENT, 4 * SEGMENT]
+        assert not os.path.exists(f"{path}{PARTS_SUFFIX}")
+
+    asyncio.run(main())
+
+
+@pytest.mark.parametrize("validator", ["etag", "last_modified"])
+def test_changed_validator_raises_link_changed(tmp_path, validator):
+    path = str(tmp_path / "video.mkv")
+    if validator == "etag":
+        before, after = {"etag": '"v1"'}, {"etag": '"v2"'}
+    else:
+        before = {"etag": None, "last_modified": "Mon, 05 Oct 2026 10:00:00 GMT"}
+        after = {"last_modified": "Tue, 06 Oct 2026 10:00:00 GMT"}
+
+    async def main():
+        async with FileServer(**before) as server, aiohttp.ClientSession() as session:
+            link = await probe_link(session, server.url)
+            for name, value in after.items():
+                setattr(server, name, value)
+            with pytest.raises(LinkChanged):
+                await LinkDownloader(session, link, path, connections=1).run()
+            # download_link probes again and starts over under the new validator
+            assert await download_link(session, link, path, connections=2) == len(PAYLOAD)
+        with open(path, "rb") as f:
+            assert f.read() == PAYLOAD
+
+    asyncio.run(main())
+
+
+def test_single_truncates_short_tail(tmp_path):
+    path = str(tmp_path / "video.mkv")
+
+    async def main():
+        async with FileServer(ranges=False) as server, aiohttp.ClientSession() as session:
+            # The link promised more than the server sends
+            link = LinkInfo(server.url, server.url, len(PAYLOAD) + 500, False, None)
+            with pytest.raises(Exception, match="Download incomplete"):
+                await LinkDownloader(session, link, path).run()
+        assert os.path.getsize(path) == len(PAYLOAD)
+
+    asyncio.run(main())
@@ -0,0 +1,88 @@
+from bot.worker import (
+    CONTAINER_OVERHEAD, MIN_SEGMENT_DURATION, THREADS_PER_SEGMENT, compute_video_bitrate, get_segment_plan,
+    get_size_budget, is_streamable_container, plan_stream_copy
+)
+
+SETTINGS = {"v_codec": "libx264", "v_scale": 1080, "v_fps": 30, "v_qp": 26, "a_bitrate": "192k"}
+
+
+def box(kind, payload=b""):
+    return (8 + len(payload)).to_bytes(4, "big") + kind + payload
+
+
+def test_segment_plan_keeps_two_segments_per_worker():
+    cpus = 4 * THREADS_PER_SEGMENT
+    assert get_segment_plan(3600, cpus) == (8, 4)
+
+
+def test_segment_plan_is_capped_by_segment_length():
+    cpus = 8 * THREADS_PER_SEGMENT
+    assert get_segment_plan(3 * MIN_SEGMENT_DURATION + 1, cpus) == (3, 3)
+
+
+def test_segment_plan_falls_back_to_one_encode():
+    assert get_segment_plan(3600, THREADS_PER_SEGMENT) == (1, 1)  # one worker
+    assert get_segment_plan(None, 64) == (1, 1)  # duration unknown
+    assert get_segment_plan(MIN_SEGMENT_DURATION * 1.5, 64) == (1, 1)  # too short to split
+
+
+def test_streamable_containers():
+    assert is_streamable_container(b"\x1a\x45\xdf\xa3" + bytes(60))  # Matroska
+    assert is_streamable_container(b"FLV\x01" + bytes(60))
+    assert is_streamable_container(b"\x47" + bytes(187) + b"\x47" + bytes(187))  # MPEG-TS
+    assert not is_streamable_container(b"RIFF" + bytes(60))
+
+
+def test_mp4_needs_moov_before_mdat():
+    ftyp = box(b"ftyp", b"isom" + bytes(12))
+    assert is_streamable_container(ftyp + box(b"free", bytes(8)) + box(b"moov", bytes(32)) + box(b"mdat"))
+    assert not is_streamable_container(ftyp + box(b"mdat", bytes(32)) + box(b"moov"))
+    # A box with a 64-bit size is skipped by that size
+    large_free = (1).to_bytes(4, "big") + b"free" + (24).to_bytes(8, "big") + bytes(8)
+    assert is_streamable_container(ftyp + large_free + box(b"moov"))
+    # moov may lie beyond the bytes downloaded so far
+    assert not is_streamable_container(ftyp + (4096).to_bytes(4, "big") + b"wide")
+
+
+def probe(video=None, audio=None, format_bit_rate=None):
+    video = {"codec_type": "video", "codec_name": "h264", "pix_fmt": "yuv420p", "width": 1920, "height": 1080,
+             "avg_frame_rate": "30000/1001", "bit_rate": "2000000", **(video or {})}
+    audio = {"codec_type": "audio", "codec_name": "aac", "bit_rate": "128000", **(audio or {})}
+    return {"streams": [video, audio], "format": {"bit_rate": format_bit_rate}}
+
+
+def test_stream_copy_remuxes_a_source_that_meets_the_target():
+    assert plan_stream_copy(probe(), SETTINGS)[0] == "remux"
+    assert plan_stream_copy(probe(audio={"codec_name": "opus"}), SETTINGS)[0] == "copy_video"
+    # Matroska keeps only the overall bitrate
+    assert plan_stream_copy(probe(video={"bit_rate": None}, format_bit_rate="2128000"), SETTINGS)[0] == "remux"
+
+
+def test_stream_copy_re_encodes_when_it_would_gain_something():
+    cases = [
+        probe(video={"codec_name": "hevc"}),
+        probe(video={"pix_fmt": "yuv420p10le"}),
+        probe(video={"height": 2160}),
+        probe(video={"avg_frame_rate": "60/1"}),
+        probe(video={"bit_rate": "20000000"}),
+        probe(video={"bit_rate": None}),
+        None,
+    ]
+    for case in cases:
+        assert plan_stream_copy(case, SETTINGS)[0] == "encode", case
+    assert plan_stream_copy(probe(), SETTINGS, watermark_enabled=True)[0] == "encode"
+
+
+def test_size_budget_never_exceeds_max_file_size():
+    assert get_size_budget({"target_size": 0}, {"max_file_size": 2000}) == 0
+    assert get_size_budget({}, {}) == 0
+    assert get_size_budget({"target_size": 500}, {"max_file_size": 2000}) == 500 * 1024 * 1024
+    assert get_size_budget({"target_size": 5000}, {"max_file_size": 2000}) == 2000 * 1024 * 1024
+    assert get_size_budget({"target_size": "5000"}, {}) == 4000 * 1024 * 1024
+
+
+def test_video_bitrate_leaves_room_for_audio_and_container():
+    budget, duration = 100 * 1024 * 1024, 600
+    total = budget * 8 * (1 - CONTAINER_OVERHEAD) / duration
+    assert compute_video_bitrate(budget, duration, "128k") == int(total - 128000)
+    assert compute_video_bitrate(budget, duration, "128k", has_audio=False) == int(total)